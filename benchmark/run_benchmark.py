@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# times the stitching steps of preparepano and the COCO conversion on a
+# synthetic scan (see synthetic_scan.py) at several panorama widths and
+# writes the results as JSON, e.g.
+#
+#   python run_benchmark.py --sizes 512 1024 2048 --out before.json
+#   python run_benchmark.py --sizes 512 1024 2048 --out after.json
+#   python run_benchmark.py --compare before.json after.json
+#
+# Steps that use the remap table cache of createpano are timed warm
+# ("cached") and with the cache cleared before every call ("uncached").
+# matterport_coco.py parses its arguments at import, so it is timed as a
+# subprocess over the whole instance loop of the scan.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+import cv2
+import numpy as np
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, "..", "preparepano"))
+
+import createpano
+import panokernel
+import prepare_matterport
+import skybox
+import synthetic_scan
+
+COCO_SCRIPT = os.path.join(_HERE, "..", "convert_coco", "matterport_coco.py")
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=_HERE, capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def _meta(args) -> dict:
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "cpus": os.cpu_count(),
+        "machine": platform.machine(),
+        "commit": _git_commit(),
+        "scan": args.scan_id,
+        "repeat": args.repeat,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+# run fn repeat times, setup (not timed) before each run
+def timeit(fn: typing.Callable, repeat: int, setup: typing.Callable = None) -> typing.List[float]:
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+def _result(name: str, size: int, mode: str, times: typing.List[float]) -> dict:
+    return {"name": name, "size": size, "mode": mode, "times": times,
+        "min": min(times), "median": float(np.median(times))}
+
+def load_location(scan_path: str, scan_id: str) -> dict:
+    base = os.path.join(scan_path, scan_id, scan_id)
+    conf = os.path.join(base, "undistorted_camera_parameters", scan_id + ".conf")
+    params = prepare_matterport.parse_camera_params(conf)
+    location = sorted(params.keys())[0]
+    data = {"location": location, "angles": createpano.get_angles(params[location])}
+    for key, folder in [("color", "undistorted_color_images"), ("depth", "undistorted_depth_images"),
+            ("classes", "segmentation_maps_classes"), ("skybox", "matterport_skybox_images")]:
+        filenames = sorted(f for f in os.listdir(os.path.join(base, folder)) if f.startswith(location))
+        data[key] = [prepare_matterport.load_image(os.path.join(base, folder, f)) for f in filenames]
+    return data
+
+# steps of the stitching pipeline on one location at width size
+def bench_stitching(data: dict, size: int, repeat: int) -> typing.List[dict]:
+    outsize = (size, size // 2)
+    v = data["angles"]
+    fov = createpano.default_fov
+    color = data["color"][0][createpano.imcutout[0][0]:createpano.imcutout[0][1],
+        createpano.imcutout[1][0]:createpano.imcutout[1][1]]
+    results = []
+    cases = [
+        ("im2sphere", lambda: createpano.im2sphere(color, fov, outsize[0], outsize[1], v[0,0], v[0,1], True, 0)),
+        ("combine_views_color", lambda: createpano.combine_views(data["color"], v, outsize, True)),
+        ("combine_views_depth", lambda: createpano.combine_views(data["depth"], v, outsize, False, True,
+            dtype=np.uint16)),
+        ("combine_views_classes", lambda: createpano.combine_views(data["classes"], v, outsize, False)),
+    ]
+    for name, fn in cases:
+        fn()
+        results.append(_result(name, size, "cached", timeit(fn, repeat)))
+        results.append(_result(name, size, "uncached", timeit(fn, repeat, createpano.clear_remap_cache)))
+
+    # the compiled backend, timed after a first (compiling) call, and its
+    # agreement with the NumPy backend
+    if panokernel.available():
+        for name, images, blending, depth, dtype in [("combine_views_color", data["color"], True, False, np.uint8),
+                ("combine_views_depth", data["depth"], False, True, np.uint16)]:
+            fn = lambda: createpano.combine_views(images, v, outsize, blending, depth, dtype=dtype)
+            createpano.stitch_backend = "numba"
+            try:
+                fn()
+                results.append(_result(name, size, "numba", timeit(fn, repeat)))
+            finally:
+                createpano.stitch_backend = "numpy"
+            fraction, maxdiff = panokernel.compare_backends(images, v, outsize, blending, depth, dtype=dtype)
+            results.append({"name": name, "size": size, "mode": "agreement", "differing": fraction, "max": maxdiff})
+
+    # the uncached path of PanoBasic, from panorama coordinates over the
+    # footprint of the view
+    r0, r1, c0, ncols = createpano.view_footprint(color.shape[0], color.shape[1], fov, outsize[0], outsize[1],
+        v[0,0], v[0,1])
+    cols = np.mod(np.arange(c0, c0 + ncols), outsize[0])
+    Px, Py, _ = createpano.sphere_coords(color.shape[0], color.shape[1], fov, outsize[0], outsize[1],
+        v[0,0], v[0,1], np.arange(r0, r1), cols)
+    Px[np.logical_not(np.isfinite(Px))] = -16
+    Py[np.logical_not(np.isfinite(Py))] = -16
+    fn = lambda: createpano.warp_image_fast(color, Px, Py, True, (ncols, r1 - r0), 0)
+    results.append(_result("warp_image_fast", size, "uncached", timeit(fn, repeat)))
+
+    # faces of a skybox grid are loaded once per location
+    faces = data["skybox"]
+    fn = lambda: skybox.skybox_to_equirect([faces], outsize)
+    fn()
+    results.append(_result("skybox_to_equirect", size, "cached", timeit(fn, repeat)))
+    results.append(_result("skybox_to_equirect", size, "uncached", timeit(fn, repeat, skybox.skybox_grid.cache_clear)))
+    return results
+
+# corrections do not depend on the panorama size, views are copied in setup
+def bench_depth_correction(data: dict, repeat: int) -> typing.List[dict]:
+    views = []
+    def setup():
+        views[:] = [view.copy() for view in data["depth"]]
+    fn = lambda: prepare_matterport.correct_depth_distortion_batch(views)
+    return [_result("correct_depth_distortion", 0, "batch", timeit(fn, repeat, setup))]
+
+def bench_coco(scan_path: str, scan_id: str, size: int, repeat: int, locations: typing.List[str]) -> dict:
+    root = os.path.join(scan_path, "coco_{}".format(size))
+    if not os.path.exists(os.path.join(root, "mpcat40.tsv")):
+        synthetic_scan.write_coco_inputs(root, scan_id, locations, size)
+    command = [sys.executable, COCO_SCRIPT, "--matterport_root_dir", root, "--matterport_scene_dir", "equirect",
+        "--matterport_annotation_dir", "ply", "--matterport_house_id", scan_id, "--export_color_images",
+        "--coco_annotation_dir", os.path.join(root, "out"), "--coco_annotation_file", "benchmark.json"]
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run(command, cwd=root, capture_output=True, text=True)
+        times.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            lines = proc.stderr.strip().splitlines()
+            return {"name": "matterport_coco", "size": size, "mode": "subprocess",
+                "error": lines[-1] if lines else "exit code {}".format(proc.returncode)}
+    return _result("matterport_coco", size, "subprocess", times)
+
+def run(args) -> dict:
+    scan_path = args.scan_path
+    tmpdir = None
+    if scan_path is None:
+        tmpdir = tempfile.TemporaryDirectory(prefix="synthscan_")
+        scan_path = tmpdir.name
+    if not os.path.exists(os.path.join(scan_path, args.scan_id)):
+        print("writing synthetic scan {} to {}".format(args.scan_id, scan_path))
+        synthetic_scan.write_scan(scan_path, args.scan_id, args.locations)
+    createpano.remap_cache_dir = None
+    data = load_location(scan_path, args.scan_id)
+    locations = sorted(prepare_matterport.parse_camera_params(os.path.join(scan_path, args.scan_id, args.scan_id,
+        "undistorted_camera_parameters", args.scan_id + ".conf")).keys())
+
+    results = bench_depth_correction(data, args.repeat)
+    for size in args.sizes:
+        print("panorama width {}".format(size))
+        results += bench_stitching(data, size, args.repeat)
+        createpano.clear_remap_cache()
+        if not args.skip_coco:
+            results.append(bench_coco(scan_path, args.scan_id, size, args.repeat, locations))
+    if tmpdir is not None:
+        tmpdir.cleanup()
+    return {"meta": _meta(args), "results": results}
+
+def print_results(results: typing.List[dict]) -> None:
+    print("{:<26} {:>6} {:<10} {:>10} {:>10}".format("step", "size", "mode", "min ms", "median ms"))
+    for r in results:
+        if "error" in r:
+            print("{:<26} {:>6} {:<10} {}".format(r["name"], r["size"], r["mode"], r["error"]))
+        elif "differing" in r:
+            print("{:<26} {:>6} {:<10} {:.3%} of pixels differ by more than 2, max {:.0f}".format(
+                r["name"], r["size"], r["mode"], r["differing"], r["max"]))
+        else:
+            print("{:<26} {:>6} {:<10} {:>10.1f} {:>10.1f}".format(r["name"], r["size"], r["mode"],
+                1000 * r["min"], 1000 * r["median"]))
+
+# ratio of the median times of two result files, < 1 is faster
+def compare(old_file: str, new_file: str) -> None:
+    with open(old_file) as f:
+        old = {(r["name"], r["size"], r["mode"]): r for r in json.load(f)["results"]}
+    with open(new_file) as f:
+        new = json.load(f)["results"]
+    print("{:<26} {:>6} {:<10} {:>10} {:>10} {:>7}".format("step", "size", "mode", "old ms", "new ms", "ratio"))
+    for r in new:
+        key = (r["name"], r["size"], r["mode"])
+        if key not in old or "median" not in r or "median" not in old[key]:
+            continue
+        o, n = old[key]["median"], r["median"]
+        print("{:<26} {:>6} {:<10} {:>10.1f} {:>10.1f} {:>7.2f}".format(key[0], key[1], key[2],
+            1000 * o, 1000 * n, n / o))
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="Benchmark the panorama and COCO pipelines on a synthetic scan")
+    parser.add_argument("--scan_path", type=str,
+        help="Root of a synthetic scan, written there if missing (default: temporary directory)"
+    )
+    parser.add_argument("--scan_id", type=str, default="SYNTH0000",
+        help="Name of the scan"
+    )
+    parser.add_argument("--locations", type=int, default=2,
+        help="Number of locations of a new synthetic scan"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048],
+        help="Panorama widths"
+    )
+    parser.add_argument("--repeat", type=int, default=3,
+        help="Runs per step"
+    )
+    parser.add_argument("--skip_coco", action="store_true",
+        help="Do not run the COCO conversion"
+    )
+    parser.add_argument("--out", type=str, default="benchmark.json",
+        help="Result file"
+    )
+    parser.add_argument("--compare", type=str, nargs=2, metavar=("OLD", "NEW"),
+        help="Compare two result files instead of running"
+    )
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    args = parse_arguments(sys.argv[1:])
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+    report = run(args)
+    print_results(report["results"])
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# writes synthetic Matterport3D scans with the directory layout of the real
+# dataset, so that the pipelines can be run and benchmarked without the
+# licensed data:
+#
+#   <out>/<scan>/<scan>/undistorted_camera_parameters/<scan>.conf
+#   <out>/<scan>/<scan>/undistorted_color_images/<loc>_i<row>_<ori>.jpg
+#   <out>/<scan>/<scan>/undistorted_depth_images/<loc>_d<row>_<ori>.png
+#   <out>/<scan>/<scan>/segmentation_maps_classes/<loc>_i<row>_<ori>.png
+#   <out>/<scan>/<scan>/segmentation_maps_instances/<loc>_i<row>_<ori>.png
+#   <out>/<scan>/<scan>/matterport_skybox_images/<loc>_skybox<face>_sami.jpg
+#   <out>/<scan>/<scan>/house_segmentations/<scan>.ply, .fsegs.json, .semseg.json
+#   <out>/<scan>/<folder>.zip                    (with --zip)
+#   <out>/category_mapping.tsv
+#
+# and the inputs of convert_coco/matterport_coco.py for the same scan:
+#
+#   <out>/mpcat40.tsv
+#   <out>/equirect/<scan>/matterport_skybox_images/<loc>.jpg
+#   <out>/equirect/<scan>/segmentation_maps_instances/<loc>.png
+#   <out>/ply/<scan>/sphere_points_smooth/<loc>_filtered_aggregation.json
+#
+# Image content is smooth noise, depth is a smooth field with invalid (zero)
+# regions and label maps hold rectangles in colors of the mpview color table.
+# The house mesh is a room around the locations with boxes standing in it,
+# one object per wall, floor, ceiling and box, and an unlabeled box.
+
+import argparse
+import json
+import os
+import sys
+import zipfile
+import cv2
+import numpy as np
+from scipy.spatial.transform import Rotation as Rot
+
+# first entries of the color table of mpview and matterport_coco.loadMP40
+COLORTABLE = [
+    [0,0,0], [1, 0, 0], [0, 0, 1],
+    [0, 1, 0], [0, 1, 1], [1, 0, 1],
+    [1, 0.5, 0], [0, 1, 0.5], [0.5, 0, 1],
+    [0.5, 1, 0], [0, 0.5, 1], [1, 0, 0.5],
+    [0.5, 0, 0], [0, 0.5, 0], [0, 0, 0.5],
+    [0.5, 0.5, 0], [0, 0.5, 0.5], [0.5, 0, 0.5],
+    [0.7, 0, 0], [0, 0.7, 0], [0, 0, 0.7]
+]
+
+# mpcat40 categories with their NYU40 names
+MPCAT40 = [
+    ("void", "void"), ("wall", "wall"), ("floor", "floor"), ("chair", "chair"),
+    ("door", "door"), ("table", "table"), ("picture", "picture"), ("cabinet", "cabinet"),
+    ("cushion", "pillow"), ("window", "window"), ("sofa", "sofa"), ("bed", "bed"),
+    ("curtain", "curtain"), ("chest_of_drawers", "dresser"), ("plant", "otherprop"),
+    ("sink", "sink"), ("stairs", "otherstructure"), ("ceiling", "ceiling"),
+    ("toilet", "toilet"), ("stool", "otherfurniture"), ("towel", "towel")
+]
+
+FOLDERS = [
+    "undistorted_camera_parameters",
+    "undistorted_color_images",
+    "undistorted_depth_images",
+    "segmentation_maps_classes",
+    "segmentation_maps_instances",
+    "matterport_skybox_images",
+    "house_segmentations"
+]
+
+def _color(index: int) -> np.array:
+    return (255 * np.array(COLORTABLE[index])).astype(np.uint8)
+
+# smooth random image, noise at 1/16 of the size scaled up
+def _smooth_noise(rng: np.random.Generator, height: int, width: int, channels: int) -> np.array:
+    small = rng.random((max(2, height // 16), max(2, width // 16), channels)).astype(np.float32)
+    image = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    return image.reshape(height, width, channels)
+
+def _label_map(rng: np.random.Generator, height: int, width: int, nlabels: int) -> np.array:
+    labels = np.zeros((height, width, 3), np.uint8)
+    for _ in range(nlabels):
+        y0, x0 = rng.integers(0, height - height // 8), rng.integers(0, width - width // 8)
+        y1, x1 = y0 + rng.integers(height // 16, height // 4), x0 + rng.integers(width // 16, width // 4)
+        labels[y0:y1, x0:x1] = _color(int(rng.integers(1, len(COLORTABLE))))
+    return labels
+
+# camera to world matrices of the 3 x 6 views of a location: three tilted
+# cameras turning in 60 degree steps, like the Matterport rig. Cameras look
+# along their -z axis with y up, the world z axis is up.
+def view_matrices(rng: np.random.Generator, position: np.array) -> np.array:
+    matrices = np.zeros((3, 6, 4, 4))
+    for row in range(3):
+        for ori in range(6):
+            rotation = Rot.from_euler('xyz', [np.pi / 2 + 0.5 * (1 - row) + rng.normal(0, 0.002), 0,
+                ori * np.pi / 3 + rng.normal(0, 0.002)])
+            matrices[row, ori] = np.eye(4)
+            matrices[row, ori, 0:3, 0:3] = rotation.as_matrix()
+            matrices[row, ori, 0:3, 3] = position
+    return matrices
+
+def write_scan(
+    out_path: str,
+    scan_id: str = "SYNTH0000",
+    locations: int = 2,
+    view_size: tuple = (1280, 1024),
+    skybox_size: int = 1024,
+    seed: int = 0,
+    zip_folders: bool = False
+) -> list:
+    rng = np.random.default_rng(seed)
+    base = os.path.join(out_path, scan_id, scan_id)
+    for folder in FOLDERS:
+        os.makedirs(os.path.join(base, folder), exist_ok=True)
+    width, height = view_size
+    fx = width / 2 / np.tan(1.06 / 2)
+    lines = ["dataset matterport", "n_images {}".format(locations * 18),
+        "depth_directory undistorted_depth_images", "color_directory undistorted_color_images", ""]
+    location_ids = ["{:016x}{:016x}".format(*rng.integers(0, 2**62, 2)) for _ in range(locations)]
+    for i, loc in enumerate(location_ids):
+        matrices = view_matrices(rng, np.array([i * 1.5, 0, 1.5]))
+        for row in range(3):
+            lines.append("intrinsics_matrix {:f} 0 {:f} 0 {:f} {:f} 0 0 1".format(fx, width / 2, fx, height / 2))
+            for ori in range(6):
+                depth_name = "{}_d{}_{}.png".format(loc, row, ori)
+                color_name = "{}_i{}_{}.jpg".format(loc, row, ori)
+                lines.append("scan {} {} {}".format(depth_name, color_name,
+                    " ".join("{:f}".format(value) for value in matrices[row, ori].flatten())))
+                color = (255 * _smooth_noise(rng, height, width, 3)).astype(np.uint8)
+                cv2.imwrite(os.path.join(base, "undistorted_color_images", color_name), color)
+                # depth in 0.25 mm units, zero where invalid
+                depth = (2000 + 30000 * _smooth_noise(rng, height, width, 1)[:,:,0]).astype(np.uint16)
+                depth[:height // 20] = 0
+                depth[rng.random((height, width)) < 0.01] = 0
+                cv2.imwrite(os.path.join(base, "undistorted_depth_images", depth_name), depth)
+                labels = _label_map(rng, height, width, 8)
+                cv2.imwrite(os.path.join(base, "segmentation_maps_classes", "{}_i{}_{}.png".format(loc, row, ori)), labels)
+                cv2.imwrite(os.path.join(base, "segmentation_maps_instances", "{}_i{}_{}.png".format(loc, row, ori)),
+                    labels[:,:,::-1])
+        for face in range(6):
+            sky = (255 * _smooth_noise(rng, skybox_size, skybox_size, 3)).astype(np.uint8)
+            cv2.imwrite(os.path.join(base, "matterport_skybox_images", "{}_skybox{}_sami.jpg".format(loc, face)), sky)
+    with open(os.path.join(base, "undistorted_camera_parameters", scan_id + ".conf"), 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+    write_house(out_path, scan_id, [i * 1.5 for i in range(locations)], seed)
+
+    # archives as distributed, members stored under <scan>/<folder>/
+    if zip_folders:
+        for folder in FOLDERS:
+            with zipfile.ZipFile(os.path.join(out_path, scan_id, folder + ".zip"), 'w', zipfile.ZIP_STORED) as zip_ref:
+                for filename in sorted(os.listdir(os.path.join(base, folder))):
+                    zip_ref.write(os.path.join(base, folder, filename), "/".join([scan_id, folder, filename]))
+    return location_ids
+
+# triangulated nu x nv grid over the parallelogram origin + [0, 1] u + [0, 1] v,
+# front (counter-clockwise) side towards u x v
+def _grid(origin: np.array, u: np.array, v: np.array, nu: int, nv: int) -> tuple:
+    s, t = np.meshgrid(np.linspace(0, 1, nu + 1), np.linspace(0, 1, nv + 1))
+    vertices = origin + s.reshape(-1, 1) * u + t.reshape(-1, 1) * v
+    k = (np.arange(nv)[:, np.newaxis] * (nu + 1) + np.arange(nu)[np.newaxis, :]).reshape(-1)
+    faces = np.concatenate([np.stack([k, k + 1, k + nu + 2], 1), np.stack([k, k + nu + 2, k + nu + 1], 1)])
+    return vertices, faces
+
+# sides of an axis aligned box without bottom, facing outwards (inwards for
+# a room)
+def _box(lo: np.array, hi: np.array, n: int, inwards: bool = False) -> list:
+    ex, ey, ez = np.diag(hi - lo)
+    sides = [
+        (lo, ex, ez), (lo + ey, ez, ex), (lo, ez, ey), (lo + ex, ey, ez),
+        (lo + ez, ex, ey)
+    ]
+    if inwards:
+        sides = [(lo, ex, ey)] + [(o, v, u) for o, u, v in sides]
+    return [_grid(o, u, v, n, n) for o, u, v in sides]
+
+# house mesh (binary PLY), face segments and objects in the formats of
+# house_segmentations, and a category mapping with the columns mpview reads
+def write_house(out_path: str, scan_id: str, positions: list, seed: int = 0) -> None:
+    rng = np.random.default_rng(seed + 2)
+    base = os.path.join(out_path, scan_id, scan_id, "house_segmentations")
+    os.makedirs(base, exist_ok=True)
+    lo, hi = np.array([-3.0, -4.0, 0.0]), np.array([max(positions) + 3.0, 4.0, 3.0])
+    parts = [(part, label) for part, label in zip(_box(lo, hi, 12, True),
+        ["floor", "wall", "wall", "wall", "wall", "ceiling"])]
+    for k in range(6):
+        x, y = rng.uniform(lo[0] + 0.5, hi[0] - 1.5), (1 if k % 2 else -1) * rng.uniform(1.5, 2.5)
+        size = rng.uniform([0.4, 0.4, 0.4], [1.2, 1.0, 1.8])
+        label = MPCAT40[int(rng.integers(3, len(MPCAT40)))][0]
+        box_lo = np.array([x, y, 0.0])
+        # the last box is not part of any object
+        parts += [(part, label if k < 5 else None) for part in _box(box_lo, box_lo + size, 4)]
+    vertices, faces, segments, groups = [], [], [], {}
+    offset = 0
+    for i, ((v, f), label) in enumerate(parts):
+        vertices.append(v)
+        faces.append(f + offset)
+        offset += len(v)
+        # two segments per part
+        segments.append(2 * i + (np.arange(len(f)) >= len(f) // 2))
+        if label is not None:
+            # the sides of a box form one object
+            key = i if i < 6 else 6 + (i - 6) // 5
+            groups.setdefault(key, {"label": label, "segments": []})["segments"] += [2 * i, 2 * i + 1]
+    vertices, faces, segments = np.concatenate(vertices), np.concatenate(faces), np.concatenate(segments)
+    vertex = np.zeros(len(vertices), [('x', '<f4'), ('y', '<f4'), ('z', '<f4')])
+    vertex['x'], vertex['y'], vertex['z'] = vertices.T
+    face = np.zeros(len(faces), [('n', 'u1'), ('vertex_indices', '<i4', (3,)), ('segment_id', '<i4')])
+    face['n'], face['vertex_indices'], face['segment_id'] = 3, faces, segments
+    header = ["ply", "format binary_little_endian 1.0", "element vertex {}".format(len(vertex)),
+        "property float x", "property float y", "property float z", "element face {}".format(len(face)),
+        "property list uchar int vertex_indices", "property int segment_id", "end_header"]
+    with open(os.path.join(base, scan_id + ".ply"), 'wb') as f:
+        f.write(("\n".join(header) + "\n").encode("ascii"))
+        f.write(vertex.tobytes())
+        f.write(face.tobytes())
+    with open(os.path.join(base, scan_id + ".fsegs.json"), 'w') as f:
+        json.dump({"sceneId": scan_id, "segIndices": segments.tolist()}, f)
+    with open(os.path.join(base, scan_id + ".semseg.json"), 'w') as f:
+        json.dump({"sceneId": scan_id, "segGroups": [{"id": k, "objectId": k, "label": group["label"],
+            "segments": group["segments"]} for k, group in enumerate(groups.values())]}, f)
+    with open(os.path.join(out_path, "category_mapping.tsv"), 'w') as f:
+        f.write("index\traw_category\tcategory\tmpcat40index\tmpcat40\n")
+        for i, (name, _) in enumerate(MPCAT40[1:]):
+            f.write("{}\t{}\t{}\t{}\t{}\n".format(i + 1, name, name, i + 1, name))
+
+# equirectangular skybox and instance panoramas with aggregation files, as
+# read by matterport_coco.py with --matterport_scene_dir equirect and
+# --matterport_annotation_dir ply
+def write_coco_inputs(
+    out_path: str,
+    scan_id: str,
+    location_ids: list,
+    pano_width: int = 1024,
+    instances: int = 12,
+    seed: int = 0
+) -> None:
+    rng = np.random.default_rng(seed + 1)
+    os.makedirs(out_path, exist_ok=True)
+    with open(os.path.join(out_path, "mpcat40.tsv"), 'w') as f:
+        f.write("mpcat40index\tmpcat40\thex\twnsynsetkey\tnyu40\tskip\tcomment\n")
+        for i, (name, nyuname) in enumerate(MPCAT40):
+            rgb = _color(i) if i < len(COLORTABLE) else np.zeros(3, np.uint8)
+            f.write("{}\t{}\t#{:02x}{:02x}{:02x}\t\t{}\t\t\n".format(i, name, rgb[0], rgb[1], rgb[2], nyuname))
+    scene = os.path.join(out_path, "equirect", scan_id)
+    annotations = os.path.join(out_path, "ply", scan_id, "sphere_points_smooth")
+    for folder in (os.path.join(scene, "matterport_skybox_images"), os.path.join(scene, "segmentation_maps_instances"), annotations):
+        os.makedirs(folder, exist_ok=True)
+    height = pano_width // 2
+    for loc in location_ids:
+        pano = (255 * _smooth_noise(rng, height, pano_width, 3)).astype(np.uint8)
+        cv2.imwrite(os.path.join(scene, "matterport_skybox_images", loc + ".jpg"), pano)
+        # instance k has the color of table entry k + 1, see classIdFromColor
+        labels = np.zeros((height, pano_width, 3), np.uint8)
+        groups = []
+        for k in range(min(instances, len(COLORTABLE) - 1)):
+            y0, x0 = rng.integers(0, height - height // 6), rng.integers(0, pano_width - pano_width // 6)
+            y1, x1 = y0 + rng.integers(height // 20, height // 6), x0 + rng.integers(pano_width // 40, pano_width // 6)
+            labels[y0:y1, x0:x1] = _color(k + 1)
+            groups.append({"id": k, "objectId": k, "label": MPCAT40[int(rng.integers(1, len(MPCAT40)))][0]})
+        cv2.imwrite(os.path.join(scene, "segmentation_maps_instances", loc + ".png"), labels[:,:,::-1])
+        with open(os.path.join(annotations, loc + "_filtered_aggregation.json"), 'w') as f:
+            json.dump({"sceneId": scan_id, "segGroups": groups}, f)
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="Write a synthetic Matterport3D scan")
+    parser.add_argument("--out_path", type=str, required=True,
+        help="Output root, the scan is written to <out_path>/<scan_id>"
+    )
+    parser.add_argument("--scan_id", type=str, default="SYNTH0000",
+        help="Name of the scan"
+    )
+    parser.add_argument("--locations", type=int, default=2,
+        help="Number of panorama locations"
+    )
+    parser.add_argument("--view_size", type=int, nargs=2, default=[1280, 1024],
+        help="Width and height of the source views"
+    )
+    parser.add_argument("--skybox_size", type=int, default=1024,
+        help="Size of the skybox faces"
+    )
+    parser.add_argument("--pano_width", type=int, default=1024,
+        help="Width of the panoramas for the COCO conversion"
+    )
+    parser.add_argument("--seed", type=int, default=0,
+        help="Random seed"
+    )
+    parser.add_argument("--zip", action="store_true",
+        help="Also write the ZIP archives of the scan folders"
+    )
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    args = parse_arguments(sys.argv[1:])
+    location_ids = write_scan(args.out_path, args.scan_id, args.locations, tuple(args.view_size),
+        args.skybox_size, args.seed, args.zip)
+    write_coco_inputs(args.out_path, args.scan_id, location_ids, args.pano_width, seed=args.seed)
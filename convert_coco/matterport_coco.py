@@ -348,7 +348,32 @@ def classIdFromColor(rgb,categories):
                         return 0
 
     return 0
-    
+
+# dense lookup table from packed 24 bit colors (r<<16 | g<<8 | b) to the ids of
+# classIdFromColor, with the +-1 tolerance expanded, -1 for background (table
+# entry 0) and colors without a category
+def classIdTable(categories):
+    lut = np.full(1<<24, -1, dtype=np.int16)
+    offsets = [(i,j,k) for i in range(-1,2) for j in range(-1,2) for k in range(-1,2)]
+
+    # later writes win, so go from the last to the first offset probed by classIdFromColor
+    for (i,j,k) in reversed(offsets):
+        for hexstr in categories.keys():
+            cat = categories[hexstr]
+            r = int(hexstr[1:3],16) - i
+            g = int(hexstr[3:5],16) - j
+            b = int(hexstr[5:7],16) - k
+            if min(r,g,b) < 0 or max(r,g,b) > 255:
+                continue
+            lut[(r<<16) | (g<<8) | b] = cat[0]-1 if cat[0]>0 else -1
+
+    return lut
+
+# per pixel ids of an instance image, see classIdTable
+def instanceIdMap(img,lut):
+    rgb = np.asarray(img.convert('RGB'),dtype=np.int32)
+    return lut[(rgb[:,:,0]<<16) | (rgb[:,:,1]<<8) | rgb[:,:,2]]
+
 def getNYUClassId(mpname,mpcategories):
     # find NYU name for MP name
     nyuname = "otherprop"
@@ -440,6 +465,7 @@ def main():
     segmentation_id = 1 # counter
 
     (colorTable,categoryTable) = loadMP40(os.path.join(ROOT_DIR,'mpcat40.tsv'))
+    idTable = classIdTable(categoryTable)
 	
     running_id = 0
 	
@@ -492,12 +518,11 @@ def main():
                     print(instance_filename)
 
                     img = Image.open(instance_filename)
-                    pixel = np.array(img)
-                    # Go through each colour, as instances are encoded as colour values
-                    pixelcolors = [x[1] for x in img.getcolors()]  # [0] = pixelcount, [1] = colour
-                    for colortuple in pixelcolors:
-                        instance_id = classIdFromColor(colortuple,categoryTable)
-                    
+                    # instances are encoded as colour values, decode them all at once
+                    idmap = instanceIdMap(img,idTable)
+                    instance_ids = np.unique(idmap)
+                    for instance_id in instance_ids[instance_ids >= 0].tolist():
+
                         key = str(instance_id)
                         category_label = ''
                         category_id = 0
@@ -516,7 +541,7 @@ def main():
         
                         # Labels are nyu40id and coded as pixel colours (1 .. 40 decimal)
                         category_info = {'id': category_id, 'is_crowd': 'crowd' in image_filename}
-                        binary_mask = np.all(pixel == colortuple, axis=-1)  # Create a binary mask for each of the labels
+                        binary_mask = idmap == instance_id  # Create a binary mask for each of the labels
 						
                         # use morphology to clean masks 
                         if opt.clean_masks:
@@ -61,8 +61,8 @@ LoadIndex(int index, int tag)
 
 
 
-static void
-LoadColor(int k)
+RNRgb
+MPLabelColor(int k)
 {
   // Make array of colors
   const int ncolors = 72;
@@ -93,10 +93,19 @@ LoadColor(int k)
     RNRgb(0.8, 0.8, 0.5), RNRgb(0.5, 0.8, 0.8), RNRgb(0.8, 0.5, 0.8)
   };
 
+  // Return color
+  if (k == -1) return RNRgb(0.8, 0.8, 0.8);
+  else if (k == 0) return colors[0];
+  else return colors[1 + (k % (ncolors-1))];
+}
+
+
+
+static void
+LoadColor(int k)
+{
   // Load color
-  if (k == -1) glColor3d(0.8, 0.8, 0.8);
-  else if (k == 0) RNLoadRgb(colors[0]);
-  else RNLoadRgb(colors[1 + (k % (ncolors-1))]);
+  RNLoadRgb(MPLabelColor(k));
 }
 
 
@@ -396,6 +405,8 @@ Draw(RNFlags draw_flags) const
     LoadColor(object->region->house_index + 1);
   else if ((draw_flags & MP_COLOR_BY_INDEX) && (draw_flags & MP_COLOR_BY_LEVEL) && object && object->region && object->region->level)
     LoadColor(object->region->level->house_index + 1);
+  else if ((draw_flags & MP_COLOR_FOR_PICK) && (draw_flags & MP_COLOR_BY_OBJECT) && object)
+    LoadIndex(object->house_index, MP_OBJECT_TAG);
   else if (draw_flags & MP_COLOR_FOR_PICK)
     LoadIndex(house_index, MP_SEGMENT_TAG);
 
@@ -417,6 +417,14 @@ public:
 
 
 
+////////////////////////////////////////////////////////////////////////
+
+// Color of label or index k, as drawn with MP_COLOR_BY_LABEL and MP_COLOR_BY_INDEX
+
+RNRgb MPLabelColor(int k);
+
+
+
 ////////////////////////////////////////////////////////////////////////
 
 // Constants for defining drawing modes
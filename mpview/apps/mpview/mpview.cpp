@@ -16,6 +16,15 @@
 #include <chrono>
 #include <thread>
 #include <future>
+#include <string>
+#include <vector>
+#include <string.h>
+#if defined(USE_MESA)
+#include <GL/osmesa.h>
+#elif defined(USE_EGL)
+#include <EGL/egl.h>
+#include <EGL/eglext.h>
+#endif
 
 ////////////////////////////////////////////////////////////////////////
 // Global variables
@@ -34,6 +43,7 @@ static char *input_ssa_filename = NULL;
 static char *input_ssb_filename = NULL;
 static char *output_house_filename = NULL;
 static char *output_image_filename = NULL;
+static char *input_list_filename = NULL;
 static R3Vector initial_camera_towards(0, 0, -1);
 static R3Vector initial_camera_up(0,1,0);
 static R3Point initial_camera_origin(0,0,0);
@@ -44,6 +54,8 @@ static int batch = 0;
 
 // BAW
 static bool render_seg_maps = false;
+static bool render_seg_maps_two_pass = false;
+static bool render_offscreen = false;
 static bool didRedraw = false;
 std::mutex redraw_flag_mutex;
 
@@ -116,6 +128,9 @@ PrintUsage(void)
   printf("  -v : print verbose (recommended)\n");
   // BAW
   printf("  -seg_maps : render class and instance segmentations maps (output_image is interpreted as directory to store images\n");
+  printf("  -seg_maps_two_pass : like -seg_maps, but draw and capture classes and instances separately\n");
+  printf("  -offscreen : with -seg_maps, render offscreen at the size of each image\n");
+  printf("  -input_list <filename> : with -seg_maps, render each house listed in <filename>, one line of input options and -output_image per house\n");
   //
   printf("\n");
   printf("Typical usage for viewing house segmentations:\n");
@@ -299,8 +314,28 @@ ReadCategories(const char *filename)
   RNTime start_time;
   start_time.Read();
 
-  // Read categories
-  if (!house->ReadCategoryFile(filename)) return 0;
+  // Read categories once, copy them into later houses
+  static MPHouse *category_table = NULL;
+  static std::string category_table_filename;
+  if (!category_table || (category_table_filename != filename)) {
+    if (category_table) delete category_table;
+    category_table = new MPHouse();
+    category_table_filename = filename;
+    if (!category_table->ReadCategoryFile(filename)) {
+      delete category_table;
+      category_table = NULL;
+      return 0;
+    }
+  }
+  for (int i = 0; i < category_table->categories.NEntries(); i++) {
+    MPCategory *category = category_table->categories.Kth(i);
+    MPCategory *copy = new MPCategory();
+    copy->label_id = category->label_id;
+    copy->label_name = (category->label_name) ? _strdup(category->label_name) : NULL;
+    copy->mpcat40_id = category->mpcat40_id;
+    copy->mpcat40_name = (category->mpcat40_name) ? _strdup(category->mpcat40_name) : NULL;
+    house->InsertCategory(copy);
+  }
 
   // Print statistics
   if (print_verbose) {
@@ -1342,6 +1377,9 @@ ParseArgs(int argc, char **argv)
       }
 	  // BAW
 	  else if (!strcmp(*argv, "-seg_maps")) render_seg_maps = true;
+	  else if (!strcmp(*argv, "-seg_maps_two_pass")) { render_seg_maps = true; render_seg_maps_two_pass = true; }
+	  else if (!strcmp(*argv, "-offscreen")) render_offscreen = true;
+	  else if (!strcmp(*argv, "-input_list")) { argc--; argv++; input_list_filename = *argv; input = TRUE; }
 	  ///
       else {
         fprintf(stderr, "Invalid program argument: %s", *argv);
@@ -1436,64 +1474,611 @@ void processMaps() {
 
 
 ////////////////////////////////////////////////////////////////////////
-// Main function
+// Single pass segmentation maps
 ////////////////////////////////////////////////////////////////////////
 
-int main(int argc, char **argv)
+// BAW
+// -seg_maps draws every image once with the packed index of the object
+// of each segment (as for picking, see Pick), and decodes both the class
+// and the instance map from the indices. The pixels are read back through
+// two pixel buffer objects: the transfer of one image runs while the next
+// one is drawn, and the maps are decoded and written on a worker thread
+// while the next but one is drawn.
+//
+// With -offscreen the images are drawn into a framebuffer object of the
+// size of each image instead of the window. The context comes from OSMesa
+// (make mesa) or EGL (make egl), so no display is needed, or else from a
+// hidden GLUT window. -input_list renders several houses with the same
+// context, see ProcessHouseList.
+
+#ifndef APIENTRY
+#define APIENTRY
+#endif
+#ifndef GL_PIXEL_PACK_BUFFER
+#define GL_PIXEL_PACK_BUFFER 0x88EB
+#endif
+#ifndef GL_STREAM_READ
+#define GL_STREAM_READ 0x88E1
+#endif
+#ifndef GL_READ_ONLY
+#define GL_READ_ONLY 0x88B8
+#endif
+#ifndef GL_FRAMEBUFFER
+#define GL_FRAMEBUFFER 0x8D40
+#endif
+#ifndef GL_RENDERBUFFER
+#define GL_RENDERBUFFER 0x8D41
+#endif
+#ifndef GL_COLOR_ATTACHMENT0
+#define GL_COLOR_ATTACHMENT0 0x8CE0
+#endif
+#ifndef GL_DEPTH_ATTACHMENT
+#define GL_DEPTH_ATTACHMENT 0x8D00
+#endif
+#ifndef GL_DEPTH_COMPONENT24
+#define GL_DEPTH_COMPONENT24 0x81A6
+#endif
+#ifndef GL_FRAMEBUFFER_COMPLETE
+#define GL_FRAMEBUFFER_COMPLETE 0x8CD5
+#endif
+
+typedef void (APIENTRY *MPGLProc)(void);
+typedef void (APIENTRY *MPGenBuffersProc)(GLsizei n, GLuint *buffers);
+typedef void (APIENTRY *MPDeleteBuffersProc)(GLsizei n, const GLuint *buffers);
+typedef void (APIENTRY *MPBindBufferProc)(GLenum target, GLuint buffer);
+typedef void (APIENTRY *MPBufferDataProc)(GLenum target, ptrdiff_t size, const void *data, GLenum usage);
+typedef void *(APIENTRY *MPMapBufferProc)(GLenum target, GLenum access);
+typedef GLboolean (APIENTRY *MPUnmapBufferProc)(GLenum target);
+typedef void (APIENTRY *MPRenderbufferStorageProc)(GLenum target, GLenum format, GLsizei width, GLsizei height);
+typedef void (APIENTRY *MPFramebufferRenderbufferProc)(GLenum target, GLenum attachment, GLenum rbtarget, GLuint buffer);
+typedef GLenum (APIENTRY *MPCheckFramebufferStatusProc)(GLenum target);
+
+static MPGenBuffersProc mpGenBuffers = NULL;
+static MPDeleteBuffersProc mpDeleteBuffers = NULL;
+static MPBindBufferProc mpBindBuffer = NULL;
+static MPBufferDataProc mpBufferData = NULL;
+static MPMapBufferProc mpMapBuffer = NULL;
+static MPUnmapBufferProc mpUnmapBuffer = NULL;
+static MPGenBuffersProc mpGenFramebuffers = NULL;
+static MPGenBuffersProc mpGenRenderbuffers = NULL;
+static MPDeleteBuffersProc mpDeleteFramebuffers = NULL;
+static MPDeleteBuffersProc mpDeleteRenderbuffers = NULL;
+static MPBindBufferProc mpBindFramebuffer = NULL;
+static MPBindBufferProc mpBindRenderbuffer = NULL;
+static MPRenderbufferStorageProc mpRenderbufferStorage = NULL;
+static MPFramebufferRenderbufferProc mpFramebufferRenderbuffer = NULL;
+static MPCheckFramebufferStatusProc mpCheckFramebufferStatus = NULL;
+
+// Render state shared by all houses
+static bool seg_maps_context = false;
+static int seg_maps_use_buffers = 0;
+static GLuint seg_maps_buffers[2] = { 0, 0 };
+static int seg_maps_buffer_sizes[2] = { 0, 0 };
+static GLuint seg_maps_framebuffer = 0;
+static GLuint seg_maps_renderbuffers[2] = { 0, 0 };
+static int seg_maps_framebuffer_width = 0;
+static int seg_maps_framebuffer_height = 0;
+
+
+
+static MPGLProc
+GetGLFunction(const char *name)
 {
-  // Parse program arguments
-  if (!ParseArgs(argc, argv)) exit(-1);
+  // Try core name, then ARB and EXT versions
+  const char *suffixes[3] = { "", "ARB", "EXT" };
+  for (int i = 0; i < 3; i++) {
+    std::string full_name = std::string(name) + suffixes[i];
+    MPGLProc function = NULL;
+#if defined(USE_MESA)
+    function = (MPGLProc) OSMesaGetProcAddress(full_name.c_str());
+#elif defined(USE_EGL)
+    function = (MPGLProc) eglGetProcAddress(full_name.c_str());
+#else
+    function = (MPGLProc) glutGetProcAddress(full_name.c_str());
+#endif
+    if (function) return function;
+  }
+  return NULL;
+}
 
-  // Allocate house
-  house = new MPHouse();
-  if (!house) {
-    fprintf(stderr, "Unable to allocate house\n");
-    exit(-1);
+
+
+static int
+LoadPixelBufferFunctions(void)
+{
+  // Pixel buffer objects are core in OpenGL 2.1
+  int major = 0, minor = 0;
+  const char *version = (const char *) glGetString(GL_VERSION);
+  if (!version || (sscanf(version, "%d.%d", &major, &minor) != 2)) return 0;
+  if ((major < 2) || ((major == 2) && (minor < 1))) return 0;
+
+  // Get entry points
+  mpGenBuffers = (MPGenBuffersProc) GetGLFunction("glGenBuffers");
+  mpDeleteBuffers = (MPDeleteBuffersProc) GetGLFunction("glDeleteBuffers");
+  mpBindBuffer = (MPBindBufferProc) GetGLFunction("glBindBuffer");
+  mpBufferData = (MPBufferDataProc) GetGLFunction("glBufferData");
+  mpMapBuffer = (MPMapBufferProc) GetGLFunction("glMapBuffer");
+  mpUnmapBuffer = (MPUnmapBufferProc) GetGLFunction("glUnmapBuffer");
+  return mpGenBuffers && mpDeleteBuffers && mpBindBuffer && mpBufferData && mpMapBuffer && mpUnmapBuffer;
+}
+
+
+
+static int
+LoadFramebufferFunctions(void)
+{
+  // Get entry points (OpenGL 3.0 or EXT_framebuffer_object)
+  mpGenFramebuffers = (MPGenBuffersProc) GetGLFunction("glGenFramebuffers");
+  mpGenRenderbuffers = (MPGenBuffersProc) GetGLFunction("glGenRenderbuffers");
+  mpDeleteFramebuffers = (MPDeleteBuffersProc) GetGLFunction("glDeleteFramebuffers");
+  mpDeleteRenderbuffers = (MPDeleteBuffersProc) GetGLFunction("glDeleteRenderbuffers");
+  mpBindFramebuffer = (MPBindBufferProc) GetGLFunction("glBindFramebuffer");
+  mpBindRenderbuffer = (MPBindBufferProc) GetGLFunction("glBindRenderbuffer");
+  mpRenderbufferStorage = (MPRenderbufferStorageProc) GetGLFunction("glRenderbufferStorage");
+  mpFramebufferRenderbuffer = (MPFramebufferRenderbufferProc) GetGLFunction("glFramebufferRenderbuffer");
+  mpCheckFramebufferStatus = (MPCheckFramebufferStatusProc) GetGLFunction("glCheckFramebufferStatus");
+  return mpGenFramebuffers && mpGenRenderbuffers && mpDeleteFramebuffers && mpDeleteRenderbuffers &&
+    mpBindFramebuffer && mpBindRenderbuffer && mpRenderbufferStorage && mpFramebufferRenderbuffer &&
+    mpCheckFramebufferStatus;
+}
+
+
+
+static int
+CreateOffscreenContext(int *argc, char **argv)
+{
+#if defined(USE_MESA)
+  // OSMesa context, drawing into a framebuffer object, not into this buffer
+  static GLubyte buffer[4 * 16 * 16];
+  OSMesaContext context = OSMesaCreateContextExt(OSMESA_RGBA, 24, 0, 0, NULL);
+  if (!context) {
+    fprintf(stderr, "Unable to create OSMesa context\n");
+    return 0;
   }
-  
-  // Read house
-  if (input_house_filename) {
-    if (!ReadHouse(input_house_filename)) exit(-1);
+  if (!OSMesaMakeCurrent(context, buffer, GL_UNSIGNED_BYTE, 16, 16)) {
+    fprintf(stderr, "Unable to make OSMesa context current\n");
+    return 0;
+  }
+#elif defined(USE_EGL)
+  // EGL context without surface, on the surfaceless platform of Mesa if available
+  EGLDisplay display = EGL_NO_DISPLAY;
+#ifdef EGL_PLATFORM_SURFACELESS_MESA
+  PFNEGLGETPLATFORMDISPLAYEXTPROC get_platform_display =
+    (PFNEGLGETPLATFORMDISPLAYEXTPROC) eglGetProcAddress("eglGetPlatformDisplayEXT");
+  if (get_platform_display) display = get_platform_display(EGL_PLATFORM_SURFACELESS_MESA, EGL_DEFAULT_DISPLAY, NULL);
+#endif
+  if (display == EGL_NO_DISPLAY) display = eglGetDisplay(EGL_DEFAULT_DISPLAY);
+  EGLint major, minor;
+  if ((display == EGL_NO_DISPLAY) || !eglInitialize(display, &major, &minor)) {
+    fprintf(stderr, "Unable to initialize EGL display\n");
+    return 0;
+  }
+  if (!eglBindAPI(EGL_OPENGL_API)) {
+    fprintf(stderr, "Unable to bind OpenGL API of EGL\n");
+    return 0;
+  }
+  EGLint attributes[] = { EGL_RENDERABLE_TYPE, EGL_OPENGL_BIT, EGL_NONE };
+  EGLConfig config = NULL;
+  EGLint nconfigs = 0;
+  if (!eglChooseConfig(display, attributes, &config, 1, &nconfigs)) nconfigs = 0;
+  EGLContext context = eglCreateContext(display, (nconfigs > 0) ? config : (EGLConfig) NULL, EGL_NO_CONTEXT, NULL);
+  if (context == EGL_NO_CONTEXT) {
+    fprintf(stderr, "Unable to create EGL context\n");
+    return 0;
   }
+  if (!eglMakeCurrent(display, EGL_NO_SURFACE, EGL_NO_SURFACE, context)) {
+    fprintf(stderr, "Unable to make EGL context current\n");
+    return 0;
+  }
+#else
+  // Context of a hidden window
+  GLUTInit(argc, argv);
+  glutHideWindow();
+  glutMainLoopEvent();
+#endif
+
+  // Initialize depth testing
+  glEnable(GL_DEPTH_TEST);
 
-  // Read scene
-  if (input_scene_filename) {
-    if (!ReadScene(input_scene_filename)) exit(-1);
+  // Print info
+  if (print_verbose) {
+    printf("Offscreen rendering with %s, OpenGL %s\n", glGetString(GL_RENDERER), glGetString(GL_VERSION));
+    fflush(stdout);
   }
 
-  // Read mesh
-  if (input_mesh_filename) {
-    if (!ReadMesh(input_mesh_filename)) exit(-1);
+  // Create framebuffer object
+  if (!LoadFramebufferFunctions()) {
+    fprintf(stderr, "No framebuffer objects for offscreen rendering\n");
+    return 0;
   }
+  mpGenFramebuffers(1, &seg_maps_framebuffer);
+  mpGenRenderbuffers(2, seg_maps_renderbuffers);
 
-  // Read categories
-  if (input_categories_filename) {
-    if (!ReadCategories(input_categories_filename)) exit(-1);
+  // Return success
+  return 1;
+}
+
+
+
+static int
+BindOffscreenFramebuffer(int width, int height)
+{
+  // Bind framebuffer object
+  mpBindFramebuffer(GL_FRAMEBUFFER, seg_maps_framebuffer);
+  if ((width == seg_maps_framebuffer_width) && (height == seg_maps_framebuffer_height)) return 1;
+
+  // Resize color and depth buffers
+  mpBindRenderbuffer(GL_RENDERBUFFER, seg_maps_renderbuffers[0]);
+  mpRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, width, height);
+  mpFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, seg_maps_renderbuffers[0]);
+  mpBindRenderbuffer(GL_RENDERBUFFER, seg_maps_renderbuffers[1]);
+  mpRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, width, height);
+  mpFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, seg_maps_renderbuffers[1]);
+  mpBindRenderbuffer(GL_RENDERBUFFER, 0);
+  if (mpCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE) {
+    fprintf(stderr, "Incomplete framebuffer object of %dx%d pixels\n", width, height);
+    seg_maps_framebuffer_width = seg_maps_framebuffer_height = 0;
+    return 0;
   }
+  seg_maps_framebuffer_width = width;
+  seg_maps_framebuffer_height = height;
+  glReadBuffer(GL_COLOR_ATTACHMENT0);
 
-  // Read segments
-  if (input_segments_filename) {
-    if (!ReadSegments(input_segments_filename)) exit(-1);
+  // Return success
+  return 1;
+}
+
+
+
+static int
+InitializeSegMaps(int *argc, char **argv)
+{
+  // Create context once for all houses
+  if (seg_maps_context) return 1;
+  if (render_offscreen) {
+    if (!CreateOffscreenContext(argc, argv)) return 0;
   }
+  else {
+    GLUTInit(argc, argv);
+
+    // init viewer
+    RNLength r = house->bbox.DiagonalRadius();
+    R3Camera camera(initial_camera_origin, initial_camera_towards, initial_camera_up, 0.54, 0.45, 0.01 * r, 100.0 * r);
+    R2Viewport viewport(0, 0, GLUTwindow_width, GLUTwindow_height);
+    viewer = new R3Viewer(camera, viewport);
+
+    // Wait until the window is shown
+    didRedraw = false;
+    while (!didRedraw) glutMainLoopEvent();
+    glReadBuffer(GL_BACK);
+  }
+  seg_maps_context = true;
 
-  // Read objects
-  if (input_objects_filename) {
-    if (!ReadObjects(input_objects_filename)) exit(-1);
+  // Allocate readback buffers
+  seg_maps_use_buffers = LoadPixelBufferFunctions();
+  if (seg_maps_use_buffers) mpGenBuffers(2, seg_maps_buffers);
+  else printf("no pixel buffer objects, reading back synchronously\n");
+  glPixelStorei(GL_PACK_ALIGNMENT, 1);
+
+  // Return success
+  return 1;
+}
+
+
+
+static void
+TerminateSegMaps(void)
+{
+  // Free readback buffers and framebuffer object
+  if (!seg_maps_context) return;
+  if (seg_maps_use_buffers) mpDeleteBuffers(2, seg_maps_buffers);
+  if (seg_maps_framebuffer) {
+    mpDeleteFramebuffers(1, &seg_maps_framebuffer);
+    mpDeleteRenderbuffers(2, seg_maps_renderbuffers);
   }
+}
+
+
+
+static void
+DrawSegMapIndices(MPImage *image, int width, int height)
+{
+  // Clear window (alpha 0 is no object)
+  glClearColor(background.R(), background.G(), background.B(), 0.0);
+  glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT);
+
+  // Set backface culling
+  if (show_backfacing) glDisable(GL_CULL_FACE);
+  else glEnable(GL_CULL_FACE);
+
+  // Set viewing transformation as in GLUTRedraw
+  glViewport(0, 0, width, height);
+  glMatrixMode(GL_PROJECTION);
+  glLoadIdentity();
+  image->rgbd.ProjectionMatrix().Load();
+  glMatrixMode(GL_MODELVIEW);
+  glLoadIdentity();
+  image->extrinsics.Load();
 
-  // Read configuration
-  if (input_configuration_filename) {
-    if (!ReadConfiguration(input_configuration_filename)) exit(-1);
+  // Clip box does not apply to segmentation maps
+  int saved_show_clip_box = show_clip_box;
+  show_clip_box = 0;
+  LoadClipPlanes();
+
+  // Indices must reach the frame buffer unchanged
+  glDisable(GL_LIGHTING);
+  glDisable(GL_DITHER);
+  glShadeModel(GL_FLAT);
+
+  // Draw faces of objects with their index
+  RNFlags flags = object_draw_flags;
+  flags.Remove(MP_DRAW_BBOXES | MP_DRAW_LABELS);
+  flags.Add(MP_DRAW_FACES | MP_COLOR_BY_OBJECT | MP_COLOR_FOR_PICK);
+  house->DrawObjects(flags);
+
+  // Reset OpenGL stuff
+  glShadeModel(GL_SMOOTH);
+  glEnable(GL_DITHER);
+  show_clip_box = saved_show_clip_box;
+}
+
+
+
+static void
+WriteSegMaps(const unsigned char *rgba, int width, int height,
+  const std::vector<unsigned char> *class_colors, const std::vector<unsigned char> *instance_colors,
+  std::string classes_filename, std::string instances_filename)
+{
+  // Look up colors of object indices, background elsewhere
+  int nobjects = (int) instance_colors->size() / 3 - 1;
+  R2Image classes(width, height, 3);
+  R2Image instances(width, height, 3);
+  for (int y = 0; y < height; y++) {
+    for (int x = 0; x < width; x++) {
+      const unsigned char *pixel = &rgba[4 * (y * width + x)];
+      int index = ((pixel[0] << 16) | (pixel[1] << 8) | pixel[2]) - 1;
+      if ((pixel[3] != MP_OBJECT_TAG) || (index < 0) || (index >= nobjects)) index = nobjects;
+      classes.SetPixel(x, y, &(*class_colors)[3 * index]);
+      instances.SetPixel(x, y, &(*instance_colors)[3 * index]);
+    }
+  }
+
+  // Write images
+  printf("writing %s \n", classes_filename.c_str());
+  classes.Write(classes_filename.c_str());
+  printf("writing %s \n", instances_filename.c_str());
+  instances.Write(instances_filename.c_str());
+}
+
+
+
+static void
+StoreColor(std::vector<unsigned char>& colors, int i, const RNRgb& rgb)
+{
+  // Convert as OpenGL does for an unsigned byte frame buffer
+  for (int c = 0; c < 3; c++) {
+    RNScalar value = rgb[c];
+    if (value < 0) value = 0;
+    if (value > 1) value = 1;
+    colors[3 * i + c] = (unsigned char) (255.0 * value + 0.5);
+  }
+}
+
+
+
+static void
+ProcessSegMaps(const char *output_directory)
+{
+  // Colors of each object and, last, of the background
+  int nobjects = house->objects.NEntries();
+  std::vector<unsigned char> class_colors(3 * (nobjects + 1));
+  std::vector<unsigned char> instance_colors(3 * (nobjects + 1));
+  for (int i = 0; i < nobjects; i++) {
+    MPObject *object = house->objects.Kth(i);
+    StoreColor(class_colors, i, (object->category) ? MPLabelColor(object->category->mpcat40_id) : background);
+    StoreColor(instance_colors, i, MPLabelColor(object->house_index + 1));
+  }
+  StoreColor(class_colors, nobjects, background);
+  StoreColor(instance_colors, nobjects, background);
+  std::string out_image_base_name = output_directory;
+
+  // Draw image i while image i-1 is transferred and image i-2 is written
+  std::vector<unsigned char> pixels[2];
+  int sizes[2][2] = { { 0, 0 }, { 0, 0 } };
+  std::string filenames[2][2];
+  std::future<void> writer;
+  int nimages = house->images.NEntries();
+  for (int i = 0; i <= nimages; i++) {
+    int slot = i % 2;
+    if (i < nimages) {
+      MPImage *image = house->images.Kth(i);
+      snap_image_index = i;
+
+      // Window size, or size of the image offscreen
+      int width = GLUTwindow_width;
+      int height = GLUTwindow_height;
+      if (render_offscreen) {
+        width = (image->width > 0) ? image->width : image->rgbd.NPixels(RN_X);
+        height = (image->height > 0) ? image->height : image->rgbd.NPixels(RN_Y);
+      }
+      if (render_offscreen && !BindOffscreenFramebuffer(width, height)) {
+        fprintf(stderr, "Unable to render image %s\n", image->name);
+        width = height = 0;
+      }
+      else {
+        DrawSegMapIndices(image, width, height);
+      }
+
+      std::string camId = std::to_string(image->camera_index);
+      std::string yawId = std::to_string(image->yaw_index);
+      filenames[slot][0] = out_image_base_name + "_classes/" + std::string(image->name) + "_c" + camId + "_" + yawId + ".png";
+      filenames[slot][1] = out_image_base_name + "_instances/" + std::string(image->name) + "_i" + camId + "_" + yawId + ".png";
+      sizes[slot][0] = width;
+      sizes[slot][1] = height;
+
+      // The writer of image i-2 still uses pixels[slot]
+      if (writer.valid()) writer.wait();
+      int nbytes = 4 * width * height;
+      pixels[slot].resize(nbytes);
+      if (nbytes == 0) {
+        // Nothing to read
+      }
+      else if (seg_maps_use_buffers) {
+        mpBindBuffer(GL_PIXEL_PACK_BUFFER, seg_maps_buffers[slot]);
+        if (seg_maps_buffer_sizes[slot] < nbytes) {
+          mpBufferData(GL_PIXEL_PACK_BUFFER, nbytes, NULL, GL_STREAM_READ);
+          seg_maps_buffer_sizes[slot] = nbytes;
+        }
+        glReadPixels(0, 0, width, height, GL_RGBA, GL_UNSIGNED_BYTE, 0);
+        mpBindBuffer(GL_PIXEL_PACK_BUFFER, 0);
+      }
+      else {
+        glReadPixels(0, 0, width, height, GL_RGBA, GL_UNSIGNED_BYTE, pixels[slot].data());
+      }
+    }
+    else if (writer.valid()) {
+      writer.wait();
+    }
+
+    // Hand image i-1 to the writer
+    int previous = 1 - slot;
+    if ((i > 0) && (sizes[previous][0] > 0)) {
+      if (seg_maps_use_buffers) {
+        mpBindBuffer(GL_PIXEL_PACK_BUFFER, seg_maps_buffers[previous]);
+        const unsigned char *mapped = (const unsigned char *) mpMapBuffer(GL_PIXEL_PACK_BUFFER, GL_READ_ONLY);
+        if (mapped) memcpy(pixels[previous].data(), mapped, pixels[previous].size());
+        else fprintf(stderr, "Unable to map pixel buffer of image %d\n", i - 1);
+        mpUnmapBuffer(GL_PIXEL_PACK_BUFFER);
+        mpBindBuffer(GL_PIXEL_PACK_BUFFER, 0);
+      }
+      writer = std::async(std::launch::async, WriteSegMaps, pixels[previous].data(), sizes[previous][0],
+        sizes[previous][1], &class_colors, &instance_colors, filenames[previous][0], filenames[previous][1]);
+      sizes[previous][0] = sizes[previous][1] = 0;
+    }
+
+    // Keep the window responsive
+    if (!render_offscreen) glutMainLoopEvent();
   }
+  if (writer.valid()) writer.wait();
+}
+
+
+
+static int
+ReadInputs(void)
+{
+  // Read house, scene, mesh, categories, segments, objects, configuration
+  if (input_house_filename && !ReadHouse(input_house_filename)) return 0;
+  if (input_scene_filename && !ReadScene(input_scene_filename)) return 0;
+  if (input_mesh_filename && !ReadMesh(input_mesh_filename)) return 0;
+  if (input_categories_filename && !ReadCategories(input_categories_filename)) return 0;
+  if (input_segments_filename && !ReadSegments(input_segments_filename)) return 0;
+  if (input_objects_filename && !ReadObjects(input_objects_filename)) return 0;
+  if (input_configuration_filename && !ReadConfiguration(input_configuration_filename)) return 0;
 
   // Write house
-  if (output_house_filename) {
-    if (!WriteHouse(output_house_filename)) exit(-1);
+  if (output_house_filename && !WriteHouse(output_house_filename)) return 0;
+
+  // Return success
+  return 1;
+}
+
+
+
+static int
+ProcessHouseList(const char *filename, int *argc, char **argv)
+{
+  // Open file
+  FILE* fp;
+  #ifndef _WIN32
+    fp = fopen(filename, "r");
+  #else
+    fopen_s(&fp,filename, "r");
+  #endif
+  if (!fp) {
+    fprintf(stderr, "Unable to open house list %s\n", filename);
+    return 0;
+  }
+
+  // Each line holds the input files and -output_image of one house, with
+  // the same options as on the command line, which apply to all houses
+  char *common[] = { input_house_filename, input_scene_filename, input_mesh_filename, input_categories_filename,
+    input_segments_filename, input_objects_filename, input_configuration_filename, output_house_filename,
+    output_image_filename };
+  int nfailed = 0;
+  char buffer[16384];
+  while (fgets(buffer, 16384, fp)) {
+    // Split line
+    std::vector<char *> args(1, argv[0]);
+    char *token = strtok(buffer, " \t\r\n");
+    while (token) { args.push_back(token); token = strtok(NULL, " \t\r\n"); }
+    if ((args.size() == 1) || (args[1][0] == '#')) continue;
+
+    // Parse options of this house
+    input_house_filename = common[0]; input_scene_filename = common[1]; input_mesh_filename = common[2];
+    input_categories_filename = common[3]; input_segments_filename = common[4]; input_objects_filename = common[5];
+    input_configuration_filename = common[6]; output_house_filename = common[7]; output_image_filename = common[8];
+    if (!ParseArgs((int) args.size(), args.data())) { nfailed++; continue; }
+    char *output_directory = output_image_filename;
+    output_image_filename = NULL;
+    if (!output_directory) {
+      fprintf(stderr, "No -output_image for %s\n", args[1]);
+      nfailed++;
+      continue;
+    }
+
+    // Read house and render its maps
+    house = new MPHouse();
+    if (ReadInputs() && InitializeSegMaps(argc, argv)) ProcessSegMaps(output_directory);
+    else nfailed++;
+    delete house;
+    house = NULL;
+  }
+
+  // Close file
+  fclose(fp);
+
+  // Return success
+  if (nfailed > 0) fprintf(stderr, "%d houses of %s failed\n", nfailed, filename);
+  return (nfailed == 0);
+}
+
+
+
+////////////////////////////////////////////////////////////////////////
+// Main function
+////////////////////////////////////////////////////////////////////////
+
+int main(int argc, char **argv)
+{
+  // Parse program arguments
+  if (!ParseArgs(argc, argv)) exit(-1);
+
+  // BAW
+  if ((render_offscreen || input_list_filename) && (!render_seg_maps || render_seg_maps_two_pass)) {
+    fprintf(stderr, "-offscreen and -input_list require -seg_maps\n");
+    exit(-1);
   }
 
+  // Render segmentation maps of a list of houses
+  if (input_list_filename) {
+    int status = ProcessHouseList(input_list_filename, &argc, argv);
+    TerminateSegMaps();
+    return (status) ? 0 : -1;
+  }
+
+  // Allocate house
+  house = new MPHouse();
+  if (!house) {
+    fprintf(stderr, "Unable to allocate house\n");
+    exit(-1);
+  }
+  
+  // Read inputs and write house
+  if (!ReadInputs()) exit(-1);
  
   // BAW
-  if (render_seg_maps) {
+  if (render_seg_maps_two_pass) {
 	  //batch = 1;
 	  GLUTInit(&argc, argv);
 
@@ -1506,8 +2091,17 @@ int main(int argc, char **argv)
 	  std::thread worker(processMaps);
 
 	  GLUTMainLoop();
-	 
-	  
+  }
+  else if (render_seg_maps) {
+	  char *output_directory = output_image_filename;
+	  output_image_filename = NULL;
+	  if (!output_directory) {
+		  fprintf(stderr, "-seg_maps requires -output_image\n");
+		  exit(-1);
+	  }
+	  if (!InitializeSegMaps(&argc, argv)) exit(-1);
+	  ProcessSegMaps(output_directory);
+	  TerminateSegMaps();
   }
   else {
 
@@ -1524,6 +2118,3 @@ int main(int argc, char **argv)
   // Return success 
   return 0;
 }
-
-
-
@@ -9,6 +9,9 @@
 # ported and extended code from https://github.com/yindaz/PanoBasic
 
 import typing
+import collections
+import functools
+import os
 import numpy as np
 from numpy.linalg import inv
 import math
@@ -18,6 +21,11 @@ from scipy.spatial.transform import Rotation as Rot
 from scipy.ndimage import *
 import cv2
 from PIL import Image
+import logging
+import panokernel
+import profiling
+
+log = logging.getLogger(__name__)
 
 # definitions following PanoBasic
 refview = (1,3)
@@ -29,98 +37,319 @@ xoffset = math.pi / 3.0  # 60 degs
 
 # get hor/vert angles for each view, starting from Matterport matrices (inverse of extrinsic)
 def get_angles(matrixDict) -> np.array:
-    v = np.zeros((18,2))
+    extrinsics = np.array([[matrixDict[row][ori] for ori in range(6)] for row in range(3)])
+    return get_angles_batch(extrinsics[np.newaxis])[0]
+
+# get_angles for N locations at once from their matrices as (N, 3, 6, 4, 4)
+# array, with one batched inversion and Rotation, returns (N, 18, 2)
+def get_angles_batch(extrinsics: np.array) -> np.array:
     rot_ctor = Rot.from_matrix\
         if version.parse(scipy.__version__) >= version.parse('1.4.0')\
         else Rot.from_dcm
-    euler = np.array([ 
-        rot_ctor(inv(np.transpose(matrixDict[0][0]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[0][1]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[0][2]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[0][3]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[0][4]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[0][5]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[1][0]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[1][1]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[1][2]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[1][3]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[1][4]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[1][5]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[2][0]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[2][1]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[2][2]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[2][3]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[2][4]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[2][5]))[0:3,0:3]).as_euler('xyz') 
-    ])
-    step = 6
-    for i in range(3):
-        v[i * step:(i+1) * step, 0] = np.array([
-            euler[refview[0]*step+refview[1],2] - euler[i*step+0,2],
-            euler[refview[0]*step+refview[1],2] - euler[i*step+1,2],
-            euler[refview[0]*step+refview[1],2] - euler[i*step+2,2],
-            euler[refview[0]*step+refview[1],2] - euler[i*step+3,2],
-            euler[refview[0]*step+refview[1],2] - euler[i*step+4,2],
-            euler[refview[0]*step+refview[1],2] - euler[i*step+5,2] 
-        ])
-        v[i * step: (i+1) * step, 1] = np.array([
-            euler[refview[0]*step+refview[1],0] - euler[i*step+0,0],
-            euler[refview[0]*step+refview[1],0] - euler[i*step+1,0],
-            euler[refview[0]*step+refview[1],0] - euler[i*step+2,0],
-            euler[refview[0]*step+refview[1],0] - euler[i*step+3,0],
-            euler[refview[0]*step+refview[1],0] - euler[i*step+4,0],
-            euler[refview[0]*step+refview[1],0] - euler[i*step+5,0] 
-        ])
-    v[:, 0] = v[:, 0] + xoffset
-    v[v > math.pi] -= 2 * math.pi        
-    v[:, 1] = -v[:, 1]
+    n = extrinsics.shape[0]
+    rotations = inv(np.swapaxes(extrinsics.reshape(n * 18, 4, 4), 1, 2))[:,0:3,0:3]
+    euler = rot_ctor(rotations).as_euler('xyz').reshape(n, 18, 3)
+    ref = refview[0] * 6 + refview[1]
+    v = np.empty((n, 18, 2))
+    v[:,:,0] = euler[:,ref:ref+1,2] - euler[:,:,2]
+    v[:,:,1] = euler[:,ref:ref+1,0] - euler[:,:,0]
+    v[:,:,0] = v[:,:,0] + xoffset
+    v[v > math.pi] -= 2 * math.pi
+    v[:,:,1] = -v[:,:,1]
     return v
 
-# set blending false for label maps
+# float32 buffers for stitching a panorama in place, reused across views and
+# locations as long as the panorama size does not change. Views are warped
+# into the scratch buffers over their footprint only, see view_footprint.
+class PanoAccumulator:
+    def __init__(self):
+        self.shape = None
+        self.peak_bytes = 0
+
+    def reset(self, outsize: typing.Tuple[int, int], nchannels: int) -> None:
+        shape = (outsize[1], outsize[0], nchannels)
+        if self.shape != shape:
+            self.shape = shape
+            self.pano = np.zeros(shape, np.float32)
+            self.pano_w = np.zeros(shape[:2], np.float32)
+            npixels = shape[0] * shape[1]
+            self.warp = np.empty(npixels * nchannels, np.float32)
+            self.weight = np.empty(npixels, np.float32)
+            self.mask = np.empty(npixels, bool)
+            self.mask2 = np.empty(npixels, bool)
+        else:
+            self.pano.fill(0)
+            self.pano_w.fill(0)
+        self.peak_bytes = self.nbytes
+
+    @property
+    def nbytes(self) -> int:
+        return _nbytes(self.pano, self.pano_w, self.warp, self.weight, self.mask, self.mask2)
+
+    def add_view(
+        self,
+        im: np.array,
+        table: 'RemapTable',
+        weight: typing.Optional[np.array],
+        blending: bool,
+        depth: bool
+    ) -> None:
+        h, n = table.map1.shape[:2]
+        warp = _carve(self.warp, (h, n, self.shape[2]))
+        w = _carve(self.weight, (h, n))
+        mask = _carve(self.mask, (h, n))
+        with profiling.stage("stitch.remap"):
+            src_bytes = warp_image_cached(im, table, warp)
+        self.peak_bytes = max(self.peak_bytes, self.nbytes + src_bytes)
+        with profiling.stage("stitch.blend"):
+            # valid pixels are inside the source view, zero is invalid for depth
+            if weight is not None:
+                np.copyto(w, weight)
+                np.less(warp[:,:,0], 1 if depth else 0, out=mask)
+                np.copyto(w, 0, where=mask)
+            else:
+                np.greater_equal(warp[:,:,0], 0, out=mask)
+                np.copyto(w, mask)
+            np.less(w, 0.00000001, out=mask)
+            np.copyto(warp, 0, where=mask[:,:,np.newaxis])
+            if blending or depth:
+                if weight is not None:
+                    np.multiply(warp, w[:,:,np.newaxis], out=warp)
+            else:
+                # labels: last view with a non-zero label wins
+                mask2 = _carve(self.mask2, (h, n))
+                np.greater(warp[:,:,0], 0, out=mask)
+                for c in range(1, warp.shape[2]):
+                    np.logical_or(mask, np.greater(warp[:,:,c], 0, out=mask2), out=mask)
+            rows, segments = footprint_segments(table.footprint, self.shape[1])
+            for pano_cols, view_cols in segments:
+                pano = self.pano[rows, pano_cols]
+                if blending or depth:
+                    np.add(pano, warp[:, view_cols], out=pano)
+                else:
+                    np.copyto(pano, warp[:, view_cols], where=mask[:, view_cols, np.newaxis])
+                pano_w = self.pano_w[rows, pano_cols]
+                np.add(pano_w, w[:, view_cols], out=pano_w)
+
+    # normalize by the accumulated weights and write to out (or a new array)
+    def result(self, divide: bool, dtype=np.float32, out: np.array=None) -> np.array:
+        if out is None:
+            out = np.empty(self.shape, dtype)
+        mask = _carve(self.mask, self.shape[:2])
+        np.equal(self.pano_w, 0, out=mask)
+        np.copyto(self.pano, 0, where=mask[:,:,np.newaxis])
+        if divide:
+            np.copyto(self.pano_w, 1, where=mask)
+            np.divide(self.pano, self.pano_w[:,:,np.newaxis], out=out, casting='unsafe')
+        else:
+            np.copyto(out, self.pano, casting='unsafe')
+        return out
+
+def _nbytes(*arrays) -> int:
+    n = 0
+    for a in arrays:
+        n += a.nbytes
+    return n
+
+# contiguous array of the given shape at the start of a flat buffer
+def _carve(buf: np.array, shape: typing.Tuple[int, ...]) -> np.array:
+    return buf[:int(np.prod(shape))].reshape(shape)
+
+# code of panorama pixels without a label, see LabelAccumulator
+_EMPTY_LABEL = np.array([0, 0, 0, 255], np.uint8).view(np.uint32)[0]
+
+# label panorama stitched without floating point: the pixels of a 1 or 3
+# channel uint8 view are converted to RGBA (alpha 255) and read as uint32
+# codes, warping is a gather with the view's source index table (see
+# get_gather_table) and codes with a label overwrite the panorama, so the
+# last view with a label wins as in PanoAccumulator
+class LabelAccumulator:
+    def __init__(self):
+        self.shape = None
+        self.src = None
+        self.peak_bytes = 0
+
+    def reset(self, outsize: typing.Tuple[int, int], nchannels: int) -> None:
+        shape = (outsize[1], outsize[0], nchannels)
+        if self.shape != shape:
+            self.shape = shape
+            npixels = shape[0] * shape[1]
+            self.codes = np.empty(shape[:2], np.uint32)
+            self.warp = np.empty(npixels, np.uint32)
+            self.mask = np.empty(npixels, bool)
+        self.codes.fill(_EMPTY_LABEL)
+        self.peak_bytes = self.nbytes
+
+    @property
+    def nbytes(self) -> int:
+        return _nbytes(self.codes, self.warp, self.mask, self.src if self.src is not None else self.mask[:0])
+
+    # image is the whole view, table and gather belong to its cutout
+    def add_view(self, image: np.array, table: 'RemapTable', gather: np.array) -> None:
+        h, n = gather.shape
+        minY, maxY = table.crop[0:2]
+        # codes of the view with the empty label past its end
+        npixels = image.shape[0] * image.shape[1]
+        if self.src is None or self.src.size != npixels + 1:
+            self.src = np.empty(npixels + 1, np.uint32)
+            self.src[-1] = _EMPTY_LABEL
+        rgba = self.src[:-1].view(np.uint8).reshape(image.shape[0], image.shape[1], 4)
+        warp = _carve(self.warp, (h, n))
+        mask = _carve(self.mask, (h, n))
+        with profiling.stage("stitch.remap"):
+            cv2.cvtColor(image[minY:maxY], cv2.COLOR_GRAY2RGBA if image.shape[2] == 1 else cv2.COLOR_RGB2RGBA,
+                dst=rgba[minY:maxY])
+            np.take(self.src, gather, out=warp, mode='clip')
+        self.peak_bytes = max(self.peak_bytes, self.nbytes)
+        with profiling.stage("stitch.blend"):
+            np.not_equal(warp, _EMPTY_LABEL, out=mask)
+            rows, segments = footprint_segments(table.footprint, self.shape[1])
+            for pano_cols, view_cols in segments:
+                np.copyto(self.codes[rows, pano_cols], warp[:, view_cols], where=mask[:, view_cols])
+
+    def result(self, dtype=np.uint8, out: np.array=None) -> np.array:
+        if out is None:
+            out = np.empty(self.shape, dtype)
+        labels = self.codes.view(np.uint8).reshape(self.shape[0], self.shape[1], 4)[:,:,:self.shape[2]]
+        np.copyto(out, labels, casting='unsafe')
+        return out
+
+_accumulator = PanoAccumulator()
+_label_accumulator = LabelAccumulator()
+
+# "numba" stitches color and depth with the compiled kernel of panokernel
+# when Numba is installed, label maps always use the NumPy path
+stitch_backend = "numpy"
+
+def _combine_views_kernel(
+    images: typing.List[np.array],
+    v: np.array,
+    outsize: typing.Tuple[int, int],
+    depth: bool,
+    feather: bool,
+    dtype,
+    acc: PanoAccumulator
+) -> np.array:
+    acc.reset(outsize, images[0].shape[2])
+    views = []
+    angles = []
+    footprints = []
+    for i in range(len(images)):
+        if images[i].size < 3:
+            continue
+        im = images[i][imcutout[0][0]:imcutout[0][1],imcutout[1][0]:imcutout[1][1]]
+        views.append(im)
+        # angles quantized as for the remap tables
+        key = _view_key(im.shape[0], im.shape[1], default_fov, outsize[0], outsize[1], v[i,0], v[i,1])
+        step = angle_quantization * default_fov / im.shape[1]
+        angles.append((key[5] * step, key[6] * step))
+        footprints.append(view_footprint(im.shape[0], im.shape[1], default_fov, outsize[0], outsize[1], *angles[-1]))
+    mode = panokernel.DEPTH if depth else (panokernel.FEATHER if feather else panokernel.AVERAGE)
+    with profiling.stage("stitch.kernel"):
+        params = panokernel.view_params(views[0].shape[0], views[0].shape[1], default_fov, angles)
+        panokernel.accumulate(views, params, np.array(footprints, np.int64), acc.pano, acc.pano_w, mode)
+    with profiling.stage("stitch.blend"):
+        return acc.result(True, dtype)
+
+# set blending false for label maps, feather weights blended views by
+# their distance to the view center instead of averaging them. Label maps of
+# 1 or 3 uint8 channels are stitched with a LabelAccumulator.
 def combine_views(
     images: typing.List[np.array],
     v: np.array,
     outsize: typing.Tuple[int, int],
     blending: bool=True,
-    depth: bool=False
+    depth: bool=False,
+    feather: bool=False,
+    dtype=np.float32,
+    accumulator: typing.Union[PanoAccumulator, LabelAccumulator]=None
 ):
-    nchannels = images[0].shape[2]
-    pano = np.zeros((outsize[1],outsize[0],nchannels))
-    pano_w = np.zeros((outsize[1],outsize[0],nchannels))
+    if stitch_backend == "numba" and (blending or depth) and panokernel.available():
+        return _combine_views_kernel(images, v, outsize, depth, blending and feather, dtype,
+            _accumulator if accumulator is None else accumulator)
+    acc = accumulator
+    if acc is None:
+        packed = not blending and not depth and images[0].dtype == np.uint8 and images[0].shape[2] in (1, 3)
+        acc = _label_accumulator if packed else _accumulator
+    acc.reset(outsize, images[0].shape[2])
     for i in range(len(images)):
         if images[i].size < 3:
             continue
-        sphere_img, validMap = im2sphere(
-            images[i][imcutout[0][0]:imcutout[0][1],imcutout[1][0]:imcutout[1][1]],
-            default_fov, 
-            outsize[0], 
-            outsize[1], 
-            v[i,0], 
-            v[i,1], 
-            blending,
-            i,
-            depth
-        )         
-        sphere_img[validMap<0.00000001] = 0
-        if blending:
-            pano = pano + sphere_img
+        im = images[i][imcutout[0][0]:imcutout[0][1],imcutout[1][0]:imcutout[1][1]]
+        if isinstance(acc, LabelAccumulator):
+            with profiling.stage("stitch.remap_table"):
+                table, gather = get_gather_table(im.shape[0], im.shape[1], default_fov, outsize[0], outsize[1],
+                    v[i,0], v[i,1], images[i].shape[0:2])
+            acc.add_view(np.ascontiguousarray(images[i]), table, gather)
+            continue
+        with profiling.stage("stitch.remap_table"):
+            table = get_remap_table(im.shape[0], im.shape[1], default_fov, outsize[0], outsize[1], v[i,0], v[i,1], blending)
+            weight = None
+            if depth or (blending and feather):
+                weight = get_warped_weight(im.shape[0], im.shape[1], default_fov, outsize[0], outsize[1], v[i,0], v[i,1])
+        acc.add_view(im, table, weight, blending, depth)
+    with profiling.stage("stitch.blend"):
+        if isinstance(acc, LabelAccumulator):
+            pano = acc.result(dtype)
         else:
-            if depth:
-                sphere_img[:,:,0] = sphere_img[:,:,0] * validMap
-                pano = pano + sphere_img 
-
-            else:
-                pano[np.any(sphere_img>0,axis=2)] = sphere_img[np.any(sphere_img>0,axis=2)] 
-        pano_w[:,:,0] = pano_w[:,:,0] + validMap
-        if nchannels>1:
-            pano_w[:,:,1] = pano_w[:,:,1] + validMap
-            pano_w[:,:,2] = pano_w[:,:,2] + validMap
-    pano[pano_w==0] = 0
-    pano_w[pano_w==0] = 1
-    if blending or depth:
-        pano = np.divide(pano, pano_w)
+            pano = acc.result(blending or depth, dtype)
+    log.debug("combine_views %dx%d: peak %.1f MB", outsize[0], outsize[1], acc.peak_bytes / 2**20)
     return pano
 
+# downsample a combined panorama to outsize: area averaging for color, the
+# average of the valid (non zero) samples for depth and, with blending false,
+# the most frequent label of each block for label maps (ties go to the
+# smaller label), so that no label is created that is not in the input.
+# Label maps with a non integer size ratio take the nearest sample.
+def downsample_pano(
+    pano: np.array,
+    outsize: typing.Tuple[int, int],
+    blending: bool=True,
+    depth: bool=False
+) -> np.array:
+    H, W = pano.shape[:2]
+    w, h = outsize
+    if w == W and h == H:
+        return pano
+    shape = (h, w) + pano.shape[2:]
+    if depth:
+        valid = (pano > 0).astype(np.float32)
+        total = cv2.resize(pano.astype(np.float32), (w, h), interpolation=cv2.INTER_AREA)
+        count = cv2.resize(valid, (w, h), interpolation=cv2.INTER_AREA)
+        out = np.zeros_like(total)
+        np.divide(total, count, out=out, where=count > 1e-6)
+        return np.rint(out).astype(pano.dtype).reshape(shape)
+    if blending:
+        return cv2.resize(pano, (w, h), interpolation=cv2.INTER_AREA).reshape(shape)
+    ky, kx = H // h, W // w
+    if ky * h != H or kx * w != W:
+        rows = ((np.arange(h) + 0.5) * H / h).astype(np.int64)
+        cols = ((np.arange(w) + 0.5) * W / w).astype(np.int64)
+        return pano[rows][:, cols]
+    # pack the channels of a label into one code
+    if pano.ndim == 2 or pano.shape[2] == 1:
+        codes = pano.reshape(H, W)
+    else:
+        assert pano.dtype == np.uint8 and pano.shape[2] <= 4
+        codes = np.zeros((H, W), np.uint32)
+        for c in range(pano.shape[2]):
+            codes |= pano[:,:,c].astype(np.uint32) << (8 * c)
+    n = ky * kx
+    blocks = np.sort(codes.reshape(h, ky, w, kx).transpose(0, 2, 1, 3).reshape(h, w, n), axis=2)
+    # length of the run of equal labels up to each sorted sample, the
+    # longest run ends at the mode
+    index = np.arange(n)
+    starts = np.zeros(blocks.shape, np.int64)
+    starts[:,:,1:] = np.where(blocks[:,:,1:] != blocks[:,:,:-1], index[1:], 0)
+    runs = index - np.maximum.accumulate(starts, axis=2)
+    mode = np.take_along_axis(blocks, np.argmax(runs, axis=2)[:,:,np.newaxis], axis=2)[:,:,0]
+    if pano.ndim == 2 or pano.shape[2] == 1:
+        return mode.reshape(shape)
+    out = np.empty(shape, pano.dtype)
+    for c in range(pano.shape[2]):
+        out[:,:,c] = (mode >> (8 * c)) & 0xff
+    return out
+
 def im2sphere(
     im: np.array,
     imHoriFOV: float,
@@ -130,17 +359,52 @@ def im2sphere(
     y: float,
     interpolate: bool,
     nr: int,
-    weightByCenterDist: bool = False
+    weightByCenterDist: bool = False,
+    zeroInvalid: bool = True
+):
+    # projection and crop of the view are looked up in the remap table cache
+    table = get_remap_table(im.shape[0], im.shape[1], imHoriFOV, sphereW, sphereH, x, y, interpolate)
+    # warp image over the view's footprint, the rest of the panorama is border
+    sphere_img = expand_footprint(warp_image_cached(im, table), table.footprint, sphereW, sphereH, -1)
+    validMap = np.zeros((sphere_img.shape[0], sphere_img.shape[1]))
+    validMap[:,:] = np.logical_not(np.isnan(sphere_img[:,:,0])).astype(float)
+
+    if weightByCenterDist:
+        validMap = expand_footprint(get_warped_weight(
+            im.shape[0], im.shape[1], imHoriFOV, sphereW, sphereH, x, y), table.footprint, sphereW, sphereH, 0).astype(float)
+        # zero is the invalid value of depth maps
+        validMap[sphere_img[:,:,0] < (1 if zeroInvalid else 0)] = 0
+
+    else:
+        validMap[sphere_img[:,:,0]<0] = 0
+    # pixels with division<0 (behind the view) are mapped outside the image
+    # by the remap table, so they are already invalid here
+    return sphere_img, validMap
+
+# map each panorama pixel (or only the given rows and columns) to (1-based)
+# coordinates in the source view
+def sphere_coords(
+    imH: int,
+    imW: int,
+    imHoriFOV: float,
+    sphereW: int,
+    sphereH: int,
+    x: float,
+    y: float,
+    rows: np.array = None,
+    cols: np.array = None
 ):
+    if rows is None:
+        rows = np.arange(sphereH)
+    if cols is None:
+        cols = np.arange(sphereW)
     # map pixel in panorama to viewing direction
-    TX, TY = np.meshgrid(np.array(range(sphereW)), np.array(range(sphereH)))
+    TX, TY = np.meshgrid(cols, rows)
     TX = TX.flatten('F')
     TY = TY.flatten('F')
     ANGx = ((TX - (sphereW / 2) - 0.5) / sphereW) * math.pi * 2.0
     ANGy = (-(TY - (sphereH / 2) - 0.5) / sphereH) * math.pi
     # compute the radius of ball
-    imH = im.shape[0]
-    imW = im.shape[1]
     R = (imW/2) / math.tan(imHoriFOV/2)
     # im is the tangent plane, contacting with ball at [x0 y0 z0]
     x0 = R * math.cos(y) * math.sin(x)
@@ -166,34 +430,303 @@ def im2sphere(
     vecposY = np.cross(np.array([x0, y0, z0]), vecposX)
     deltaY = np.dot(vecposY,np.transpose(vec)) / np.sqrt(np.dot(vecposY,np.transpose(vecposY)))
     # convert to im coordinates
-    Px = np.reshape(deltaX, (sphereH, sphereW),'F') + (imW+1)/2
-    Py = np.reshape(deltaY, (sphereH, sphereW),'F') + (imH+1)/2
-    # warp image
-    sphere_img = warp_image_fast(im, Px, Py, interpolate, (sphereW, sphereH), nr)
-    validMap = np.zeros((sphere_img.shape[0], sphere_img.shape[1]))
-    validMap[:,:] = np.logical_not(np.isnan(sphere_img[:,:,0])).astype(float)
-
-    if weightByCenterDist:
-        weightIm = np.zeros((im.shape[0],im.shape[1],1))
-        c0 = im.shape[0] / 2
-        c1 = im.shape[1] / 2
-        for i in range(im.shape[0]):
-            for j in range(im.shape[1]):
-                weightIm[i,j,0] = (1 - abs(c0 - i)/c0) * (1 - abs(c1 - j)/c1)
-                
-        weightImWarped = warp_image_fast(weightIm, Px, Py,False,(sphereW,sphereH),nr)
-
-        validMap = weightImWarped[:,:,0]
-        validMap[sphere_img[:,:,0]<1] = 0
-
-    else:
-        validMap[sphere_img[:,:,0]<0] = 0
+    Px = np.reshape(deltaX, (len(rows), len(cols)),'F') + (imW+1)/2
+    Py = np.reshape(deltaY, (len(rows), len(cols)),'F') + (imH+1)/2
     # view direction: [alpha belta gamma]
     # contacting point direction: [x0 y0 z0]
     # so division>0 are valid region
-    validMap[np.reshape(division, (sphereH, sphereW), 'F') < 0] = 0
-    return sphere_img, validMap
-   
+    valid = np.reshape(division, (len(rows), len(cols)), 'F') >= 0
+    return Px, Py, valid
+
+# rows and (wrapping) columns of the panorama a view can see, as
+# (first row, end row, first column, number of columns), found by projecting
+# the image border (with a small margin) onto the sphere
+def view_footprint(
+    imH: int,
+    imW: int,
+    imHoriFOV: float,
+    sphereW: int,
+    sphereH: int,
+    x: float,
+    y: float,
+    margin: int = 2
+) -> typing.Tuple[int, int, int, int]:
+    R = (imW/2) / math.tan(imHoriFOV/2)
+    p0 = np.array([R * math.cos(y) * math.sin(x), R * math.cos(y) * math.cos(x), R * math.sin(y)])
+    ex = np.array([math.cos(x), -math.sin(x), 0])
+    ey = np.cross(p0, ex) / R
+    # closed loop around the image border in source pixel coordinates
+    n = 256
+    u = np.linspace(-margin, imW + 1 + margin, n)
+    w = np.linspace(-margin, imH + 1 + margin, n)
+    Px = np.concatenate([u, np.full(n, u[-1]), u[::-1], np.full(n, u[0])])
+    Py = np.concatenate([np.full(n, w[0]), w, np.full(n, w[-1]), w[::-1]])
+    P = p0 + np.outer(Px - (imW+1)/2, ex) + np.outer(Py - (imH+1)/2, ey)
+    ANGx = np.arctan2(P[:,0], P[:,1])
+    ANGy = np.arctan2(P[:,2], np.hypot(P[:,0], P[:,1]))
+    # longitude relative to the view center, unwrapped along the loop
+    relx = np.unwrap(np.mod(ANGx - x + math.pi, 2 * math.pi) - math.pi)
+    TY = -ANGy * sphereH / math.pi + sphereH / 2 + 0.5
+    r0 = max(0, math.floor(TY.min()) - margin)
+    r1 = min(sphereH, math.ceil(TY.max()) + margin + 1)
+    if abs(relx[-1] - relx[0]) > math.pi:
+        # the loop winds around a pole, which is inside the view
+        if y > 0:
+            r0 = 0
+        else:
+            r1 = sphereH
+        return (r0, r1, 0, sphereW)
+    TX = (x + relx) * sphereW / (2.0 * math.pi) + sphereW / 2 + 0.5
+    c0 = math.floor(TX.min()) - margin
+    ncols = math.ceil(TX.max()) + margin + 1 - c0
+    if ncols >= sphereW:
+        return (r0, r1, 0, sphereW)
+    return (r0, r1, c0 % sphereW, ncols)
+
+# row slice and (panorama columns, footprint columns) slice pairs of a
+# footprint, split in two where it wraps around at +-180 degrees
+def footprint_segments(footprint: typing.Tuple[int, int, int, int], sphereW: int):
+    r0, r1, c0, ncols = footprint
+    first = min(ncols, sphereW - c0)
+    segments = [(slice(c0, c0 + first), slice(0, first))]
+    if first < ncols:
+        segments.append((slice(0, ncols - first), slice(first, ncols)))
+    return slice(r0, r1), segments
+
+# place an array computed over a footprint into a full panorama
+def expand_footprint(
+    im: np.array,
+    footprint: typing.Tuple[int, int, int, int],
+    sphereW: int,
+    sphereH: int,
+    fill: float
+) -> np.array:
+    full = np.full((sphereH, sphereW) + im.shape[2:], fill, im.dtype)
+    rows, segments = footprint_segments(footprint, sphereW)
+    for pano_cols, view_cols in segments:
+        full[rows, pano_cols] = im[:, view_cols]
+    return full
+
+# precomputed remap for one view: source crop and fixed-point maps (CV_16SC2)
+RemapTable = typing.NamedTuple('RemapTable', [
+    ('crop', typing.Tuple[int, int, int, int]),  # minY, maxY, minX, maxX
+    ('footprint', typing.Tuple[int, int, int, int]),  # see view_footprint
+    ('map1', np.ndarray),
+    ('map2', typing.Optional[np.ndarray]),
+    ('interpolate', bool)
+])
+
+# remap tables are kept in memory up to remap_cache_bytes, so that all types
+# of a location share them, and on disk if remap_cache_dir is set, so that
+# re-runs of a scan share them too. Locations have their own view angles,
+# so tables are not reused across locations.
+remap_cache_dir = None
+remap_cache_bytes = 2 << 30
+# view angles are quantized to this fraction of a source pixel for lookup,
+# well below the 1/32 pixel of the fixed-point maps, so that the tables
+# sample the views as the exact angles would
+angle_quantization = 1 / 1024
+_remap_cache = collections.OrderedDict()
+_remap_cache_nbytes = 0
+
+def _cache_nbytes(entry) -> int:
+    if isinstance(entry, RemapTable):
+        return entry.map1.nbytes + (0 if entry.map2 is None else entry.map2.nbytes)
+    return entry.nbytes
+
+def _cache_store(key, entry):
+    global _remap_cache_nbytes
+    _remap_cache[key] = entry
+    _remap_cache_nbytes += _cache_nbytes(entry)
+    while _remap_cache_nbytes > remap_cache_bytes and len(_remap_cache) > 1:
+        _, old = _remap_cache.popitem(last=False)
+        _remap_cache_nbytes -= _cache_nbytes(old)
+    return entry
+
+# version of the tables on disk, part of their file names. Bump it when
+# make_remap_tables, sphere_coords, view_footprint or the .npz layout change,
+# so that tables of other versions are never loaded.
+REMAP_TABLE_VERSION = 2
+
+def clear_remap_cache() -> None:
+    global _remap_cache_nbytes
+    _remap_cache.clear()
+    _remap_cache_nbytes = 0
+
+# cache key of a view geometry, with angles quantized in source pixels
+def _view_key(
+    imH: int,
+    imW: int,
+    imHoriFOV: float,
+    sphereW: int,
+    sphereH: int,
+    x: float,
+    y: float
+):
+    step = angle_quantization * imHoriFOV / imW
+    return (imH, imW, round(imHoriFOV, 6), sphereW, sphereH, int(round(x / step)), int(round(y / step)))
+
+def get_remap_table(
+    imH: int,
+    imW: int,
+    imHoriFOV: float,
+    sphereW: int,
+    sphereH: int,
+    x: float,
+    y: float,
+    interpolate: bool
+) -> RemapTable:
+    step = angle_quantization * imHoriFOV / imW
+    viewkey = _view_key(imH, imW, imHoriFOV, sphereW, sphereH, x, y)
+    qx, qy = viewkey[5:7]
+    key = viewkey + (interpolate,)
+    if key in _remap_cache:
+        _remap_cache.move_to_end(key)
+        return _remap_cache[key]
+
+    filename = None
+    if remap_cache_dir is not None:
+        # qx, qy count steps of angle_quantization, which is part of the name
+        filename = os.path.join(remap_cache_dir, "remap_v{}_{}x{}_{:.6f}_{}x{}_{!r}_{}_{}_{}.npz".format(
+            REMAP_TABLE_VERSION, imH, imW, imHoriFOV, sphereW, sphereH, angle_quantization, qx, qy,
+            "lin" if interpolate else "nn"))
+    table = None
+    if filename is not None and os.path.exists(filename):
+        with np.load(filename) as data:
+            table = RemapTable(tuple(int(c) for c in data["crop"]), tuple(int(c) for c in data["footprint"]),
+                data["map1"], data["map2"] if interpolate else None, interpolate)
+    if table is not None:
+        return _cache_store(key, table)
+
+    # the projection is shared by the bilinear and nearest neighbour tables,
+    # so both are built (and cached) together
+    tables = make_remap_tables(imH, imW, imHoriFOV, sphereW, sphereH, qx * step, qy * step)
+    # a small cache may already have evicted the requested table again
+    for other in tables:
+        if filename is not None:
+            os.makedirs(remap_cache_dir, exist_ok=True)
+            otherfile = filename[:filename.rindex("_")] + ("_lin.npz" if other.interpolate else "_nn.npz")
+            # write to a temporary name first, so concurrent runs never read partial files
+            tmpname = otherfile + ".{}.tmp.npz".format(os.getpid())
+            np.savez(tmpname, crop=np.array(other.crop), footprint=np.array(other.footprint), map1=other.map1,
+                map2=other.map2 if other.interpolate else np.zeros(0, np.uint16))
+            os.replace(tmpname, otherfile)
+        _cache_store(viewkey + (other.interpolate,), other)
+        if other.interpolate == interpolate:
+            table = other
+    return table
+
+# bilinear weight falling off from the image center to zero at the borders
+@functools.lru_cache(maxsize=4)
+def center_weight_map(imH: int, imW: int) -> np.array:
+    c0 = imH / 2
+    c1 = imW / 2
+    w0 = 1 - np.abs(c0 - np.arange(imH))/c0
+    w1 = 1 - np.abs(c1 - np.arange(imW))/c1
+    weightIm = np.outer(w0, w1).astype(np.float32)[:,:,np.newaxis]
+    weightIm.flags.writeable = False
+    return weightIm
+
+# center weights warped to the panorama, cached next to the view's remap tables
+def get_warped_weight(
+    imH: int,
+    imW: int,
+    imHoriFOV: float,
+    sphereW: int,
+    sphereH: int,
+    x: float,
+    y: float
+) -> np.array:
+    key = _view_key(imH, imW, imHoriFOV, sphereW, sphereH, x, y) + ("weight",)
+    if key in _remap_cache:
+        _remap_cache.move_to_end(key)
+        return _remap_cache[key]
+    table = get_remap_table(imH, imW, imHoriFOV, sphereW, sphereH, x, y, False)
+    weight = warp_image_cached(center_weight_map(imH, imW), table)[:,:,0]
+    # border pixels come back as -1
+    np.maximum(weight, 0, out=weight)
+    weight.flags.writeable = False
+    return _cache_store(key, weight)
+
+# nearest neighbour table of a view as flat pixel indices into the whole
+# view of srcShape (the view is cut out at its top left corner), pixels
+# outside the view index the empty label past its end, see LabelAccumulator
+def get_gather_table(
+    imH: int,
+    imW: int,
+    imHoriFOV: float,
+    sphereW: int,
+    sphereH: int,
+    x: float,
+    y: float,
+    srcShape: typing.Tuple[int, int]
+) -> typing.Tuple[RemapTable, np.array]:
+    table = get_remap_table(imH, imW, imHoriFOV, sphereW, sphereH, x, y, False)
+    key = _view_key(imH, imW, imHoriFOV, sphereW, sphereH, x, y) + ("gather", tuple(srcShape))
+    if key in _remap_cache:
+        _remap_cache.move_to_end(key)
+        return table, _remap_cache[key]
+    minY, maxY, minX, maxX = table.crop
+    mapx = table.map1[:,:,0].astype(np.int32)
+    mapy = table.map1[:,:,1].astype(np.int32)
+    outside = (mapx < 0) | (mapx >= maxX - minX) | (mapy < 0) | (mapy >= maxY - minY)
+    gather = (mapy + minY) * srcShape[1] + (mapx + minX)
+    gather[outside] = srcShape[0] * srcShape[1]
+    gather.flags.writeable = False
+    return table, _cache_store(key, gather)
+
+# bilinear and nearest neighbour remap tables of a view
+def make_remap_tables(
+    imH: int,
+    imW: int,
+    imHoriFOV: float,
+    sphereW: int,
+    sphereH: int,
+    x: float,
+    y: float
+) -> typing.Tuple[RemapTable, RemapTable]:
+    footprint = view_footprint(imH, imW, imHoriFOV, sphereW, sphereH, x, y)
+    r0, r1, c0, ncols = footprint
+    cols = np.mod(np.arange(c0, c0 + ncols), sphereW)
+    Px, Py, valid = sphere_coords(imH, imW, imHoriFOV, sphereW, sphereH, x, y, np.arange(r0, r1), cols)
+    # rays exactly parallel to the image plane have no intersection
+    finite = np.logical_and(np.isfinite(Px), np.isfinite(Py))
+    valid = np.logical_and(valid, finite)
+    # same crop as warp_image_fast
+    minX = max(1,math.floor(Px[finite].min()) - 1)
+    minY = max(1,math.floor(Py[finite].min()) - 1)
+    maxX = min(imW, math.ceil(Px[finite].max()) + 1)
+    maxY = min(imH, math.ceil(Py[finite].max()) + 1)
+    mapx = (Px - minX + 1).astype(np.float32)
+    mapy = (Py - minY + 1).astype(np.float32)
+    # points behind the view are sent to the border
+    mapx[np.logical_not(valid)] = -16
+    mapy[np.logical_not(valid)] = -16
+    crop = (minY, maxY, minX, maxX)
+    map1, map2 = cv2.convertMaps(mapx, mapy, cv2.CV_16SC2, nninterpolation=False)
+    map1nn, _ = cv2.convertMaps(mapx, mapy, cv2.CV_16SC2, nninterpolation=True)
+    return (RemapTable(crop, footprint, map1, map2, True),
+            RemapTable(crop, footprint, map1nn, None, False))
+
+# warp with a remap table, into out if given (then returns the size of the
+# temporary source copy instead of the warped image)
+def warp_image_cached(
+    im: np.array,
+    table: RemapTable,
+    out: np.array=None
+):
+    minY, maxY, minX, maxX = table.crop
+    src = np.ascontiguousarray(im[minY:maxY, minX:maxX, :], dtype=np.float32)
+    intermode = cv2.INTER_LINEAR if table.interpolate else cv2.INTER_NEAREST
+    dst = None if out is None else out.reshape(out.shape[0], out.shape[1], -1)
+    if dst is not None and dst.shape[2] == 1:
+        dst = dst[:,:,0]
+    im_warp = cv2.remap(src, table.map1, table.map2, interpolation=intermode, dst=dst,
+        borderMode=cv2.BORDER_CONSTANT, borderValue=(-1,-1,-1,-1))
+    if out is not None:
+        return src.nbytes
+    return im_warp.reshape(im_warp.shape[0], im_warp.shape[1], im.shape[2])
+
 def warp_image_fast(
     im: np.array,
     XXdense: np.array,
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# point clouds and surface normals from the equirectangular depth panoramas
+# of prepare_matterport. Pixels are turned into rays with the ANGx / ANGy
+# convention of createpano.sphere_coords, in the panorama frame: x to the
+# right of, y towards and z above the panorama center. The panorama frame of
+# a location is related to the world frame of the scan by the rotation that
+# maps the view directions of createpano.get_angles (which include xoffset)
+# to the camera axes of the .conf matrices, see pano_to_world.
+#
+#   python panogeometry.py --pano_path <out_path>/<scan_id> --out_path points --world --normals --color
+
+import argparse
+import functools
+import os
+import sys
+import typing
+import numpy as np
+from PIL import Image
+
+# 0.25 mm per unit, as in the Matterport depth images
+DEPTH_SCALE = 4000.0
+
+# unit ray directions (H, W, 3) of the panorama pixels, float32
+@functools.lru_cache(maxsize=4)
+def ray_table(sphereW: int, sphereH: int) -> np.array:
+    ANGx = ((np.arange(sphereW) - (sphereW / 2) - 0.5) / sphereW) * np.pi * 2.0
+    ANGy = (-(np.arange(sphereH) - (sphereH / 2) - 0.5) / sphereH) * np.pi
+    rays = np.empty((sphereH, sphereW, 3), np.float32)
+    rays[:,:,0] = np.cos(ANGy)[:,np.newaxis] * np.sin(ANGx)[np.newaxis,:]
+    rays[:,:,1] = np.cos(ANGy)[:,np.newaxis] * np.cos(ANGx)[np.newaxis,:]
+    rays[:,:,2] = np.sin(ANGy)[:,np.newaxis]
+    rays.flags.writeable = False
+    return rays
+
+# panorama frame to world transform (4 x 4) of a location from the camera
+# to world matrices (3, 6, 4, 4) of its views and their angles (18, 2) of
+# createpano.get_angles: the rotation is fitted to the view and right
+# directions of all valid views (cameras look along -z with x to the right),
+# the origin is the mean camera center
+def pano_to_world(extrinsics: np.array, angles: np.array, valid: np.array = None) -> np.array:
+    extrinsics = extrinsics.reshape(18, 4, 4)
+    if valid is not None:
+        extrinsics = extrinsics[valid.reshape(18)]
+        angles = angles[valid.reshape(18)]
+    x, y = angles[:,0], angles[:,1]
+    pano_dirs = np.concatenate([
+        np.stack([np.cos(y) * np.sin(x), np.cos(y) * np.cos(x), np.sin(y)], axis=1),
+        np.stack([np.cos(x), -np.sin(x), np.zeros_like(x)], axis=1)
+    ])
+    world_dirs = np.concatenate([-extrinsics[:,0:3,2], extrinsics[:,0:3,0]])
+    # Kabsch: rotation minimizing |R pano - world|
+    u, _, vt = np.linalg.svd(world_dirs.T @ pano_dirs)
+    d = np.sign(np.linalg.det(u @ vt))
+    transform = np.eye(4)
+    transform[0:3,0:3] = u @ np.diag([1, 1, d]) @ vt
+    transform[0:3,3] = extrinsics[:,0:3,3].mean(axis=0)
+    return transform
+
+# points (H, W, 3) in meters, in the panorama frame or, with transform, in
+# the world frame, and the mask of valid (non zero) depth. The depth
+# panorama holds distances to the camera center (prepare_matterport with
+# warp_depth).
+def depth_to_points(
+    depth: np.array,
+    transform: np.array = None,
+    scale: float = DEPTH_SCALE
+) -> typing.Tuple[np.array, np.array]:
+    depth = depth.reshape(depth.shape[0], depth.shape[1])
+    rays = ray_table(depth.shape[1], depth.shape[0])
+    points = rays * (depth.astype(np.float32) / np.float32(scale))[:,:,np.newaxis]
+    if transform is not None:
+        points = points @ transform[0:3,0:3].T.astype(np.float32) + transform[0:3,3].astype(np.float32)
+    return points, depth > 0
+
+# unit normals (H, W, 3) of a point grid by central differences (wrapping
+# around horizontally), facing the camera at origin, and the mask of
+# pixels with valid neighbours
+def point_normals(
+    points: np.array,
+    valid: np.array,
+    origin: np.array = np.zeros(3)
+) -> typing.Tuple[np.array, np.array]:
+    du = np.roll(points, -1, axis=1) - np.roll(points, 1, axis=1)
+    dv = np.zeros_like(points)
+    dv[1:-1] = points[2:] - points[:-2]
+    normals = np.cross(du, dv)
+    length = np.linalg.norm(normals, axis=2)
+    ok = valid & np.roll(valid, -1, axis=1) & np.roll(valid, 1, axis=1) & (length > 0)
+    ok[1:-1] &= valid[2:] & valid[:-2]
+    ok[[0, -1]] = False
+    np.divide(normals, length[:,:,np.newaxis], out=normals, where=ok[:,:,np.newaxis])
+    normals[~ok] = 0
+    # towards the camera
+    facing = np.einsum('ijk,ijk->ij', normals, points - origin.astype(np.float32)) > 0
+    normals[facing] *= -1
+    return normals, ok
+
+_PLY_TYPES = {'<f4': "float", 'u1': "uchar"}
+
+# binary little endian PLY of N points with optional normals and colors
+def write_ply(
+    filename: str,
+    points: np.array,
+    normals: np.array = None,
+    colors: np.array = None
+) -> None:
+    fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    if normals is not None:
+        fields += [('nx', '<f4'), ('ny', '<f4'), ('nz', '<f4')]
+    if colors is not None:
+        fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+    vertices = np.empty(len(points), fields)
+    vertices['x'], vertices['y'], vertices['z'] = points.T
+    if normals is not None:
+        vertices['nx'], vertices['ny'], vertices['nz'] = normals.T
+    if colors is not None:
+        vertices['red'], vertices['green'], vertices['blue'] = colors.T
+    header = ["ply", "format binary_little_endian 1.0", "element vertex {}".format(len(points))]
+    header += ["property {} {}".format(_PLY_TYPES[t], name) for name, t in fields]
+    header += ["end_header"]
+    tmpname = filename + ".tmp"
+    with open(tmpname, 'wb') as f:
+        f.write(("\n".join(header) + "\n").encode("ascii"))
+        f.write(vertices.tobytes())
+    os.replace(tmpname, filename)
+
+# .npy with the columns x y z [nx ny nz] [r g b] as float32
+def write_npy(
+    filename: str,
+    points: np.array,
+    normals: np.array = None,
+    colors: np.array = None
+) -> None:
+    columns = [points] + [a.astype(np.float32) for a in (normals, colors) if a is not None]
+    tmpname = filename + ".tmp.npy"
+    np.save(tmpname, np.concatenate(columns, axis=1).astype(np.float32))
+    os.replace(tmpname, filename)
+
+# point cloud of a depth panorama, flattened to the valid pixels, every
+# step-th row and column
+def export_points(
+    filename: str,
+    depth: np.array,
+    transform: np.array = None,
+    normals: bool = False,
+    color: np.array = None,
+    step: int = 1
+) -> int:
+    points, valid = depth_to_points(depth, transform)
+    columns = {}
+    if normals:
+        origin = np.zeros(3) if transform is None else transform[0:3,3]
+        n, ok = point_normals(points, valid, origin)
+        valid &= ok
+        columns["normals"] = n[::step,::step][valid[::step,::step]]
+    if color is not None:
+        columns["colors"] = color[::step,::step][valid[::step,::step]][:,0:3]
+    points = points[::step,::step][valid[::step,::step]]
+    if filename.endswith(".npy"):
+        write_npy(filename, points, **columns)
+    else:
+        write_ply(filename, points, **columns)
+    return len(points)
+
+# panorama of a location in any of the codecs of panowriter
+def load_pano(folder: str, location: str) -> np.array:
+    for extension in (".png", ".webp", ".npy"):
+        filename = os.path.join(folder, location + extension)
+        if os.path.exists(filename):
+            if extension == ".npy":
+                return np.load(filename)
+            return np.array(Image.open(filename))
+    raise FileNotFoundError("no panorama of {} in {}".format(location, folder))
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="Export point clouds from equirectangular depth panoramas")
+    parser.add_argument("--pano_path", type=str, required=True,
+        help="Output directory of a scan written by prepare_matterport"
+    )
+    parser.add_argument("--out_path", type=str, required=True,
+        help="Directory for the point clouds"
+    )
+    parser.add_argument("--depth_folder", type=str, default="undistorted_depth_images",
+        help="Folder of the depth panoramas (e.g. undistorted_depth_images_1024 with several widths)"
+    )
+    parser.add_argument("--color_folder", type=str, default="undistorted_color_images",
+        help="Folder of the color panoramas of the same width, used with --color"
+    )
+    parser.add_argument("--format", choices=['ply', 'npy'], default='ply',
+        help="Output format"
+    )
+    parser.add_argument("--world", action="store_true",
+        help="Transform the points to the world frame, with the camera index (cameras.npy) of the scan"
+    )
+    parser.add_argument("--normals", action="store_true",
+        help="Add surface normals"
+    )
+    parser.add_argument("--color", action="store_true",
+        help="Add the colors of the color panoramas"
+    )
+    parser.add_argument("--step", type=int, default=1,
+        help="Use every step-th row and column"
+    )
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    args = parse_arguments(sys.argv[1:])
+    if not os.path.exists(args.out_path):
+        os.makedirs(args.out_path)
+    transforms = {}
+    if args.world:
+        index = np.load(os.path.join(args.pano_path, "cameras.npy"))
+        for record in index:
+            transforms[str(record['location'])] = pano_to_world(record['extrinsics'], record['angles'], record['valid'])
+    depth_dir = os.path.join(args.pano_path, args.depth_folder)
+    for location in sorted(set(os.path.splitext(f)[0] for f in os.listdir(depth_dir) if not f.endswith(".tmp"))):
+        if args.world and location not in transforms:
+            print("no camera pose for location {}, skipped".format(location))
+            continue
+        depth = load_pano(depth_dir, location)
+        color = None
+        if args.color:
+            color = load_pano(os.path.join(args.pano_path, args.color_folder), location)
+        n = export_points(os.path.join(args.out_path, location + "." + args.format), depth,
+            transforms.get(location), args.normals, color, args.step)
+        print("{}: {} points".format(location, n))
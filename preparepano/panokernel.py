@@ -0,0 +1,181 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# optional compiled stitching backend: a Numba kernel that projects every
+# panorama pixel into the views, samples them, weights the samples and adds
+# them to the accumulation buffers of createpano.PanoAccumulator in one pass,
+# parallel over panorama rows and without remap tables or per-view
+# temporaries. It follows the geometry of createpano.sphere_coords and the
+# sampling of the cv2.remap path (bilinear for color, nearest neighbour for
+# depth and the center weights), up to the fixed point coordinates of cv2.
+# Without Numba available() is false and createpano uses the NumPy path.
+
+import math
+import typing
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# weighting of the views
+AVERAGE, FEATHER, DEPTH = range(3)
+
+def available() -> bool:
+    return numba is not None
+
+# per view: R, the tangent point [x0 y0 z0], the unit image axes in the
+# tangent plane and the source coordinates of the tangent point, for views
+# of imH x imW pixels seen at (quantized) angles v
+def view_params(imH: int, imW: int, imHoriFOV: float, v: np.array) -> np.array:
+    params = np.zeros((len(v), 11))
+    R = (imW / 2) / math.tan(imHoriFOV / 2)
+    for i, (x, y) in enumerate(v):
+        tangent = np.array([R * math.cos(y) * math.sin(x), R * math.cos(y) * math.cos(x), R * math.sin(y)])
+        axis_x = np.array([math.cos(x), -math.sin(x), 0])
+        axis_y = np.cross(tangent, axis_x)
+        axis_y /= np.linalg.norm(axis_y)
+        # createpano samples at sphere_coords + 1 in 0-based pixels
+        params[i] = [R, tangent[0], tangent[1], tangent[2], axis_x[0], axis_x[1], axis_y[0], axis_y[1], axis_y[2],
+            (imW + 1) / 2 + 1, (imH + 1) / 2 + 1]
+    return params
+
+def _accumulate(views, params, footprints, sin_x, cos_x, pano, pano_w, mode):
+    H = pano.shape[0]
+    W = pano.shape[1]
+    nch = pano.shape[2]
+    for r in numba.prange(H):
+        angy = (-(r - (H / 2) - 0.5) / H) * math.pi
+        cos_y = math.cos(angy)
+        gamma = math.sin(angy)
+        # views in order, over the columns of their footprint in this row
+        for k in range(len(views)):
+            r0, r1, c0, ncols = footprints[k]
+            if r < r0 or r >= r1:
+                continue
+            im = views[k]
+            imH = im.shape[0]
+            imW = im.shape[1]
+            p = params[k]
+            for j in range(ncols):
+                c = c0 + j
+                if c >= W:
+                    c -= W
+                alpha = cos_y * sin_x[c]
+                beta = cos_y * cos_x[c]
+                division = p[1] * alpha + p[2] * beta + p[3] * gamma
+                # behind the view, or parallel to the image plane
+                if not division > 0:
+                    continue
+                t = p[0] * p[0] / division
+                dx = alpha * t - p[1]
+                dy = beta * t - p[2]
+                dz = gamma * t - p[3]
+                sx = p[4] * dx + p[5] * dy + p[9]
+                sy = p[6] * dx + p[7] * dy + p[8] * dz + p[10]
+                # nearest pixel, for depth and the center weights
+                ix = int(math.floor(sx + 0.5))
+                iy = int(math.floor(sy + 0.5))
+                w = np.float32(1)
+                if mode != AVERAGE:
+                    if ix < 0 or ix >= imW or iy < 0 or iy >= imH:
+                        continue
+                    w0 = 1 - abs(imH / 2 - iy) / (imH / 2)
+                    w1 = 1 - abs(imW / 2 - ix) / (imW / 2)
+                    w = np.float32(w0 * w1)
+                    if w < 0.00000001:
+                        continue
+                if mode == DEPTH:
+                    value = np.float32(im[iy, ix, 0])
+                    if value < 1:
+                        continue
+                    pano[r, c, 0] += value * w
+                    pano_w[r, c] += w
+                    continue
+                x0 = int(math.floor(sx))
+                y0 = int(math.floor(sy))
+                if x0 < -1 or x0 >= imW or y0 < -1 or y0 >= imH:
+                    continue
+                fx = np.float32(sx - x0)
+                fy = np.float32(sy - y0)
+                w00 = (1 - fx) * (1 - fy)
+                w01 = fx * (1 - fy)
+                w10 = (1 - fx) * fy
+                w11 = fx * fy
+                if x0 >= 0 and x0 + 1 < imW and y0 >= 0 and y0 + 1 < imH:
+                    # bilinear inside the view, always valid
+                    for ch in range(nch):
+                        value = (np.float32(im[y0, x0, ch]) * w00 + np.float32(im[y0, x0 + 1, ch]) * w01 +
+                            np.float32(im[y0 + 1, x0, ch]) * w10 + np.float32(im[y0 + 1, x0 + 1, ch]) * w11)
+                        pano[r, c, ch] += value * w
+                    pano_w[r, c] += w
+                    continue
+                # at the border taps outside the view count as -1, like the
+                # border value of cv2.remap
+                value0 = np.float32(0)
+                for ch in range(nch):
+                    value = np.float32(0)
+                    for ty in range(2):
+                        for tx in range(2):
+                            yy = y0 + ty
+                            xx = x0 + tx
+                            tap = np.float32(-1)
+                            if yy >= 0 and yy < imH and xx >= 0 and xx < imW:
+                                tap = np.float32(im[yy, xx, ch])
+                            value += tap * (fx if tx == 1 else 1 - fx) * (fy if ty == 1 else 1 - fy)
+                    if ch == 0:
+                        value0 = value
+                        if value0 < 0:
+                            break
+                    pano[r, c, ch] += value * w
+                if value0 >= 0:
+                    pano_w[r, c] += w
+
+if numba is not None:
+    _accumulate = numba.njit(parallel=True, cache=True)(_accumulate)
+
+# add the views (cut out, all of one shape and type) to the float32
+# buffers pano (H, W, C) and pano_w (H, W), footprints as given by
+# createpano.view_footprint
+def accumulate(
+    views: typing.List[np.array],
+    params: np.array,
+    footprints: np.array,
+    pano: np.array,
+    pano_w: np.array,
+    mode: int
+) -> None:
+    W = pano.shape[1]
+    angx = ((np.arange(W) - (W / 2) - 0.5) / W) * math.pi * 2.0
+    _accumulate(numba.typed.List(views), params, footprints, np.sin(angx), np.cos(angx), pano, pano_w, mode)
+
+# consistency check of the backends on one location: the fraction of
+# panorama pixels that differ by more than tolerance and the largest
+# difference, for images stitched with createpano.combine_views
+def compare_backends(
+    images: typing.List[np.array],
+    v: np.array,
+    outsize: typing.Tuple[int, int],
+    blending: bool = True,
+    depth: bool = False,
+    feather: bool = False,
+    dtype=np.float32,
+    tolerance: float = 2
+) -> typing.Tuple[float, float]:
+    import createpano
+    backend = createpano.stitch_backend
+    try:
+        createpano.stitch_backend = "numpy"
+        reference = createpano.combine_views(images, v, outsize, blending, depth, feather, dtype).astype(np.float64)
+        createpano.stitch_backend = "numba"
+        pano = createpano.combine_views(images, v, outsize, blending, depth, feather, dtype).astype(np.float64)
+    finally:
+        createpano.stitch_backend = backend
+    diff = np.abs(pano - reference)
+    return float(np.mean(diff > tolerance)), float(diff.max())
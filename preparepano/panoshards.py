@@ -0,0 +1,130 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# sharded output of prepared panoramas for training: the panoramas of each
+# type are packed into fixed-shape .npy stacks of up to shard_size samples,
+# written sequentially and readable with np.load(..., mmap_mode='r'), plus an
+# index.json mapping scan/location to (shard, offset) for every type
+
+import io
+import json
+import logging
+import os
+import typing
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+INDEX_FILE = "index.json"
+
+def _npy_header(shape: typing.Tuple[int, ...], dtype: np.dtype) -> bytes:
+    buf = io.BytesIO()
+    np.lib.format.write_array_header_1_0(buf, {
+        'descr': np.lib.format.dtype_to_descr(dtype),
+        'fortran_order': False,
+        'shape': shape
+    })
+    return buf.getvalue()
+
+# one .npy shard being appended to
+class _Shard:
+    def __init__(self, filename: str, capacity: int, shape: typing.Tuple[int, ...], dtype: np.dtype):
+        self.filename = filename
+        self.capacity = capacity
+        self.shape = shape
+        self.dtype = dtype
+        self.count = 0
+        self.file = open(filename + ".tmp", 'wb')
+        self.header = _npy_header((capacity,) + shape, dtype)
+        self.file.write(self.header)
+
+    def append(self, pano: np.array) -> int:
+        self.file.write(np.ascontiguousarray(pano, self.dtype).tobytes())
+        self.count += 1
+        return self.count - 1
+
+    def close(self) -> None:
+        # shrink the stack to the samples written if the header keeps its
+        # size, otherwise keep the full shape with zero padded samples
+        header = _npy_header((self.count,) + self.shape, self.dtype)
+        if len(header) != len(self.header):
+            log.warning("keeping %d empty samples in %s", self.capacity - self.count, self.filename)
+            header = self.header
+            self.file.truncate(len(header) + self.capacity * int(np.prod(self.shape)) * self.dtype.itemsize)
+        self.file.seek(0)
+        self.file.write(header)
+        self.file.close()
+        os.replace(self.filename + ".tmp", self.filename)
+
+class ShardWriter:
+    def __init__(self, out_dir: str, shard_size: int = 256):
+        self.out_dir = out_dir
+        self.shard_size = shard_size
+        self.index = {"shard_size": shard_size, "types": {}, "samples": {}}
+        self.shards = {}
+        if not(os.path.exists(out_dir)):
+            os.makedirs(out_dir)
+        # continue the index of an earlier run, new shards are appended
+        if os.path.exists(os.path.join(out_dir, INDEX_FILE)):
+            with open(os.path.join(out_dir, INDEX_FILE), 'r') as f:
+                self.index = json.load(f)
+
+    def append(self, scan_id: str, file_type: str, location: str, pano: np.array) -> None:
+        if pano.ndim == 2:
+            pano = pano[:,:,np.newaxis]
+        types = self.index["types"]
+        if file_type not in types:
+            types[file_type] = {"shape": list(pano.shape), "dtype": pano.dtype.str, "shards": []}
+        info = types[file_type]
+        if list(pano.shape) != info["shape"] or pano.dtype.str != info["dtype"]:
+            raise ValueError("{} panorama {}/{} has shape {} {}, shards hold {} {}".format(
+                file_type, scan_id, location, pano.shape, pano.dtype.str, tuple(info["shape"]), info["dtype"]))
+        shard = self.shards.get(file_type)
+        if shard is None or shard.count == shard.capacity:
+            if shard is not None:
+                self._close_shard(file_type)
+            filename = "{}_{:05d}.npy".format(file_type, len(info["shards"]))
+            info["shards"].append({"file": filename, "count": 0})
+            shard = _Shard(os.path.join(self.out_dir, filename), self.shard_size, tuple(info["shape"]), np.dtype(info["dtype"]))
+            self.shards[file_type] = shard
+        offset = shard.append(pano)
+        info["shards"][-1]["count"] = shard.count
+        sample = self.index["samples"].setdefault(scan_id + "/" + location, {})
+        sample[file_type] = [len(info["shards"]) - 1, offset]
+
+    def _close_shard(self, file_type: str) -> None:
+        self.shards.pop(file_type).close()
+
+    def close(self) -> None:
+        for file_type in list(self.shards.keys()):
+            self._close_shard(file_type)
+        tmpname = os.path.join(self.out_dir, INDEX_FILE + ".tmp")
+        with open(tmpname, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmpname, os.path.join(self.out_dir, INDEX_FILE))
+
+# samples of a shard directory as dicts of type -> panorama, memory mapped
+# (zero copy) from the shards; only samples that have all requested types
+class ShardReader:
+    def __init__(self, out_dir: str, types: typing.List[str] = None):
+        with open(os.path.join(out_dir, INDEX_FILE), 'r') as f:
+            self.index = json.load(f)
+        self.types = list(self.index["types"].keys()) if types is None else types
+        self.stacks = {}
+        for t in self.types:
+            self.stacks[t] = [np.load(os.path.join(out_dir, shard["file"]), mmap_mode='r')
+                for shard in self.index["types"][t]["shards"]]
+        self.keys = sorted(key for key, sample in self.index["samples"].items()
+            if all(t in sample for t in self.types))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __getitem__(self, i: int) -> dict:
+        sample = self.index["samples"][self.keys[i]]
+        return {t: self.stacks[t][sample[t][0]][sample[t][1]] for t in self.types}
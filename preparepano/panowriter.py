@@ -0,0 +1,170 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# output codecs for panoramas and a writer encoding them on a bounded thread
+# pool, so that stitching does not wait for compression and disk writes
+#
+# codecs are given as "name[:level]":
+#   png[:level]     PNG via PIL, compress_level 0-9 (PIL default 6)
+#   pngfast[:level] PNG via OpenCV with the zlib RLE strategy, compression
+#                   0-9 (default 1), fast for 16 bit depth
+#   webp[:method]   lossless WebP via PIL, method 0-6 (default 4), 8 bit only
+#   npy             raw NumPy array
+
+import collections
+import concurrent.futures
+import io
+import logging
+import os
+import time
+import typing
+import cv2
+import numpy as np
+from PIL import Image
+import profiling
+
+log = logging.getLogger(__name__)
+
+_EXTENSIONS = {"png": ".png", "pngfast": ".png", "webp": ".webp", "npy": ".npy"}
+
+def parse_codec(spec: str) -> typing.Tuple[str, typing.Optional[int]]:
+    name, _, level = spec.partition(":")
+    if name not in _EXTENSIONS:
+        raise ValueError("unknown codec {}, expected one of {}".format(name, ", ".join(_EXTENSIONS.keys())))
+    if name == "npy" and level:
+        raise ValueError("codec npy takes no level")
+    return name, int(level) if level else None
+
+# codecs that only encode 8 bit panoramas
+_UINT8_ONLY = ("webp",)
+
+# check up front that the codec can encode panoramas of dtype, so that a
+# bad choice fails before any panorama is stitched
+def check_codec(spec: str, dtype) -> None:
+    name, _ = parse_codec(spec)
+    if name in _UINT8_ONLY and np.dtype(dtype) != np.uint8:
+        raise ValueError("codec {} only encodes 8 bit panoramas, got {}".format(name, np.dtype(dtype)))
+
+def codec_extension(spec: str) -> str:
+    return _EXTENSIONS[parse_codec(spec)[0]]
+
+# PIL takes single channel images as 2D arrays, 2D uint16 arrays map to
+# mode I;16 and are saved as 16 bit PNG
+def _squeeze(pano: np.array) -> np.array:
+    return pano[:,:,0] if pano.ndim == 3 and pano.shape[2] == 1 else pano
+
+def _encode_png(pano: np.array, level: typing.Optional[int]) -> bytes:
+    pano = _squeeze(pano)
+    buf = io.BytesIO()
+    options = {} if level is None else {"compress_level": level}
+    Image.fromarray(pano).save(buf, "PNG", **options)
+    return buf.getvalue()
+
+def _encode_pngfast(pano: np.array, level: typing.Optional[int]) -> bytes:
+    if pano.ndim == 3 and pano.shape[2] == 3:
+        pano = cv2.cvtColor(pano, cv2.COLOR_RGB2BGR)
+    ok, buf = cv2.imencode(".png", pano, [
+        cv2.IMWRITE_PNG_COMPRESSION, 1 if level is None else level,
+        cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE
+    ])
+    if not ok:
+        raise RuntimeError("PNG encoding failed")
+    return buf.tobytes()
+
+def _encode_webp(pano: np.array, level: typing.Optional[int]) -> bytes:
+    if pano.dtype != np.uint8:
+        raise ValueError("webp only encodes 8 bit panoramas, got {}".format(pano.dtype))
+    buf = io.BytesIO()
+    Image.fromarray(_squeeze(pano)).save(buf, "WEBP", lossless=True, method=4 if level is None else level)
+    return buf.getvalue()
+
+def _encode_npy(pano: np.array, level: typing.Optional[int]) -> bytes:
+    buf = io.BytesIO()
+    np.save(buf, pano)
+    return buf.getvalue()
+
+_ENCODERS = {"png": _encode_png, "pngfast": _encode_pngfast, "webp": _encode_webp, "npy": _encode_npy}
+
+def encode(spec: str, pano: np.array) -> bytes:
+    name, level = parse_codec(spec)
+    return _ENCODERS[name](pano, level)
+
+# encode and write atomically, returns the number of bytes written
+def write_panorama(spec: str, pano: np.array, filename: str) -> int:
+    data = encode(spec, pano)
+    tmpname = filename + ".tmp"
+    with open(tmpname, 'wb') as f:
+        f.write(data)
+    os.replace(tmpname, filename)
+    return len(data)
+
+class PanoWriter:
+    # threads = 0 writes synchronously in the calling thread; at most
+    # max_pending panoramas (default 2 per thread) are queued, beyond that
+    # write() waits for the oldest one
+    def __init__(self, threads: int = 2, max_pending: int = None):
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads) if threads > 0 else None
+        self.max_pending = max(1, 2 * threads if max_pending is None else max_pending)
+        self.pending = collections.deque()
+        # per codec: files, bytes, encode and write seconds
+        self.stats = collections.OrderedDict()
+        self.wait_seconds = 0.0
+
+    def _write(self, spec: str, pano: np.array, filename: str) -> typing.Tuple[int, float]:
+        start = time.perf_counter()
+        with profiling.stage("encode", file=filename, codec=spec) as s:
+            nbytes = write_panorama(spec, pano, filename)
+            s.written += nbytes
+        return nbytes, time.perf_counter() - start
+
+    def _finish(self, spec: str, future: concurrent.futures.Future, done: typing.Callable) -> None:
+        nbytes, seconds = future.result()
+        stats = self.stats.setdefault(spec, [0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += nbytes
+        stats[2] += seconds
+        if done is not None:
+            done()
+
+    # completion callbacks run in the calling thread, in submission order
+    def _drain(self, keep: int) -> None:
+        while len(self.pending) > keep or (len(self.pending) > 0 and self.pending[0][1].done()):
+            spec, future, done = self.pending[0]
+            if not future.done():
+                start = time.perf_counter()
+                concurrent.futures.wait([future])
+                self.wait_seconds += time.perf_counter() - start
+            self.pending.popleft()
+            self._finish(spec, future, done)
+
+    # the panorama must not be modified after it is handed to write();
+    # done is called once the file is complete
+    def write(self, spec: str, pano: np.array, filename: str, done: typing.Callable = None) -> None:
+        if self.pool is None:
+            future = concurrent.futures.Future()
+            future.set_result(self._write(spec, pano, filename))
+            self._finish(spec, future, done)
+            return
+        self._drain(self.max_pending - 1)
+        self.pending.append((spec, self.pool.submit(self._write, spec, pano, filename), done))
+
+    def flush(self) -> None:
+        self._drain(0)
+
+    def close(self) -> None:
+        self.flush()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def summary(self) -> str:
+        lines = ["{:<12} {:>7} {:>10} {:>10} {:>9} {:>9}".format("codec", "files", "MB", "MB/file", "s", "ms/file")]
+        for spec, (files, nbytes, seconds) in self.stats.items():
+            lines.append("{:<12} {:>7d} {:>10.1f} {:>10.2f} {:>9.2f} {:>9.1f}".format(
+                spec, files, nbytes / 2**20, nbytes / 2**20 / files, seconds, 1000 * seconds / files))
+        lines.append("waited {:.2f}s for the writer".format(self.wait_seconds))
+        return "\n".join(lines)
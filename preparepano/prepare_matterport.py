@@ -8,20 +8,25 @@
 
 
 import argparse
+import io
+import json
 import os
 import sys
+import typing
+import concurrent.futures
+from multiprocessing import shared_memory, resource_tracker
 import numpy as np
 from PIL import Image
-# conversion package for panoramic images
-# https://github.com/sunset1995/py360convert
-# can be installed using pip install py360convert
-import py360convert 
 import zipfile
 import createpano
+import panokernel
+import panoshards
+import panowriter
+import profiling
+import skybox
 import logging
 import tqdm
-import copy
-import math
+import functools
 
 log = logging.getLogger(__name__)
 
@@ -29,8 +34,9 @@ def unzip(basedir,filename):
     with zipfile.ZipFile(os.path.join(basedir, filename), 'r') as zip_ref:
         zip_ref.extractall(basedir)
 
-def parse_camera_params(filename: str) -> dict:
-    with open(filename, 'r') as f:
+# filename may also be an open text file
+def parse_camera_params(filename: typing.Union[str, typing.TextIO]) -> dict:
+    with (open(filename, 'r') if isinstance(filename, str) else filename) as f:
         paramdict = {}
         while True: 
             line = f.readline() 
@@ -56,32 +62,358 @@ def parse_camera_params(filename: str) -> dict:
     return paramdict
 
 
-def correct_depth_distortion(depth_img_in):
-    depth_img = copy.deepcopy(depth_img_in)
-    
-    c1 = depth_img.shape[1]/2
-    c0 = depth_img.shape[0]/2
-    halfFov = createpano.default_fov / 2
-    
-    for i in range(depth_img.shape[1]):
-        angle1 = (abs(i-c1)/c1) * halfFov
-        for j in range(depth_img.shape[0]):
-            d1 = math.tan(angle1) * depth_img[j,i,0]
-            angle0 = (abs(j-c0)/c0) * halfFov    
-            d0 = math.tan(angle0) * depth_img[j,i,0] 
-            diag = math.sqrt(d0*d0 + d1*d1)
-            distToCenter = math.sqrt(float(depth_img[j,i,0])*float(depth_img[j,i,0]) + diag*diag)
-            corr = distToCenter - depth_img[j,i,0]
-            
-            if depth_img[j,i,0] >0:
-                result = depth_img[j,i,0] + corr
-                if result>65535:
-                    result = 65535
-                depth_img[j,i,0] = result
+# per-pixel factor that turns depth along the optical axis into distance
+# to the camera center, sqrt(1 + tan(angle0)^2 + tan(angle1)^2)
+@functools.lru_cache(maxsize=4)
+def depth_correction_map(height: int, width: int, fov: float) -> np.array:
+    c1 = width/2
+    c0 = height/2
+    halfFov = fov / 2
+    tan1 = np.tan((np.abs(np.arange(width) - c1)/c1) * halfFov)
+    tan0 = np.tan((np.abs(np.arange(height) - c0)/c0) * halfFov)
+    factor = np.sqrt(1.0 + tan0[:,np.newaxis]**2 + tan1[np.newaxis,:]**2)
+    factor.flags.writeable = False
+    return factor
 
-        
+def correct_depth_distortion(depth_img_in, inplace=False, scratch=None):
+    depth_img = depth_img_in if inplace else depth_img_in.copy()
+    factor = depth_correction_map(depth_img.shape[0], depth_img.shape[1], createpano.default_fov)
+    if scratch is None:
+        scratch = np.empty(factor.shape)
+    # invalid (zero) depth stays zero, results saturate at 65535
+    np.multiply(depth_img[:,:,0], factor, out=scratch)
+    np.minimum(scratch, 65535, out=scratch)
+    np.copyto(depth_img[:,:,0], scratch, casting='unsafe')
     return depth_img
-    
+
+# correct all views of a location in place, sharing the factor map and one
+# float buffer between them
+def correct_depth_distortion_batch(depth_imgs):
+    scratch = None
+    for depth_img in depth_imgs:
+        if depth_img.size < 3:
+            continue
+        if scratch is None or scratch.shape != depth_img.shape[:2]:
+            scratch = np.empty(depth_img.shape[:2])
+        correct_depth_distortion(depth_img, True, scratch)
+    return depth_imgs
+
+# filename may also be an open binary file
+def load_image(filename: typing.Union[str, typing.BinaryIO]) -> np.array:
+    srcimg = np.array(Image.open(filename))
+    if srcimg.ndim==2:
+        srcimg = np.reshape(srcimg, (srcimg.shape[0],srcimg.shape[1],1))
+    return srcimg
+
+# open zip archives, one shared handle per archive and process, with the
+# archive members indexed by folder and file name
+_archives = {}
+
+def _open_archive(filename: str) -> typing.Tuple[zipfile.ZipFile, dict]:
+    key = (os.getpid(), filename)
+    if key not in _archives:
+        zip_ref = zipfile.ZipFile(filename, 'r')
+        members = {}
+        for member in zip_ref.namelist():
+            if member.endswith("/"):
+                continue
+            folder = os.path.basename(os.path.dirname(member))
+            members.setdefault(folder, {})[os.path.basename(member)] = member
+        _archives[key] = (zip_ref, members)
+    return _archives[key]
+
+# one folder of a scan (e.g. undistorted_color_images), read from the
+# extracted directory or, with from_zip, straight from the scan's
+# <folder>.zip archive, decoding only the members that are opened
+class ScanFolder:
+    def __init__(self, base_dir: str, scan_id: str, name: str, from_zip: bool = False):
+        self.name = name
+        self.path = os.path.join(base_dir, scan_id, scan_id, name)
+        self.archive = None
+        zipname = os.path.join(base_dir, scan_id, name + ".zip")
+        if from_zip and os.path.exists(zipname):
+            self.archive = zipname
+
+    def listdir(self) -> typing.List[str]:
+        if self.archive is None:
+            return os.listdir(self.path)
+        return list(_open_archive(self.archive)[1].get(self.name, {}).keys())
+
+    def open(self, filename: str) -> typing.BinaryIO:
+        if self.archive is None:
+            return open(os.path.join(self.path, filename), 'rb')
+        zip_ref, members = _open_archive(self.archive)
+        return zip_ref.open(members[self.name][filename])
+
+    def load_image(self, filename: str) -> np.array:
+        with self.open(filename) as f, profiling.stage("decode") as s:
+            srcimg = load_image(f)
+            s.read += f.tell()
+        return srcimg
+
+    # cheap change signature of a file: size and mtime, or size and CRC
+    # for archive members
+    def stat(self, filename: str) -> typing.List[int]:
+        if self.archive is None:
+            st = os.stat(os.path.join(self.path, filename))
+            return [st.st_size, st.st_mtime_ns]
+        zip_ref, members = _open_archive(self.archive)
+        info = zip_ref.getinfo(members[self.name][filename])
+        return [info.file_size, info.CRC]
+
+def camera_params_folder(base_dir: str, scan_id: str, from_zip: bool = False) -> ScanFolder:
+    return ScanFolder(base_dir, scan_id, "undistorted_camera_parameters", from_zip)
+
+# camera index of a scan: one record per location with the matrices of its
+# 3 x 6 views, the intrinsics of each view and the view angles of
+# createpano.get_angles, plus the signature of the .conf it was made from
+CAMERA_INDEX_FILE = "cameras.npy"
+CAMERA_INDEX_DTYPE = np.dtype([
+    ('location', 'U32'),
+    ('conf', 'i8', (2,)),
+    ('valid', '?', (3, 6)),
+    ('extrinsics', 'f8', (3, 6, 4, 4)),
+    ('intrinsics', 'f8', (3, 6, 3, 3)),
+    ('angles', 'f8', (18, 2)),
+])
+
+def parse_camera_index(f: typing.TextIO, conf: typing.Optional[typing.List[int]] = None) -> np.array:
+    if conf is None:
+        conf = [0, 0]
+    keys = []
+    matrices = []
+    intrinsics = []
+    current = ["1", "0", "0", "0", "1", "0", "0", "0", "1"]
+    for line in f:
+        lineparts = line.split()
+        if len(lineparts) == 0:
+            continue
+        if lineparts[0] == "intrinsics_matrix":
+            current = lineparts[1:10]
+        elif lineparts[0] == "scan":
+            (loc,row,ori) = lineparts[1].split("_", 3)
+            keys.append((loc, int(row[1:]), int(os.path.splitext(ori)[0])))
+            matrices.append(lineparts[3:19])
+            intrinsics.append(current)
+    locations = sorted(set(key[0] for key in keys))
+    index = np.zeros(len(locations), CAMERA_INDEX_DTYPE)
+    index['location'] = locations
+    index['conf'] = conf
+    index['extrinsics'] = np.eye(4)
+    index['intrinsics'] = np.eye(3)
+    if len(keys) > 0:
+        rows = {location: i for i, location in enumerate(locations)}
+        locs = np.array([rows[key[0]] for key in keys])
+        rowids = np.array([key[1] for key in keys])
+        oriids = np.array([key[2] for key in keys])
+        index['valid'][locs, rowids, oriids] = True
+        index['extrinsics'][locs, rowids, oriids] = np.array(matrices, np.float64).reshape(-1, 4, 4)
+        index['intrinsics'][locs, rowids, oriids] = np.array(intrinsics, np.float64).reshape(-1, 3, 3)
+        index['angles'] = createpano.get_angles_batch(index['extrinsics'])
+    return index
+
+# the camera index of a scan, kept as a memory mapped .npy in the scan's
+# output directory and rebuilt when the .conf changes
+def load_camera_index(base_dir: str, scan_id: str, from_zip: bool, out_dir: str) -> np.array:
+    folder = camera_params_folder(base_dir, scan_id, from_zip)
+    conf = folder.stat(scan_id + ".conf")
+    filename = os.path.join(out_dir, CAMERA_INDEX_FILE)
+    if os.path.exists(filename):
+        try:
+            index = np.load(filename, mmap_mode='r')
+            if index.dtype == CAMERA_INDEX_DTYPE and len(index) > 0 and list(index['conf'][0]) == conf:
+                return index
+        except ValueError:
+            log.warning("ignoring unreadable camera index %s", filename)
+    with io.TextIOWrapper(folder.open(scan_id + ".conf")) as f:
+        index = parse_camera_index(f, conf)
+    if not(os.path.exists(out_dir)):
+        os.makedirs(out_dir)
+    tmpname = filename + ".tmp"
+    with open(tmpname, 'wb') as f:
+        np.save(f, index)
+    os.replace(tmpname, filename)
+    return index
+
+# view angles per location
+def camera_angles(index: np.array) -> dict:
+    return {str(record['location']): np.array(record['angles']) for record in index}
+
+# version of the output panoramas, part of the manifest signatures together
+# with createpano.REMAP_TABLE_VERSION. Bump it when the stitching, depth
+# correction, skybox conversion or encoding change the output bytes, so that
+# outputs of other versions are rebuilt.
+OUTPUT_VERSION = 1
+
+# record of the inputs and parameters every output panorama of a scan was
+# made from, stored as manifest.json in the scan's output directory, so that
+# runs can skip outputs that are up to date. Updates are kept in memory
+# until save(), which the callers do once per location and at the end of
+# the scan; a crash only loses entries whose outputs are then rebuilt.
+class Manifest:
+    def __init__(self, out_dir: str, rebuild: bool = False):
+        self.out_dir = out_dir
+        self.filename = os.path.join(out_dir, "manifest.json")
+        self.entries = {}
+        self.dirty = False
+        if not rebuild and os.path.exists(self.filename):
+            try:
+                with open(self.filename, 'r') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                log.warning("ignoring unreadable manifest %s", self.filename)
+
+    # output is relative to the scan's output directory
+    def is_current(self, output: str, signature: dict) -> bool:
+        return self.entries.get(output) == signature and os.path.exists(os.path.join(self.out_dir, output))
+
+    def update(self, output: str, signature: dict) -> None:
+        self.entries[output] = signature
+        self.dirty = True
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        if not(os.path.exists(self.out_dir)):
+            os.mkdir(self.out_dir)
+        # replace atomically, so a crash never leaves a truncated manifest
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmpname, self.filename)
+        self.dirty = False
+
+def output_signature(
+    file_type: str,
+    folder: ScanFolder,
+    filenames: typing.List[str],
+    camera: typing.Optional[typing.List[int]],
+    warp_depth: bool,
+    feather: bool
+) -> dict:
+    return {
+        "version": [OUTPUT_VERSION, createpano.REMAP_TABLE_VERSION],
+        "params": {
+            "type": file_type,
+            "out_width": equirect_size[0],
+            "warp_depth": warp_depth,
+            "feather": feather,
+            "codec": output_codecs[file_type],
+            "backend": createpano.stitch_backend if panokernel.available() else "numpy"
+        },
+        "inputs": {filename: folder.stat(filename) for filename in filenames},
+        "camera": camera
+    }
+
+# sorted file names per location id, from the directory listing alone
+def list_locations(folder: ScanFolder, extension: str) -> dict:
+    filedict = {}
+    for filename in sorted(folder.listdir()):
+        if not(filename.endswith(extension)):
+            continue
+        namepart, _ = os.path.splitext(filename)
+        locationId = namepart.split("_", 3)[0]
+        filedict.setdefault(locationId, []).append(filename)
+    return filedict
+
+# stitch the views of one location of the given type (folder name)
+def stitch_views(
+    name: str,
+    views: typing.List[np.array],
+    v: np.array,
+    warp_depth: bool,
+    feather: bool = False
+) -> np.array:
+    blending = True
+    if name.startswith("segmentation_maps"):
+        blending = False
+
+    is_depth = False
+    if name == "undistorted_depth_images":
+        is_depth = True
+        blending = False
+        if warp_depth:
+            with profiling.stage("depth_correction"):
+                correct_depth_distortion_batch(views)
+
+            # debug code
+            #for i, depth_img in enumerate(views):
+            #    array_buffer = depth_img.astype(np.uint16).tobytes()
+            #    eqrimg = Image.new("I", (depth_img.shape[1],depth_img.shape[0]))
+            #    eqrimg.frombytes(array_buffer, 'raw', "I;16")
+            #    eqrimg.save(os.path.join(out_dir, name, location + "_" + str(i) + "_corrected.png"), "PNG", compress_level=0)
+
+    dtype = np.uint16 if is_depth else np.uint8
+    with profiling.stage("stitch"):
+        return createpano.combine_views(views, v, equirect_size, blending, is_depth, feather, dtype)
+
+# output codec per type, see panowriter for the choices
+DEFAULT_CODECS = {
+    'skybox':   'png',
+    'color':    'png',
+    'depth':    'png:0',
+    'classes':  'png:0',
+    'instances':'png:0',
+}
+output_codecs = dict(DEFAULT_CODECS)
+
+# dtype of the panoramas of each type
+def output_dtype(file_type: str):
+    return np.uint16 if file_type == "depth" else np.uint8
+
+# output widths: panoramas are stitched once at the largest width (the
+# global equirect_size) and the smaller levels are downsampled from it. With
+# several widths each level goes to its own <folder>_<width> directory.
+out_widths = [1024]
+
+def output_folder(file_type: str, width: int) -> str:
+    name = _CHOICE_MAPPING_[file_type][0]
+    return name if len(out_widths) == 1 else "{}_{}".format(name, width)
+
+# output file of a location, relative to the scan's output directory
+def output_name(file_type: str, location: str, width: int) -> str:
+    return os.path.join(output_folder(file_type, width), location + panowriter.codec_extension(output_codecs[file_type]))
+
+def make_output_folders(file_type: str, out_dir: str) -> None:
+    for width in out_widths:
+        if not(os.path.exists(os.path.join(out_dir, output_folder(file_type, width)))):
+            os.makedirs(os.path.join(out_dir, output_folder(file_type, width)))
+
+def is_current(manifest: Manifest, file_type: str, location: str, signature: dict) -> bool:
+    return all(manifest.is_current(output_name(file_type, location, width), signature) for width in out_widths)
+
+# the panorama at every output width, largest first
+def pyramid(file_type: str, eqrar: np.array) -> typing.Iterator[typing.Tuple[int, np.array]]:
+    for width in sorted(out_widths, reverse=True):
+        with profiling.stage("downsample"):
+            level = createpano.downsample_pano(eqrar, [width, width // 2], _CHOICE_MAPPING_[file_type][3], file_type == "depth")
+        yield width, level
+
+# hand the levels of a panorama to the writer, the manifest is updated once
+# a file is written
+def save_panorama(
+    writer: panowriter.PanoWriter,
+    file_type: str,
+    location: str,
+    eqrar: np.array,
+    out_dir: str,
+    manifest: Manifest = None,
+    signature: dict = None
+) -> None:
+    for width, level in pyramid(file_type, eqrar):
+        output = output_name(file_type, location, width)
+        done = None
+        if manifest is not None:
+            done = functools.partial(manifest.update, output, signature)
+        writer.write(output_codecs[file_type], level, os.path.join(out_dir, output), done)
+
+# shards hold the levels as separate types <type>_<width>
+def save_shards(shards: panoshards.ShardWriter, scan_id: str, file_type: str, location: str, eqrar: np.array) -> None:
+    for width, level in pyramid(file_type, eqrar):
+        shard_type = file_type if len(out_widths) == 1 else "{}_{}".format(file_type, width)
+        with profiling.stage("shards") as s:
+            shards.append(scan_id, shard_type, location, level)
+            s.written += level.nbytes
 
 def process_file_type(
     base_dir: str,
@@ -92,93 +424,234 @@ def process_file_type(
     extension: str,
     is_skyBox: bool,
     interpolate: bool,
-    warp_depth: bool
+    warp_depth: bool,
+    feather: bool = False,
+    from_zip: bool = False,
+    manifest: Manifest = None,
+    shards: panoshards.ShardWriter = None,
+    writer: panowriter.PanoWriter = None,
+    skybox_batch: int = 4
 ) -> None:
-    face_seq = ['U','B','R','F','L','D']
-    
     if not(os.path.exists(out_dir)):
         os.mkdir(out_dir)
 
-    if not(os.path.exists(os.path.join(out_dir, name))):
-        os.mkdir(os.path.join(out_dir, name))
+    make_output_folders(file_type, out_dir)
     
-    srcdir = os.path.join(base_dir, scan_id, scan_id, name)
-    filelist = sorted(os.listdir(srcdir))    
-    filedict = {}
-    for filename in filelist:
-        if not(filename.endswith(extension)):
-            continue
-        namepart, _ = os.path.splitext(filename)
-        tokens = namepart.split("_", 3)        
-        srcimg = np.array(Image.open(os.path.join(srcdir, filename)))
-        if srcimg.ndim==2:
-            srcimg = np.reshape(srcimg, (srcimg.shape[0],srcimg.shape[1],1))		
-        locationId = tokens[0]
-        if is_skyBox:
-            if not(locationId) in filedict.keys():
-                filedict[locationId] = {}
-            filedict[locationId][face_seq[len(filedict[locationId])]] = srcimg
-        else:
-            if not(locationId) in filedict.keys():
-                filedict[locationId] = [ srcimg ]
-            else:
-                filedict[locationId].append(srcimg)
+    folder = ScanFolder(base_dir, scan_id, name, from_zip)
+    listing = list_locations(folder, extension)
         
+    camera = None
     if not is_skyBox:
-        paramdict = parse_camera_params(os.path.join(base_dir, scan_id, scan_id, "undistorted_camera_parameters", scan_id + ".conf"))
+        with profiling.stage("camera_index"):
+            angles = camera_angles(load_camera_index(base_dir, scan_id, from_zip, out_dir))
+        camera = camera_params_folder(base_dir, scan_id, from_zip).stat(scan_id + ".conf")
+
+    signatures = {}
+    if manifest is not None:
+        for location in list(listing.keys()):
+            signatures[location] = output_signature(file_type, folder, listing[location], camera, warp_depth, feather)
+            if is_current(manifest, file_type, location, signatures[location]):
+                del listing[location]
+    if writer is None:
+        writer = panowriter.PanoWriter(0)
             
-    for location in tqdm.tqdm(filedict.keys(), desc=f"{file_type}"):
-        if is_skyBox:
-            facelist = [
-                np.fliplr(filedict[location]['F']),
-                filedict[location]['R'],
-                filedict[location]['B'],
-                np.fliplr(filedict[location]['L']),
-                filedict[location]['U'],
-                np.flipud(filedict[location]['D']) 
-            ]
-            eqrar = py360convert.c2e(facelist, equirect_size[1], equirect_size[0], mode='bilinear', cube_format='list')
-            eqrar = np.fliplr(eqrar)
-            eqrimg = Image.fromarray(eqrar.astype(np.uint8))            
-            eqrimg.save(os.path.join(out_dir, name, location + ".png"))
+    def save(location, eqrar):
+        if shards is not None:
+            save_shards(shards, scan_id, file_type, location, eqrar)
         else:
-            v = createpano.get_angles(paramdict[location])
-            blending = True
-            if name.startswith("segmentation_maps"):
-                blending = False
-
-            is_depth = False
-            if name == "undistorted_depth_images":
-                is_depth = True
-                blending = False
-                if warp_depth:
-                    for i in range(len(filedict[location])):                       
-                        depth_img= correct_depth_distortion(filedict[location][i])           
-
-                        # debug code
-                        #array_buffer = depth_img.astype(np.uint16).tobytes()
-                        #eqrimg = Image.new("I", (depth_img.shape[1],depth_img.shape[0]))
-                        #eqrimg.frombytes(array_buffer, 'raw', "I;16")               
-                        #eqrimg.save(os.path.join(out_dir, name, location + "_" + str(i) + "_corrected.png"), "PNG", compress_level=0)
-
-                        
-                        filedict[location][i] = depth_img
-
-            eqrar = createpano.combine_views(filedict[location], v, equirect_size, blending, is_depth)
-            if name=="undistorted_depth_images":
-                array_buffer = eqrar.astype(np.uint16).tobytes()
-                eqrimg = Image.new("I", (eqrar.shape[1],eqrar.shape[0]))
-                eqrimg.frombytes(array_buffer, 'raw', "I;16")               
-                eqrimg.save(os.path.join(out_dir, name, location + ".png"), "PNG", compress_level=0)
-            elif name.startswith("segmentation_maps"):
-                eqrimg = Image.fromarray(eqrar.astype(np.uint8))
-                eqrimg.save(os.path.join(out_dir, name, location + ".png"), "PNG", compress_level=0)
-            else:
-                eqrimg = Image.fromarray(eqrar.astype(np.uint8))
-                eqrimg.save(os.path.join(out_dir, name, location + ".png"))
-
-def process_scan(m3d_path, out_path, scan_id, types, unpack, warp_depth) -> None:      
-    if unpack:
+            save_panorama(writer, file_type, location, eqrar, out_dir, manifest, signatures.get(location))
+
+    # skyboxes are converted skybox_batch locations at a time, the profile
+    # counts a batch to the location that completes it
+    skyboxes = []
+    def convert_skyboxes():
+        with profiling.stage("skybox"):
+            panos = skybox.skybox_to_equirect([faces for _, faces in skyboxes], equirect_size)
+        for (location, faces), eqrar in zip(skyboxes, panos):
+            save(location, eqrar)
+            del faces[:]
+        del skyboxes[:]
+        if manifest is not None:
+            manifest.save()
+
+    # views are decoded one location at a time, in listing order, so that
+    # only one location is held in memory
+    for location in tqdm.tqdm(listing.keys(), total=len(listing), desc=f"{file_type}"):
+        with profiling.location(scan=scan_id, type=file_type, location=location):
+            srcimgs = [folder.load_image(filename) for filename in listing[location]]
+            if is_skyBox:
+                skyboxes.append((location, srcimgs))
+                if len(skyboxes) >= skybox_batch:
+                    convert_skyboxes()
+                continue
+            eqrar = stitch_views(name, srcimgs, angles[location], warp_depth, feather)
+            save(location, eqrar)
+            if manifest is not None:
+                manifest.save()
+            # release the location's views before decoding the next one
+            del srcimgs[:]
+    if len(skyboxes) > 0:
+        convert_skyboxes()
+
+# load and stitch the views of one location for each of the given types,
+# filenames maps each type to the location's view files, v are the view
+# angles of the location
+def stitch_location(
+    base_dir: str,
+    scan_id: str,
+    location: str,
+    filenames: dict,
+    v: np.array,
+    warp_depth: bool,
+    feather: bool = False,
+    from_zip: bool = False
+) -> dict:
+    views = {}
+    for t in filenames.keys():
+        folder = ScanFolder(base_dir, scan_id, _CHOICE_MAPPING_[t][0], from_zip)
+        views[t] = [folder.load_image(filename) for filename in filenames[t]]
+    panos = {}
+    for t in views.keys():
+        panos[t] = stitch_views(_CHOICE_MAPPING_[t][0], views[t], v, warp_depth, feather)
+        del views[t][:]
+    return panos
+
+def _init_worker(size, remap_cache_dir, angle_quantization, stitch_backend, profile) -> None:
+    global equirect_size
+    equirect_size = size
+    createpano.remap_cache_dir = remap_cache_dir
+    createpano.angle_quantization = angle_quantization
+    createpano.stitch_backend = stitch_backend
+    if profile:
+        profiling.start()
+
+# worker side of stitch_location: panoramas are handed back in shared memory
+# blocks, which the caller unlinks after reading them with _from_shared,
+# together with the location's profile record (None without profiling)
+def _stitch_location_shared(*args) -> typing.Tuple[dict, typing.Optional[dict]]:
+    with profiling.location(scan=args[1], type="+".join(args[3].keys()), location=args[2]) as record:
+        panos = stitch_location(*args)
+    results = {}
+    for t, pano in panos.items():
+        try:
+            shm = shared_memory.SharedMemory(create=True, size=max(1, pano.nbytes), track=False)
+        except TypeError:
+            # before Python 3.13 the block cannot be created untracked
+            shm = shared_memory.SharedMemory(create=True, size=max(1, pano.nbytes))
+            resource_tracker.unregister(shm._name, "shared_memory")
+        np.ndarray(pano.shape, pano.dtype, buffer=shm.buf)[...] = pano
+        results[t] = (shm.name, pano.shape, pano.dtype.str)
+        shm.close()
+    return results, record
+
+def _from_shared(result, consume) -> None:
+    shm_name, shape, dtype = result
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        pano = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+        consume(pano)
+        del pano
+    finally:
+        shm.close()
+        shm.unlink()
+
+# stitch all requested view based types location by location: the directories
+# and camera parameters are read once, the views of all types of a location
+# are loaded together and share the view geometry (remap tables). With
+# workers > 1 locations are stitched in a process pool, output files are
+# identical to the serial path.
+def process_views(
+    base_dir: str,
+    scan_id: str,
+    file_types: typing.List[str],
+    out_dir: str,
+    warp_depth: bool,
+    feather: bool = False,
+    workers: int = 1,
+    from_zip: bool = False,
+    manifest: Manifest = None,
+    shards: panoshards.ShardWriter = None,
+    writer: panowriter.PanoWriter = None
+) -> None:
+    if not(os.path.exists(out_dir)):
+        os.mkdir(out_dir)
+
+    folders = {}
+    listings = {}
+    for t in file_types:
+        name, extension = _CHOICE_MAPPING_[t][0:2]
+        make_output_folders(t, out_dir)
+        folders[t] = ScanFolder(base_dir, scan_id, name, from_zip)
+        listings[t] = list_locations(folders[t], extension)
+
+    with profiling.stage("camera_index"):
+        angles = camera_angles(load_camera_index(base_dir, scan_id, from_zip, out_dir))
+    camera = camera_params_folder(base_dir, scan_id, from_zip).stat(scan_id + ".conf")
+    locations = sorted(set(location for t in file_types for location in listings[t].keys()))
+    jobs = []
+    signatures = {}
+    for location in locations:
+        filenames = {}
+        for t in file_types:
+            if location not in listings[t]:
+                log.warning("no %s views for location %s", t, location)
+                continue
+            if manifest is not None:
+                signature = output_signature(t, folders[t], listings[t][location], camera, warp_depth, feather)
+                if is_current(manifest, t, location, signature):
+                    continue
+                signatures[(location, t)] = signature
+            filenames[t] = listings[t][location]
+        if len(filenames) > 0:
+            jobs.append((base_dir, scan_id, location, filenames, angles[location], warp_depth, feather, from_zip))
+
+    if writer is None:
+        writer = panowriter.PanoWriter(0)
+
+    def save(location, t, pano):
+        if shards is not None:
+            save_shards(shards, scan_id, t, location, pano)
+        else:
+            save_panorama(writer, t, location, pano, out_dir, manifest, signatures.get((location, t)))
+
+    progress = tqdm.tqdm(total=len(jobs), desc="+".join(file_types))
+    if workers <= 1:
+        for job in jobs:
+            with profiling.location(scan=scan_id, type="+".join(job[3].keys()), location=job[2]):
+                for t, pano in stitch_location(*job).items():
+                    save(job[2], t, pano)
+            if manifest is not None:
+                manifest.save()
+            progress.update(1)
+    else:
+        # workers are forked, no writer thread may hold a lock (e.g. a
+        # module import of PIL) at that point
+        writer.flush()
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(
+                equirect_size, createpano.remap_cache_dir, createpano.angle_quantization, createpano.stitch_backend,
+                profiling.active() is not None)) as pool:
+            futures = [pool.submit(_stitch_location_shared, *job) for job in jobs]
+            # results are saved in job order, as in the serial path, so that
+            # shard offsets and the index do not depend on worker timing
+            saved = 0
+            for _ in concurrent.futures.as_completed(futures):
+                while saved < len(futures) and futures[saved].done():
+                    location = jobs[saved][2]
+                    results, record = futures[saved].result()
+                    if record is not None:
+                        profiling.active().merge(record)
+                    for t, result in results.items():
+                        # the writer keeps the panorama beyond the shared block
+                        _from_shared(result, lambda pano: save(location, t, pano.copy()))
+                    saved += 1
+                if manifest is not None:
+                    manifest.save()
+                progress.update(1)
+    progress.close()
+
+def process_scan(m3d_path, out_path, scan_id, types, unpack, warp_depth, feather=False, fused=False, workers=1, from_zip=False, rebuild=False, shards=None, writer=None) -> None:      
+    # archives are read directly with from_zip, nothing needs to be extracted
+    if unpack and not from_zip:
         unzip(os.path.join(m3d_path,scan_id),"undistorted_camera_parameters.zip")
         unzip(os.path.join(m3d_path,scan_id),"house_segmentations.zip")
         unzip(os.path.join(m3d_path,scan_id),"undistorted_color_images.zip")
@@ -186,9 +659,22 @@ def process_scan(m3d_path, out_path, scan_id, types, unpack, warp_depth) -> None
         unzip(os.path.join(m3d_path,scan_id),"matterport_skybox_images.zip")
 
     equirect_path = os.path.join(out_path, scan_id)
+    # shards are appended to, outputs are only skipped for PNG files
+    manifest = Manifest(equirect_path, rebuild) if shards is None else None
+    view_types = [t for t in types if not _CHOICE_MAPPING_[t][2]]
+    # workers always stitch all view based types of a location in one job,
+    # so that the types share the remap tables cached in the worker
+    if (fused or workers > 1) and len(view_types) > 0:
+        process_views(m3d_path, scan_id, view_types, equirect_path, warp_depth, feather, workers, from_zip, manifest, shards, writer)
+        types = [t for t in types if _CHOICE_MAPPING_[t][2]]
     for t in tqdm.tqdm(types, desc="Scan Progress"):
         args = _CHOICE_MAPPING_[t]
-        process_file_type(m3d_path, scan_id, t, args[0], equirect_path, args[1], args[2], args[3], warp_depth)
+        process_file_type(m3d_path, scan_id, t, args[0], equirect_path, args[1], args[2], args[3], warp_depth, feather, from_zip, manifest, shards, writer)
+    # the entries of the files still being written
+    if manifest is not None:
+        if writer is not None:
+            writer.flush()
+        manifest.save()
 
 _CHOICE_MAPPING_ = {
     # choice:   (         `folder`,             'ext'   'sky?`  `bilinear`)
@@ -210,8 +696,9 @@ def parse_arguments(args):
     parser.add_argument("--out_path", type=str,         
         help="Output processed Matterport3D equirectangular images path"
     )
-    parser.add_argument("--out_width", type=int, 
-        default=1024, help="Output equirectangular width"
+    parser.add_argument("--out_width", type=int, nargs='+',
+        default=[1024], help="Output equirectangular width, with several widths panoramas are stitched at the "
+                             "largest and the others are downsampled from it"
     )
     parser.add_argument("--types", #type=list,
         nargs='+', default=['color'],
@@ -230,13 +717,64 @@ def parse_arguments(args):
     parser.add_argument("--unpack", action="store_true", 
         help="Unpack ZIP files before processing"
     )
+    parser.add_argument("--feather", action="store_true",
+        help="Blend color views weighted by distance to the view center instead of averaging"
+    )
+    parser.add_argument("--shards", action="store_true",
+        help="Pack panoramas into memory-mappable .npy shards with an index in <out_path>/shards instead of PNG files"
+    )
+    parser.add_argument("--shard_size", type=int, default=256,
+        help="Number of panoramas per shard"
+    )
+    parser.add_argument("--codec", nargs='+', default=[], metavar="TYPE=CODEC",
+        help="Output codec per type, one of png[:level], pngfast[:level], webp[:method] or npy "
+             "(default: png:0 for depth and labels, png otherwise)"
+    )
+    parser.add_argument("--writer_threads", type=int, default=2,
+        help="Number of threads encoding and writing output files, 0 writes synchronously"
+    )
+    parser.add_argument("--profile", nargs='?', const="", metavar="TRACE",
+        help="Record wall and CPU time, bytes read and written and peak RSS per stage and location, written as "
+             "JSON lines to TRACE (default: <out_path>/profile.jsonl), and print a summary at the end"
+    )
+    parser.add_argument("--rebuild", action="store_true",
+        help="Rebuild all outputs, even those the scan's manifest lists as up to date"
+    )
+    parser.add_argument("--from_zip", action="store_true",
+        help="Read images and camera parameters directly from the scan's ZIP files instead of extracted folders"
+    )
+    parser.add_argument("--fused", action="store_true",
+        help="Stitch all view based types of a location in one pass"
+    )
+    parser.add_argument("--workers", type=int, default=1,
+        help="Number of processes stitching panorama locations in parallel, more than one implies --fused"
+    )
+    parser.add_argument("--backend", choices=['numpy', 'numba'], default='numpy',
+        help="Stitching backend for color and depth, numba needs Numba installed"
+    )
+    parser.add_argument("--remap_cache_dir", type=str,
+        help="Directory for view remap tables kept between runs, so that re-runs of a scan reuse them "
+            "(default: none, tables are only shared in memory between the types of a location). "
+            "The directory is not size limited, about 6 MB per location at width 1024"
+    )
     return parser.parse_known_args(args)
 
 if __name__ == "__main__":
     args, _ = parse_arguments(sys.argv)
-    equirect_size = [args.out_width, args.out_width // 2]
+    out_widths = sorted(set(args.out_width))
+    equirect_size = [out_widths[-1], out_widths[-1] // 2]
     if not os.path.exists(args.out_path):
         os.mkdir(args.out_path)
+    for item in args.codec:
+        file_type, _, spec = item.partition("=")
+        if file_type not in output_codecs:
+            raise ValueError("unknown type {} in --codec {}".format(file_type, item))
+        panowriter.check_codec(spec, output_dtype(file_type))
+        output_codecs[file_type] = spec
+    if args.backend == 'numba' and not panokernel.available():
+        log.warning("Numba is not installed, stitching with the NumPy backend")
+    createpano.stitch_backend = args.backend
+    createpano.remap_cache_dir = args.remap_cache_dir
     scan_id_list = []
     if not(args.scan_id==None):
         scan_id_list = tqdm.tqdm([args.scan_id], desc="Dataset Progress")
@@ -264,5 +802,19 @@ if __name__ == "__main__":
         scan_id_list = tqdm.tqdm(test_id_list, desc="Dataset Progress")
     else: 
         scan_id_list = tqdm.tqdm(os.listdir(args.m3d_path), desc="Dataset Progress")
+    if args.profile is not None:
+        profiling.start(args.profile if args.profile else os.path.join(args.out_path, "profile.jsonl"))
+    shards = None
+    if args.shards:
+        shards = panoshards.ShardWriter(os.path.join(args.out_path, "shards"), args.shard_size)
+    writer = panowriter.PanoWriter(args.writer_threads)
     for scan_id in scan_id_list:
-        process_scan(args.m3d_path, args.out_path, scan_id, args.types, args.unpack, args.warp_depth)
+        process_scan(args.m3d_path, args.out_path, scan_id, args.types, args.unpack, args.warp_depth, args.feather, args.fused, args.workers, args.from_zip, args.rebuild, shards, writer)
+    writer.close()
+    if shards is not None:
+        shards.close()
+    elif len(writer.stats) > 0:
+        tqdm.tqdm.write(writer.summary())
+    if profiling.active() is not None:
+        tqdm.tqdm.write(profiling.active().summary())
+        profiling.stop()
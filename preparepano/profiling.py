@@ -0,0 +1,213 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# per-stage profiling of the panorama pipeline. Code is instrumented with
+#
+#   with profiling.stage("decode") as s:
+#       ...
+#       s.read += nbytes
+#
+# which, once start() was called, records wall and CPU (thread) time and the
+# bytes read and written of the stage. Stages run inside a location() are
+# summed up per location and written as one line of the JSON-lines trace
+# together with the peak RSS of the process; other stages (e.g. encoding on
+# writer threads) get a trace line of their own. Stage names with a dot are
+# part of the stage before the dot, e.g. stitch.remap is inside stitch,
+# the summary lists them after it.
+# Without start() stage() returns a shared no-op object.
+
+import collections
+import json
+import os
+import threading
+import time
+import typing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# peak resident set size of this process in bytes, 0 where unknown
+def peak_rss() -> int:
+    if resource is None:
+        return 0
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class _NullStage:
+    __slots__ = ("read", "written")
+
+    def __init__(self):
+        self.read = 0
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        # values added while profiling is off are dropped
+        self.read = 0
+        self.written = 0
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    __slots__ = ("profiler", "name", "info", "read", "written", "wall", "cpu")
+
+    def __init__(self, profiler: 'Profiler', name: str, info: dict):
+        self.profiler = profiler
+        self.name = name
+        self.info = info
+        self.read = 0
+        self.written = 0
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.profiler._record(self, time.perf_counter() - self.wall, time.thread_time() - self.cpu)
+
+def _empty() -> typing.List[float]:
+    # calls, wall, cpu, read, written
+    return [0, 0.0, 0.0, 0, 0]
+
+def _add(stats: dict, name: str, values: typing.List[float]) -> None:
+    total = stats.setdefault(name, _empty())
+    for i, value in enumerate(values):
+        total[i] += value
+
+def _stages_json(stats: dict) -> dict:
+    return {name: {"calls": calls, "wall": round(wall, 6), "cpu": round(cpu, 6), "read": read, "written": written}
+        for name, (calls, wall, cpu, read, written) in stats.items()}
+
+class Profiler:
+    # trace is the file name of the JSON-lines trace, None keeps records in
+    # memory only (worker processes hand them to the parent, see merge)
+    def __init__(self, trace: str = None):
+        self.trace = open(trace, 'w') if trace is not None else None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.totals = collections.OrderedDict()
+        self.locations = 0
+        self.worker_rss = 0
+        self.start = time.perf_counter()
+
+    def _write(self, record: dict) -> None:
+        if self.trace is not None:
+            self.trace.write(json.dumps(record) + "\n")
+
+    def _record(self, stage: _Stage, wall: float, cpu: float) -> None:
+        values = [1, wall, cpu, stage.read, stage.written]
+        location = getattr(self.local, "stats", None)
+        with self.lock:
+            _add(self.totals, stage.name, values)
+            if location is not None:
+                _add(location, stage.name, values)
+            else:
+                record = {"event": "stage", "stage": stage.name, "wall": round(wall, 6), "cpu": round(cpu, 6),
+                    "read": stage.read, "written": stage.written, "thread": threading.current_thread().name}
+                record.update(stage.info)
+                self._write(record)
+
+    def stage(self, name: str, **info) -> _Stage:
+        return _Stage(self, name, info)
+
+    # stages of the calling thread within the block are summed up in the
+    # yielded record, which is complete (and written) when the block ends
+    def location(self, **info) -> '_Location':
+        return _Location(self, info)
+
+    # add the location record of a worker process
+    def merge(self, record: dict) -> None:
+        with self.lock:
+            for name, s in record["stages"].items():
+                _add(self.totals, name, [s["calls"], s["wall"], s["cpu"], s["read"], s["written"]])
+            self.locations += 1
+            self.worker_rss = max(self.worker_rss, record["rss_peak"])
+            self._write(record)
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        lines = ["{:<22} {:>7} {:>9} {:>9} {:>6} {:>9} {:>9}".format(
+            "stage", "calls", "wall s", "cpu s", "wall%", "MB read", "MB wrote")]
+        with self.lock:
+            for name, (calls, wall, cpu, read, written) in sorted(self.totals.items()):
+                lines.append("{:<22} {:>7d} {:>9.2f} {:>9.2f} {:>6.1f} {:>9.1f} {:>9.1f}".format(
+                    name, calls, wall, cpu, 100 * wall / elapsed, read / 2**20, written / 2**20))
+        rss = "peak RSS {:.0f} MB".format(peak_rss() / 2**20)
+        if self.worker_rss > 0:
+            rss += ", workers {:.0f} MB".format(self.worker_rss / 2**20)
+        lines.append("{} locations in {:.2f}s, {}".format(self.locations, elapsed, rss))
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        if self.trace is not None:
+            self.trace.write(json.dumps({"event": "summary", "wall": round(time.perf_counter() - self.start, 6),
+                "rss_peak": peak_rss(), "worker_rss_peak": self.worker_rss,
+                "stages": _stages_json(self.totals)}) + "\n")
+            self.trace.close()
+            self.trace = None
+
+class _Location:
+    def __init__(self, profiler: Profiler, info: dict):
+        self.profiler = profiler
+        self.record = {"event": "location"}
+        self.record.update(info)
+
+    def __enter__(self) -> dict:
+        self.profiler.local.stats = collections.OrderedDict()
+        self.wall = time.perf_counter()
+        return self.record
+
+    def __exit__(self, *exc) -> None:
+        profiler = self.profiler
+        stats = profiler.local.stats
+        profiler.local.stats = None
+        self.record.update({"wall": round(time.perf_counter() - self.wall, 6), "pid": os.getpid(),
+            "rss_peak": peak_rss(), "stages": _stages_json(stats)})
+        with profiler.lock:
+            profiler.locations += 1
+            profiler._write(self.record)
+
+_profiler = None
+
+def start(trace: str = None) -> Profiler:
+    global _profiler
+    _profiler = Profiler(trace)
+    return _profiler
+
+def stop() -> None:
+    global _profiler
+    if _profiler is not None:
+        _profiler.close()
+    _profiler = None
+
+def active() -> typing.Optional[Profiler]:
+    return _profiler
+
+def stage(name: str, **info):
+    if _profiler is None:
+        return _NULL_STAGE
+    return _profiler.stage(name, **info)
+
+class _NullLocation:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+_NULL_LOCATION = _NullLocation()
+
+def location(**info):
+    if _profiler is None:
+        return _NULL_LOCATION
+    return _profiler.location(**info)
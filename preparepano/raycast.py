@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# class, instance and radial depth panoramas cast directly from the house
+# mesh, one ray per equirectangular pixel from the panorama center, without
+# rendering and stitching views. The rays follow panogeometry (the frame of
+# the stitched panoramas), the colors and the front face rule segmaps, but
+# all faces occlude: a ray ending on a face of no object is background in
+# the label panoramas and still has depth.
+#
+# The mesh is put into a bounding volume hierarchy once per house: a
+# complete binary tree over leaves of leaf_size triangles, split at the
+# median of the triangle centroids. Batches of rays walk it together, one
+# node per ray and step, see BVH.intersect.
+#
+#   python raycast.py --m3d_path <root> --scan_id <scan_id> --categories metadata/category_mapping.tsv --out_path <out_path>
+
+import argparse
+import concurrent.futures
+import io
+import os
+import sys
+import typing
+import numpy as np
+import tqdm
+from PIL import Image
+
+import panogeometry
+import prepare_matterport
+import segmaps
+
+OUTPUT_FOLDERS = {
+    'classes': 'segmentation_maps_classes',
+    'instances': 'segmentation_maps_instances',
+    'depth': 'mesh_depth_images'
+}
+
+class BVH:
+    def __init__(self, vertices: np.array, faces: np.array, leaf_size: int = 8):
+        triangles = vertices[faces]
+        centroids = triangles.mean(axis=1)
+        self.leaf_size = leaf_size
+        self.depth = max(0, int(np.ceil(np.log2(max(1, -(-len(faces) // leaf_size))))))
+        # padded with copies of the last triangle, which can only repeat its hit
+        order = np.concatenate([np.arange(len(faces)), np.full((leaf_size << self.depth) - len(faces), len(faces) - 1)])
+        # top down, all nodes of a level at once: the triangles of a node are
+        # split in halves at the median of their centroids along the axis of
+        # largest extent
+        for level in range(self.depth):
+            nodes = order.reshape(1 << level, -1)
+            c = centroids[nodes]
+            axis = np.argmax(c.max(axis=1) - c.min(axis=1), axis=1)
+            key = np.take_along_axis(c, axis[:,np.newaxis,np.newaxis], axis=2)[:,:,0]
+            half = nodes.shape[1] // 2
+            split = np.argpartition(key, half - 1, axis=1)
+            order = np.take_along_axis(nodes, split, axis=1).reshape(-1)
+        self.faces = order
+        triangles = triangles[order]
+        self.v0 = triangles[:,0]
+        self.e1 = triangles[:,1] - triangles[:,0]
+        self.e2 = triangles[:,2] - triangles[:,0]
+        # node bounds in heap order: the root is node 1, the children of
+        # node i are 2 i and 2 i + 1, leaf k is node 2^depth + k
+        nleaves = 1 << self.depth
+        lo = np.zeros((2 * nleaves, 3))
+        hi = np.zeros((2 * nleaves, 3))
+        leaves = triangles.reshape(nleaves, leaf_size * 3, 3)
+        lo[nleaves:] = leaves.min(axis=1)
+        hi[nleaves:] = leaves.max(axis=1)
+        for level in range(self.depth - 1, -1, -1):
+            first, last = 1 << level, 2 << level
+            lo[first:last] = np.minimum(lo[2 * first:2 * last:2], lo[2 * first + 1:2 * last:2])
+            hi[first:last] = np.maximum(hi[2 * first:2 * last:2], hi[2 * first + 1:2 * last:2])
+        # bounds of the two children of node i, (N, 2, [lo, hi], 3)
+        self.children = np.stack([lo, hi], axis=1).reshape(nleaves, 2, 2, 3)
+
+    # distance at which rays (origin, inverse directions inv) enter the
+    # boxes of the two children of nodes, inf where they miss them or only
+    # after limit
+    def _boxes(self, origin: np.array, inv: np.array, nodes: np.array, limit: np.array) -> np.array:
+        with np.errstate(invalid='ignore'):
+            t = (self.children[nodes] - origin) * inv[:,np.newaxis,np.newaxis,:]
+        # nan for rays parallel to a box face through its plane, ignored
+        tmin, tmax = np.fmin(t[:,:,0], t[:,:,1]), np.fmax(t[:,:,0], t[:,:,1])
+        tnear = np.maximum(np.fmax(np.fmax(tmin[:,:,0], tmin[:,:,1]), tmin[:,:,2]), 0)
+        tfar = np.fmin(np.fmin(tmax[:,:,0], tmax[:,:,1]), tmax[:,:,2])
+        return np.where((tnear <= tfar) & (tnear < limit[:,np.newaxis]), tnear, np.inf)
+
+    # closest front facing hit per ray from origin along dirs (N, 3): face
+    # index (-1 for none) and distance. Every ray walks the tree depth first
+    # with a stack of (node, entry distance), nearer child on top, all rays
+    # one step per iteration; nodes entered beyond the closest hit so far
+    # are skipped.
+    def intersect(self, origin: np.array, dirs: np.array) -> typing.Tuple[np.array, np.array]:
+        with np.errstate(divide='ignore'):
+            inv = 1 / dirs
+        count = len(dirs)
+        best = np.full(count, np.inf)
+        hits = np.full(count, -1, np.int64)
+        stack = np.zeros((count, self.depth + 2), np.int64)
+        stack_t = np.zeros((count, self.depth + 2))
+        stack[:,0] = 1
+        sp = np.ones(count, np.int64)
+        first_leaf = 1 << self.depth
+        slots = np.arange(self.leaf_size)
+        active = np.arange(count)
+        while len(active) > 0:
+            sp[active] -= 1
+            nodes = stack[active, sp[active]]
+            tnear = stack_t[active, sp[active]]
+            keep = tnear < best[active]
+            rays, nodes = active[keep], nodes[keep]
+            leaf = nodes >= first_leaf
+            if np.any(leaf):
+                r = rays[leaf]
+                tri = (nodes[leaf, np.newaxis] - first_leaf) * self.leaf_size + slots
+                t = self._triangles(origin, dirs[r,np.newaxis], tri)
+                j = np.argmin(t, axis=1)
+                t = t[np.arange(len(r)), j]
+                closer = t < best[r]
+                best[r[closer]] = t[closer]
+                hits[r[closer]] = self.faces[tri[closer, j[closer]]]
+            r, n = rays[~leaf], nodes[~leaf]
+            t = self._boxes(origin, inv[r], n, best[r])
+            t0, t1 = t[:,0], t[:,1]
+            # push the farther child first
+            swap = t1 > t0
+            far, near = np.where(swap, 2 * n + 1, 2 * n), np.where(swap, 2 * n, 2 * n + 1)
+            tfar, tnear = np.maximum(t0, t1), np.minimum(t0, t1)
+            for child, t in ((far, tfar), (near, tnear)):
+                m = np.isfinite(t)
+                rm = r[m]
+                stack[rm, sp[rm]] = child[m]
+                stack_t[rm, sp[rm]] = t[m]
+                sp[rm] += 1
+            active = active[sp[active] > 0]
+        return hits, best
+
+    # Moeller-Trumbore distances of rays (N, 1, 3) to triangles (N, L), inf
+    # for misses and back faces
+    def _triangles(self, origin: np.array, d: np.array, tri: np.array) -> np.array:
+        e1, e2 = self.e1[tri], self.e2[tri]
+        d = np.broadcast_to(d, e1.shape)
+        p = _cross(d, e2)
+        det = np.einsum('ijk,ijk->ij', e1, p)
+        # front faces (counter-clockwise towards the ray origin) only
+        valid = det > 1e-12
+        inv = 1 / np.where(valid, det, 1)
+        s = origin - self.v0[tri]
+        u = np.einsum('ijk,ijk->ij', s, p) * inv
+        q = _cross(s, e1)
+        v = np.einsum('ijk,ijk->ij', d, q) * inv
+        t = np.einsum('ijk,ijk->ij', e2, q) * inv
+        valid &= (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 0)
+        return np.where(valid, t, np.inf)
+
+# cross product over the last axis, without the overhead of np.cross
+def _cross(a: np.array, b: np.array) -> np.array:
+    c = np.empty(np.broadcast_shapes(a.shape, b.shape))
+    c[...,0] = a[...,1] * b[...,2] - a[...,2] * b[...,1]
+    c[...,1] = a[...,2] * b[...,0] - a[...,0] * b[...,2]
+    c[...,2] = a[...,0] * b[...,1] - a[...,1] * b[...,0]
+    return c
+
+# state of the worker processes
+_scene = None
+
+def _init_worker(scene: BVH) -> None:
+    global _scene
+    _scene = scene
+
+def _cast_rows(origin: np.array, dirs: np.array, batch: int) -> typing.Tuple[np.array, np.array]:
+    hits = np.empty(len(dirs), np.int64)
+    dist = np.empty(len(dirs))
+    for start in range(0, len(dirs), batch):
+        hits[start:start + batch], dist[start:start + batch] = _scene.intersect(origin, dirs[start:start + batch])
+    return hits, dist
+
+# face index and distance (H, W) per pixel of the panorama (transform as of
+# panogeometry.pano_to_world), cast in chunks of rows on the workers
+def cast_panorama(
+    transform: np.array,
+    size: typing.Tuple[int, int],
+    executor: concurrent.futures.Executor = None,
+    rows: int = 16,
+    batch: int = 16384
+) -> typing.Tuple[np.array, np.array]:
+    width, height = size
+    dirs = panogeometry.ray_table(width, height).reshape(-1, 3).astype(np.float64) @ transform[0:3,0:3].T
+    origin = transform[0:3,3]
+    chunks = [(origin, dirs[r * width:(r + rows) * width], batch) for r in range(0, height, rows)]
+    if executor is None:
+        results = [_cast_rows(*chunk) for chunk in chunks]
+    else:
+        results = list(executor.map(_cast_rows, *zip(*chunks)))
+    hits = np.concatenate([r[0] for r in results]).reshape(height, width)
+    dist = np.concatenate([r[1] for r in results]).reshape(height, width)
+    return hits, dist
+
+def cast_scan(
+    m3d_path: str,
+    scan_id: str,
+    categories: typing.Tuple[dict, dict],
+    out_dir: str,
+    types: typing.List[str],
+    size: typing.Tuple[int, int],
+    workers: int = 1,
+    from_zip: bool = False,
+    leaf_size: int = 8
+) -> int:
+    house = segmaps.House(prepare_matterport.ScanFolder(m3d_path, scan_id, "house_segmentations", from_zip), scan_id, categories)
+    scene = BVH(house.vertices, house.faces, leaf_size)
+    folder = prepare_matterport.camera_params_folder(m3d_path, scan_id, from_zip)
+    with io.TextIOWrapper(folder.open(scan_id + ".conf")) as f:
+        index = prepare_matterport.parse_camera_index(f)
+    for t in types:
+        os.makedirs(os.path.join(out_dir, OUTPUT_FOLDERS[t]), exist_ok=True)
+    executor = None
+    if workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(scene,))
+    else:
+        _init_worker(scene)
+    try:
+        for record in tqdm.tqdm(index, desc="Locations"):
+            transform = panogeometry.pano_to_world(record['extrinsics'], record['angles'], record['valid'])
+            hits, dist = cast_panorama(transform, size, executor)
+            classes, instances = house.colors(hits)
+            outputs = {
+                'classes': classes,
+                'instances': instances,
+                'depth': np.where(hits >= 0, np.minimum(np.round(dist * panogeometry.DEPTH_SCALE), 65535), 0).astype(np.uint16)
+            }
+            for t in types:
+                Image.fromarray(outputs[t]).save(os.path.join(out_dir, OUTPUT_FOLDERS[t], str(record['location']) + ".png"))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return len(index)
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="Cast label and depth panoramas from the Matterport house meshes")
+    parser.add_argument("--m3d_path", type=str, required=True,
+        help="Input Matterport3D root path"
+    )
+    parser.add_argument("--scan_id", type=str, nargs='+', required=True,
+        help="Scans to process"
+    )
+    parser.add_argument("--categories", type=str, required=True,
+        help="Category mapping of the dataset (metadata/category_mapping.tsv)"
+    )
+    parser.add_argument("--out_path", type=str, required=True,
+        help="Output path, panoramas are written to <out_path>/<scan_id>/<type folder>/<location>.png"
+    )
+    parser.add_argument("--out_width", type=int, default=1024,
+        help="Output equirectangular width"
+    )
+    parser.add_argument("--types", nargs='+', default=['classes', 'instances', 'depth'],
+        choices=['classes', 'instances', 'depth'],
+        help="Which panoramas to write, depth in 0.25 mm units to " + OUTPUT_FOLDERS['depth']
+    )
+    parser.add_argument("--workers", type=int, default=1,
+        help="Number of processes casting chunks of rows in parallel"
+    )
+    parser.add_argument("--leaf_size", type=int, default=8,
+        help="Triangles per leaf of the bounding volume hierarchy"
+    )
+    parser.add_argument("--from_zip", action="store_true",
+        help="Read the house segmentations and camera parameters from the scan's ZIP files"
+    )
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    args = parse_arguments(sys.argv[1:])
+    categories = segmaps.read_categories(args.categories)
+    for scan_id in args.scan_id:
+        count = cast_scan(args.m3d_path, scan_id, categories, os.path.join(args.out_path, scan_id), args.types,
+            (args.out_width, args.out_width // 2), args.workers, args.from_zip, args.leaf_size)
+        print("{}: {} panoramas".format(scan_id, count))
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# headless replacement of mpview -seg_maps: renders the class and instance
+# segmentation maps of all views of a house from the house mesh, its face
+# segments and objects (house_segmentations) and the views of the .conf.
+# Like mpview only the faces of objects are drawn, front faces only, with
+# the class color of the object's mpcat40 index and the instance color of
+# its index + 1 from the mpview color table, on a black background. Both
+# maps come from one z-buffer pass per view, written as
+#
+#   segmentation_maps_classes/<loc>_c<row>_<ori>.png
+#   segmentation_maps_instances/<loc>_i<row>_<ori>.png
+#
+# in the scan folder, where prepare_matterport reads them:
+#
+#   python segmaps.py --m3d_path <root> --scan_id <scan_id> --categories metadata/category_mapping.tsv
+
+import argparse
+import io
+import json
+import os
+import sys
+import typing
+import numpy as np
+import tqdm
+from PIL import Image
+
+import prepare_matterport
+
+# color table of mpview (LoadColor), 8 bit values as in
+# convert_coco/matterport_coco.loadMP40
+COLORTABLE = np.array([
+    [0.5, 0.5, 0.5], [1, 0, 0], [0, 0, 1],
+    [0, 1, 0], [0, 1, 1], [1, 0, 1],
+    [1, 0.5, 0], [0, 1, 0.5], [0.5, 0, 1],
+    [0.5, 1, 0], [0, 0.5, 1], [1, 0, 0.5],
+    [0.5, 0, 0], [0, 0.5, 0], [0, 0, 0.5],
+    [0.5, 0.5, 0], [0, 0.5, 0.5], [0.5, 0, 0.5],
+    [0.7, 0, 0], [0, 0.7, 0], [0, 0, 0.7],
+    [0.7, 0.7, 0], [0, 0.7, 0.7], [0.7, 0, 0.7],
+    [0.7, 0.3, 0], [0, 0.7, 0.3], [0.3, 0, 0.7],
+    [0.3, 0.7, 0], [0, 0.3, 0.7], [0.7, 0, 0.3],
+    [0.3, 0, 0], [0, 0.3, 0], [0, 0, 0.3],
+    [0.3, 0.3, 0], [0, 0.3, 0.3], [0.3, 0, 0.3],
+    [1, 0.3, 0.3], [0.3, 1, 0.3], [0.3, 0.3, 1],
+    [1, 1, 0.3], [0.3, 1, 1], [1, 0.3, 1],
+    [1, 0.5, 0.3], [0.3, 1, 0.5], [0.5, 0.3, 1],
+    [0.5, 1, 0.3], [0.3, 0.5, 1], [1, 0.3, 0.5],
+    [0.5, 0.3, 0.3], [0.3, 0.5, 0.3], [0.3, 0.3, 0.5],
+    [0.5, 0.5, 0.3], [0.3, 0.5, 0.5], [0.5, 0.3, 0.5],
+    [0.3, 0.5, 0.5], [0.5, 0.3, 0.5], [0.5, 0.5, 0.3],
+    [0.3, 0.3, 0.5], [0.5, 0.3, 0.3], [0.3, 0.5, 0.3],
+    [0.3, 0.8, 0.5], [0.5, 0.3, 0.8], [0.8, 0.5, 0.3],
+    [0.8, 0.3, 0.5], [0.5, 0.8, 0.3], [0.3, 0.5, 0.8],
+    [0.8, 0.5, 0.5], [0.5, 0.8, 0.5], [0.5, 0.5, 0.8],
+    [0.8, 0.8, 0.5], [0.5, 0.8, 0.8], [0.8, 0.5, 0.8]
+])
+
+# colors (N, 3) uint8 of the color indices k of mpview's LoadColor(k)
+def label_colors(k: np.array) -> np.array:
+    k = np.asarray(k)
+    index = np.where(k == 0, 0, 1 + np.mod(k, len(COLORTABLE) - 1))
+    return (255 * COLORTABLE[index]).astype(np.uint8)
+
+# triangles closer to the camera than this (in meters) are not drawn
+NEAR = 0.05
+
+_PLY_TYPES = {
+    "char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4", "double": "f8", "float64": "f8"
+}
+
+# vertex positions (N, 3) and triangles (M, 3) of a binary little endian PLY
+def read_ply(f: typing.BinaryIO) -> typing.Tuple[np.array, np.array]:
+    elements = []
+    line = f.readline().strip()
+    if line != b"ply":
+        raise ValueError("not a PLY file")
+    while line != b"end_header":
+        line = f.readline()
+        if not line:
+            raise ValueError("PLY header without end_header")
+        parts = line.decode("ascii").split()
+        line = line.strip()
+        if parts[0] == "format" and parts[1] != "binary_little_endian":
+            raise ValueError("PLY format {} is not supported".format(parts[1]))
+        elif parts[0] == "element":
+            elements.append((parts[1], int(parts[2]), []))
+        elif parts[0] == "property" and parts[1] == "list":
+            # faces are read as triangles, the count is checked below
+            elements[-1][2].extend([("count_" + parts[4], "<" + _PLY_TYPES[parts[2]]),
+                (parts[4], "<" + _PLY_TYPES[parts[3]], (3,))])
+        elif parts[0] == "property":
+            elements[-1][2].append((parts[2], "<" + _PLY_TYPES[parts[1]]))
+    data = f.read()
+    offset = 0
+    arrays = {}
+    for name, count, fields in elements:
+        dtype = np.dtype(fields)
+        arrays[name] = np.frombuffer(data, dtype, count, offset)
+        offset += count * dtype.itemsize
+    vertex, face = arrays["vertex"], arrays["face"]
+    indices = "vertex_indices" if "vertex_indices" in face.dtype.names else "vertex_index"
+    if np.any(face["count_" + indices] != 3):
+        raise ValueError("only triangle meshes are supported")
+    vertices = np.stack([vertex['x'], vertex['y'], vertex['z']], axis=1).astype(np.float64)
+    return vertices, face[indices].astype(np.int64)
+
+# mpcat40 index per raw category name and per category index, from the
+# Matterport category_mapping.tsv
+def read_categories(filename: str) -> typing.Tuple[dict, dict]:
+    by_name, by_index = {}, {}
+    with open(filename, 'r') as f:
+        keys = f.readline().rstrip("\n").split("\t")
+        for line in f:
+            values = dict(zip(keys, line.rstrip("\n").split("\t")))
+            if not values.get("mpcat40index"):
+                continue
+            by_name[values["raw_category"]] = int(values["mpcat40index"])
+            by_index[int(values["index"])] = int(values["mpcat40index"])
+    return by_name, by_index
+
+# object index per face (-1 for faces of no object) and mpcat40 index per
+# object (0 without a known category) from the face segments and objects
+def face_objects(seg_indices: np.array, groups: list, categories: typing.Tuple[dict, dict]) -> typing.Tuple[np.array, np.array]:
+    by_name, by_index = categories
+    segment_object = {}
+    classes = np.zeros(len(groups), np.int64)
+    for i, group in enumerate(groups):
+        if "label" in group:
+            classes[i] = by_name.get(group["label"], 0)
+        elif "label_index" in group:
+            classes[i] = by_index.get(int(group["label_index"]), 0)
+        # faces of segments in several objects are drawn by the first
+        for segment in group.get("segments", []):
+            segment_object.setdefault(int(segment), i)
+    segment_ids, inverse = np.unique(seg_indices, return_inverse=True)
+    objects = np.array([segment_object.get(int(s), -1) for s in segment_ids], np.int64)
+    return objects[inverse], classes
+
+# index (H, W) of the closest front facing triangle per pixel, -1 where none,
+# for a camera (looking along -z, y up) with the given camera to world
+# matrix and intrinsics. Triangles are binned by the size of their bounding
+# box, the pixels of each bin are tested at once and merged into the z-buffer
+# (inverse depth, interpolated linearly in the image) in chunks of at most
+# chunk pixels.
+def rasterize(
+    vertices: np.array,
+    faces: np.array,
+    extrinsics: np.array,
+    intrinsics: np.array,
+    width: int,
+    height: int,
+    chunk: int = 1 << 21
+) -> np.array:
+    cam = (vertices - extrinsics[0:3,3]) @ extrinsics[0:3,0:3]
+    z = -cam[:,2]
+    # drop triangles near or behind the camera before projecting
+    keep = np.all(z[faces] > NEAR, axis=1)
+    tri = np.nonzero(keep)[0]
+    f = faces[tri]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = intrinsics[0,0] * cam[:,0] / z + intrinsics[0,2]
+        v = intrinsics[1,2] - intrinsics[1,1] * cam[:,1] / z
+    x0, x1, x2 = u[f[:,0]], u[f[:,1]], u[f[:,2]]
+    y0, y1, y2 = v[f[:,0]], v[f[:,1]], v[f[:,2]]
+    # counter-clockwise in the y-up window of OpenGL is clockwise here
+    area = (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)
+    # pixels whose centers (i + 0.5) lie in the bounding box
+    xmin = np.maximum(np.ceil(np.minimum(np.minimum(x0, x1), x2) - 0.5), 0)
+    xmax = np.minimum(np.floor(np.maximum(np.maximum(x0, x1), x2) - 0.5), width - 1)
+    ymin = np.maximum(np.ceil(np.minimum(np.minimum(y0, y1), y2) - 0.5), 0)
+    ymax = np.minimum(np.floor(np.maximum(np.maximum(y0, y1), y2) - 0.5), height - 1)
+    keep = (area < 0) & (xmin <= xmax) & (ymin <= ymax)
+    tri, x0, x1, x2, y0, y1, y2, area = (a[keep] for a in (tri, x0, x1, x2, y0, y1, y2, area))
+    xmin, xmax, ymin, ymax = (a[keep].astype(np.int64) for a in (xmin, xmax, ymin, ymax))
+    iz0, iz1, iz2 = (1 / z[faces[tri, i]] for i in range(3))
+
+    # barycentric coordinates and inverse depth as planes a x + b y + c
+    a0, b0, c0 = (y1 - y2) / area, (x2 - x1) / area, (x1 * y2 - x2 * y1) / area
+    a1, b1, c1 = (y2 - y0) / area, (x0 - x2) / area, (x2 * y0 - x0 * y2) / area
+    az = a0 * (iz0 - iz2) + a1 * (iz1 - iz2)
+    bz = b0 * (iz0 - iz2) + b1 * (iz1 - iz2)
+    cz = c0 * (iz0 - iz2) + c1 * (iz1 - iz2) + iz2
+    planes = np.stack([a0, b0, c0, a1, b1, c1, az, bz, cz], axis=1)
+
+    zbuf = np.zeros(width * height)
+    ids = np.full(width * height, -1, np.int64)
+    # bins of power of two width and height
+    bw = np.ceil(np.log2(xmax - xmin + 1)).astype(np.int64)
+    bh = np.ceil(np.log2(ymax - ymin + 1)).astype(np.int64)
+    bins = bw * 32 + bh
+    order = np.argsort(bins, kind='stable')
+    starts = np.flatnonzero(np.diff(bins[order], prepend=-1))
+    for start, end in zip(starts, np.append(starts[1:], len(order))):
+        sw, sh = 1 << int(bw[order[start]]), 1 << int(bh[order[start]])
+        ox, oy = np.tile(np.arange(sw), sh), np.repeat(np.arange(sh), sw)
+        step = max(1, chunk // (sw * sh))
+        for s in range(start, end, step):
+            sel = order[s:min(end, s + step)]
+            px = xmin[sel,np.newaxis] + ox
+            py = ymin[sel,np.newaxis] + oy
+            cx, cy = px + 0.5, py + 0.5
+            p = planes[sel,:,np.newaxis]
+            w0 = p[:,0] * cx + p[:,1] * cy + p[:,2]
+            w1 = p[:,3] * cx + p[:,4] * cy + p[:,5]
+            inside = (px <= xmax[sel,np.newaxis]) & (py <= ymax[sel,np.newaxis]) & (w0 >= 0) & (w1 >= 0) & (w0 + w1 <= 1)
+            k, j = np.nonzero(inside)
+            pix = py[k, j] * width + px[k, j]
+            iz = p[k,6,0] * cx[k, j] + p[k,7,0] * cy[k, j] + p[k,8,0]
+            # closest fragment per pixel of the chunk, then against the buffer
+            first = np.lexsort((-iz, pix))
+            pix, iz, k = pix[first], iz[first], k[first]
+            unique = np.ones(len(pix), bool)
+            unique[1:] = pix[1:] != pix[:-1]
+            pix, iz, k = pix[unique], iz[unique], k[unique]
+            closer = iz > zbuf[pix]
+            zbuf[pix[closer]] = iz[closer]
+            ids[pix[closer]] = tri[sel[k[closer]]]
+    return ids.reshape(height, width)
+
+class House:
+    # mesh, segments and objects of house_segmentations, with the object
+    # index per face (-1 for faces of no object)
+    def __init__(self, folder: prepare_matterport.ScanFolder, scan_id: str, categories: typing.Tuple[dict, dict]):
+        with folder.open(scan_id + ".ply") as f:
+            self.vertices, faces = read_ply(f)
+        with folder.open(scan_id + ".fsegs.json") as f:
+            seg_indices = np.array(json.load(f)["segIndices"], np.int64)
+        with folder.open(scan_id + ".semseg.json") as f:
+            groups = json.load(f)["segGroups"]
+        if len(seg_indices) != len(faces):
+            raise ValueError("{} face segments for {} faces".format(len(seg_indices), len(faces)))
+        self.faces = faces
+        self.objects, classes = face_objects(seg_indices, groups, categories)
+        # the faces drawn into the views
+        self.drawn = np.nonzero(self.objects >= 0)[0]
+        # colors per object, the background (index -1) is black
+        self.class_colors = np.concatenate([label_colors(classes), np.zeros((1, 3), np.uint8)])
+        self.instance_colors = np.concatenate([label_colors(np.arange(len(groups)) + 1), np.zeros((1, 3), np.uint8)])
+
+    # class and instance map (H, W, 3) of one view
+    def render(self, extrinsics: np.array, intrinsics: np.array, width: int, height: int) -> typing.Tuple[np.array, np.array]:
+        ids = rasterize(self.vertices, self.faces[self.drawn], extrinsics, intrinsics, width, height)
+        return self.colors(np.where(ids >= 0, self.drawn[ids], -1))
+
+    # class and instance colors of face indices, black for -1
+    def colors(self, faces: np.array) -> typing.Tuple[np.array, np.array]:
+        objects = np.where(faces >= 0, self.objects[faces], -1)
+        return self.class_colors[objects], self.instance_colors[objects]
+
+def render_scan(
+    m3d_path: str,
+    scan_id: str,
+    categories: typing.Tuple[dict, dict],
+    out_dir: str,
+    size: typing.Tuple[int, int] = (1280, 1024),
+    from_zip: bool = False
+) -> int:
+    house = House(prepare_matterport.ScanFolder(m3d_path, scan_id, "house_segmentations", from_zip), scan_id, categories)
+    folder = prepare_matterport.camera_params_folder(m3d_path, scan_id, from_zip)
+    with io.TextIOWrapper(folder.open(scan_id + ".conf")) as f:
+        index = prepare_matterport.parse_camera_index(f)
+    for name in ("segmentation_maps_classes", "segmentation_maps_instances"):
+        os.makedirs(os.path.join(out_dir, name), exist_ok=True)
+    count = 0
+    for record in tqdm.tqdm(index, desc="Locations"):
+        for row, ori in zip(*np.nonzero(record['valid'])):
+            classes, instances = house.render(record['extrinsics'][row, ori], record['intrinsics'][row, ori], size[0], size[1])
+            view = "{}_{}{}_{}.png"
+            Image.fromarray(classes).save(os.path.join(out_dir, "segmentation_maps_classes",
+                view.format(record['location'], "c", row, ori)))
+            Image.fromarray(instances).save(os.path.join(out_dir, "segmentation_maps_instances",
+                view.format(record['location'], "i", row, ori)))
+            count += 1
+    return count
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="Render class and instance segmentation maps of the Matterport views")
+    parser.add_argument("--m3d_path", type=str, required=True,
+        help="Input Matterport3D root path"
+    )
+    parser.add_argument("--scan_id", type=str, nargs='+', required=True,
+        help="Scans to render"
+    )
+    parser.add_argument("--categories", type=str, required=True,
+        help="Category mapping of the dataset (metadata/category_mapping.tsv)"
+    )
+    parser.add_argument("--out_path", type=str,
+        help="Root for the maps, written to <out_path>/<scan_id>/<scan_id>/segmentation_maps_* "
+             "(default: the scan folders in m3d_path)"
+    )
+    parser.add_argument("--size", type=int, nargs=2, default=[1280, 1024], metavar=("WIDTH", "HEIGHT"),
+        help="Size of the views"
+    )
+    parser.add_argument("--from_zip", action="store_true",
+        help="Read the house segmentations and camera parameters from the scan's ZIP files"
+    )
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    args = parse_arguments(sys.argv[1:])
+    categories = read_categories(args.categories)
+    out_path = args.out_path if args.out_path is not None else args.m3d_path
+    for scan_id in args.scan_id:
+        count = render_scan(args.m3d_path, scan_id, categories, os.path.join(out_path, scan_id, scan_id),
+            tuple(args.size), args.from_zip)
+        print("{}: {} views".format(scan_id, count))
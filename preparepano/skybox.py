@@ -0,0 +1,114 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# conversion of Matterport skybox cube faces to equirectangular panoramas,
+# following the geometry of py360convert.c2e: the sampling grid is built once
+# per face and output size as cv2 fixed point maps into an atlas of the six
+# faces with a one pixel border taken from the neighbouring faces. The
+# Matterport face orientation is applied when the atlas is filled and the
+# horizontal flip of the output is part of the grid. Several locations are
+# converted with one cv2.remap by stacking their atlases along the channels.
+
+import functools
+import typing
+import cv2
+import numpy as np
+
+# faces of a skybox in the order of the file names
+FACES = ['U','B','R','F','L','D']
+
+# cube faces front, right, back, left, up, down as (skybox face, row step,
+# column step) of the face orientation expected by the grid
+_CUBE = [('F', 1, -1), ('R', 1, 1), ('B', 1, 1), ('L', 1, -1), ('U', 1, 1), ('D', -1, 1)]
+FRONT, RIGHT, BACK, LEFT, UP, DOWN = range(6)
+
+@functools.lru_cache(maxsize=8)
+def skybox_grid(face_w: int, h: int, w: int) -> typing.Tuple[np.array, np.array]:
+    # the output is mirrored horizontally, so longitude runs from +pi to -pi
+    u = np.linspace(np.pi, -np.pi, num=w, dtype=np.float32)[np.newaxis,:]
+    v = np.linspace(np.pi / 2, -np.pi / 2, num=h, dtype=np.float32)[:,np.newaxis]
+    x = np.cos(v) * np.sin(u)
+    y = np.broadcast_to(np.sin(v), (h, w))
+    z = np.cos(v) * np.cos(u)
+    # cube face of every output pixel by the dominant axis of its direction
+    face = np.where(np.abs(z) >= np.abs(x), np.where(z >= 0, FRONT, BACK), np.where(x >= 0, RIGHT, LEFT))
+    face = np.where(np.abs(y) >= np.maximum(np.abs(x), np.abs(z)), np.where(y >= 0, UP, DOWN), face)
+    u = np.broadcast_to(u, (h, w))
+    v = np.broadcast_to(v, (h, w))
+
+    coor_x = np.empty((h, w), np.float32)
+    coor_y = np.empty((h, w), np.float32)
+    face_w2 = face_w / 2
+    mask = face < UP
+    angles = u[mask] - np.pi / 2 * face[mask]
+    coor_x[mask] = face_w2 * np.tan(angles)
+    coor_y[mask] = -face_w2 * np.tan(v[mask]) / np.cos(angles)
+    mask = face == UP
+    c = face_w2 * np.tan(np.pi / 2 - v[mask])
+    coor_x[mask] = c * np.sin(u[mask])
+    coor_y[mask] = c * np.cos(u[mask])
+    mask = face == DOWN
+    c = face_w2 * np.tan(np.pi / 2 - np.abs(v[mask]))
+    coor_x[mask] = c * np.sin(u[mask])
+    coor_y[mask] = -c * np.cos(u[mask])
+
+    # into the atlas of bordered faces stacked vertically
+    coor_x = np.clip(coor_x + face_w2, 0, face_w) + 1
+    coor_y = np.clip(coor_y + face_w2, 0, face_w) + 1 + face * np.float32(face_w + 2)
+    map1, map2 = cv2.convertMaps(coor_x.astype(np.float32), coor_y.astype(np.float32), cv2.CV_16SC2)
+    map1.setflags(write=False)
+    map2.setflags(write=False)
+    return map1, map2
+
+# fill the bordered faces of an atlas (6, S+2, S+2, C) from the inner
+# pixels of the neighbouring faces
+def _fill_borders(atlas: np.array) -> None:
+    atlas[FRONT,0,:] = atlas[UP,-2,:]
+    atlas[FRONT,-1,:] = atlas[DOWN,1,:]
+    atlas[RIGHT,0,:] = atlas[UP,::-1,-2]
+    atlas[RIGHT,-1,:] = atlas[DOWN,:,-2]
+    atlas[BACK,0,:] = atlas[UP,1,::-1]
+    atlas[BACK,-1,:] = atlas[DOWN,-2,::-1]
+    atlas[LEFT,0,:] = atlas[UP,:,1]
+    atlas[LEFT,-1,:] = atlas[DOWN,::-1,1]
+    atlas[UP,0,:] = atlas[BACK,1,::-1]
+    atlas[UP,-1,:] = atlas[FRONT,1,:]
+    atlas[DOWN,0,:] = atlas[FRONT,-2,:]
+    atlas[DOWN,-1,:] = atlas[BACK,-2,::-1]
+    atlas[FRONT,:,0] = atlas[LEFT,:,-2]
+    atlas[FRONT,:,-1] = atlas[RIGHT,:,1]
+    atlas[RIGHT,:,0] = atlas[FRONT,:,-2]
+    atlas[RIGHT,:,-1] = atlas[BACK,:,1]
+    atlas[BACK,:,0] = atlas[RIGHT,:,-2]
+    atlas[BACK,:,-1] = atlas[LEFT,:,1]
+    atlas[LEFT,:,0] = atlas[BACK,:,-2]
+    atlas[LEFT,:,-1] = atlas[FRONT,:,1]
+    atlas[UP,:,0] = atlas[LEFT,1,:]
+    atlas[UP,:,-1] = atlas[RIGHT,1,::-1]
+    atlas[DOWN,:,0] = atlas[LEFT,-2,::-1]
+    atlas[DOWN,:,-1] = atlas[RIGHT,-2,:]
+
+# convert the skyboxes of several locations, each given as its six faces in
+# FACES order, to equirectangular panoramas of outsize [width, height]
+def skybox_to_equirect(
+    skyboxes: typing.List[typing.List[np.array]],
+    outsize: typing.Tuple[int, int]
+) -> typing.List[np.array]:
+    face_w = skyboxes[0][0].shape[0]
+    nchannels = skyboxes[0][0].shape[2]
+    atlas = np.zeros((6, face_w + 2, face_w + 2, nchannels * len(skyboxes)), skyboxes[0][0].dtype)
+    for i, faces in enumerate(skyboxes):
+        faces = dict(zip(FACES, faces))
+        for j, (name, row_step, col_step) in enumerate(_CUBE):
+            atlas[j,1:-1,1:-1,i*nchannels:(i+1)*nchannels] = faces[name][::row_step,::col_step]
+    _fill_borders(atlas)
+    map1, map2 = skybox_grid(face_w, outsize[1], outsize[0])
+    # images of cv2 have at most 512 channels, which bounds the batch size
+    out = cv2.remap(atlas.reshape(6 * (face_w + 2), face_w + 2, -1), map1, map2, cv2.INTER_LINEAR)
+    out = out.reshape(outsize[1], outsize[0], -1)
+    return [np.ascontiguousarray(out[:,:,i*nchannels:(i+1)*nchannels]) for i in range(len(skyboxes))]
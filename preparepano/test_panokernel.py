@@ -0,0 +1,110 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# agreement of the Numba stitching backend (panokernel) with the NumPy
+# backend of createpano on one location of a synthetic scan, run with
+#
+#   python -m pytest -q test_panokernel.py
+
+import os
+import sys
+import numpy as np
+import pytest
+from scipy import ndimage
+
+pytest.importorskip("numba")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmark"))
+
+import createpano
+import panokernel
+import prepare_matterport
+import synthetic_scan
+
+OUTSIZE = (512, 256)
+
+@pytest.fixture(scope="module")
+def location(tmp_path_factory) -> dict:
+    out_path = str(tmp_path_factory.mktemp("scan"))
+    synthetic_scan.write_scan(out_path, locations=1)
+    base = os.path.join(out_path, "SYNTH0000", "SYNTH0000")
+    params = prepare_matterport.parse_camera_params(
+        os.path.join(base, "undistorted_camera_parameters", "SYNTH0000.conf"))
+    loc = sorted(params.keys())[0]
+    data = {"angles": createpano.get_angles(params[loc])}
+    for key, folder in [("color", "undistorted_color_images"), ("depth", "undistorted_depth_images")]:
+        filenames = sorted(f for f in os.listdir(os.path.join(base, folder)) if f.startswith(loc))
+        data[key] = [prepare_matterport.load_image(os.path.join(base, folder, f)) for f in filenames]
+    return data
+
+def stitch_both(images, v, blending: bool, depth: bool, dtype):
+    backend = createpano.stitch_backend
+    try:
+        createpano.stitch_backend = "numpy"
+        reference = createpano.combine_views(images, v, OUTSIZE, blending, depth, dtype=dtype)
+        createpano.stitch_backend = "numba"
+        pano = createpano.combine_views(images, v, OUTSIZE, blending, depth, dtype=dtype)
+    finally:
+        createpano.stitch_backend = backend
+    return reference.astype(np.float64), pano.astype(np.float64)
+
+# panorama pixels within two pixels of the border of any view, where the
+# backends may decide differently whether a view covers the pixel
+def view_borders(images, v) -> np.array:
+    cut = createpano.imcutout
+    band = np.zeros((OUTSIZE[1], OUTSIZE[0]), bool)
+    for i in range(len(images)):
+        ones = np.ones((cut[0][1] - cut[0][0], cut[1][1] - cut[1][0], 1), np.float32)
+        _, valid = createpano.im2sphere(ones, createpano.default_fov, OUTSIZE[0], OUTSIZE[1], v[i,0], v[i,1], True, 0)
+        valid = valid > 0
+        band |= ndimage.binary_dilation(valid, iterations=2) & ~ndimage.binary_erosion(valid, iterations=2)
+    return band
+
+# panorama pixels that sample a view within half a step of the fixed-point
+# maps (1/64 pixel) of a tie between two source pixels, where nearest
+# neighbour taps of the backends may pick different samples
+def nearest_ties(images, v) -> np.array:
+    cut = createpano.imcutout
+    imH, imW = cut[0][1] - cut[0][0], cut[1][1] - cut[1][0]
+    step = createpano.angle_quantization * createpano.default_fov / imW
+    ties = np.zeros((OUTSIZE[1], OUTSIZE[0]), bool)
+    for i in range(len(images)):
+        # at the angles of the remap tables and the kernel
+        key = createpano._view_key(imH, imW, createpano.default_fov, OUTSIZE[0], OUTSIZE[1], v[i,0], v[i,1])
+        Px, Py, valid = createpano.sphere_coords(imH, imW, createpano.default_fov, OUTSIZE[0], OUTSIZE[1],
+            key[5] * step, key[6] * step)
+        with np.errstate(invalid='ignore'):
+            tie = (np.abs(np.mod(Px, 1) - 0.5) < 1 / 64) | (np.abs(np.mod(Py, 1) - 0.5) < 1 / 64)
+        ties |= (valid & tie).reshape(OUTSIZE[1], OUTSIZE[0])
+    return ties
+
+def test_color_blending(location):
+    v = location["angles"]
+    reference, pano = stitch_both(location["color"], v, True, False, np.uint8)
+    diff = np.abs(pano - reference).max(axis=2)
+    fraction, _ = panokernel.compare_backends(location["color"], v, OUTSIZE, True, dtype=np.uint8)
+
+    assert fraction == pytest.approx(np.mean(np.abs(pano - reference) > 2))
+    # more than 2 levels apart only along view borders, and there rarely
+    assert fraction < 0.005
+    assert diff[~view_borders(location["color"], v)].max() <= 8
+
+def test_depth(location):
+    v = location["angles"]
+    reference, pano = stitch_both(location["depth"], v, False, True, np.uint16)
+    reference, pano = reference[:,:,0], pano[:,:,0]
+    diff = np.abs(pano - reference)
+
+    # nearest neighbour taps at ties between source pixels may pick the
+    # neighbouring (or an invalid) sample, which changes a few pixels
+    assert np.mean((reference == 0) != (pano == 0)) < 0.0001
+    assert np.mean(diff > 2) < 0.001
+    # elsewhere the weights and samples of both backends are the same
+    exact = ~nearest_ties(location["depth"], v) & ~view_borders(location["depth"], v)
+    assert np.array_equal(reference[exact] == 0, pano[exact] == 0)
+    assert diff[exact].max() <= 2